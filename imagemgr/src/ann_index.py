@@ -0,0 +1,252 @@
+"""
+近似最近邻检索模块
+基于 VectorIndex 的存储（分片 + 追加日志 + 墓碑），用 IVF 倒排聚类减少每次查询扫描的行数
+"""
+import threading
+import numpy as np
+from typing import Dict, Any, List, Optional
+
+from vector_index import VectorIndex, top_k_indices
+
+
+# IVF 文件：聚类中心（与行号无关，所有版本共用），以及已合并分片中每一行所属的聚类（检查点文件，按版本号命名）
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_ASSIGN_FILE = "ivf_assign"
+
+# 分配聚类/计算相似度时每批处理的行数（控制临时内存）
+IVF_CHUNK_ROWS = 16384
+
+# 每个聚类中心至少需要的训练样本数，数据量不足时仍使用精确检索
+MIN_TRAIN_ROWS_PER_LIST = 39
+
+# 每个聚类中心最多采样的训练样本数
+MAX_TRAIN_ROWS_PER_LIST = 64
+
+
+class IVFVectorIndex(VectorIndex):
+    """
+    IVF 近似检索索引
+    
+    用球面 k-means 将向量划分为 nlist 个聚类，查询时只扫描与查询最接近的 nprobe 个聚类中的行。
+    数据量达到 nlist * 39 行后在后台自动训练，训练完成前使用精确检索；
+    新增的行按最近的聚类中心增量分配，无需重新训练。
+    """
+    
+    backend = "ivf"
+    sharded_search = False  # 只扫描候选聚类中的行，不按分片并行
+    checkpoint_files = VectorIndex.checkpoint_files + (IVF_ASSIGN_FILE,)
+    
+    def __init__(self, index_dir: str, index_name: str, dimension: int,
+                 model_name: str, model_version: str,
+                 nlist: int = 1024, nprobe: int = 32, kmeans_iterations: int = 10,
+                 **kwargs):
+        """
+        初始化 IVF 索引
+        
+        Args:
+            nlist: 聚类数量
+            nprobe: 每次查询扫描的聚类数量（越大召回率越高、越慢）
+            kmeans_iterations: k-means 迭代次数
+            其余参数同 VectorIndex
+        """
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.kmeans_iterations = kmeans_iterations
+        
+        self._centroids: Optional[np.ndarray] = None  # (nlist, dimension)，已归一化
+        self._assign = np.empty(0, dtype=np.int32)  # 每行所属的聚类
+        self._assigned = 0  # 已分配聚类的行数
+        self._layout_version = 0  # 清除已删除行（ID 重新编号）时递增
+        self._train_thread: Optional[threading.Thread] = None
+        
+        super().__init__(index_dir, index_name, dimension, model_name, model_version, **kwargs)
+    
+    @property
+    def min_train_rows(self) -> int:
+        """开始训练所需的最少行数"""
+        return self.nlist * MIN_TRAIN_ROWS_PER_LIST
+    
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+    
+    def _backend_options(self) -> Dict[str, Any]:
+        return {
+            **super()._backend_options(),
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "kmeans_iterations": self.kmeans_iterations
+        }
+    
+    # ==================== 持久化 ====================
+    
+    def _load_data(self, shard_names: List[str]):
+        """先加载聚类中心和已合并部分的聚类分配，重放追加日志时再增量分配新行"""
+        centroids_path = self.index_path / IVF_CENTROIDS_FILE
+        assign_path = self._committed_file(IVF_ASSIGN_FILE)
+        if centroids_path.exists() and assign_path.exists():
+            centroids = np.load(centroids_path)
+            if centroids.shape == (self.nlist, self.dimension):
+                self._centroids = centroids
+                self._assign = np.load(assign_path).astype(np.int32)
+                self._assigned = len(self._assign)
+        
+        super()._load_data(shard_names)
+        
+        # 聚类分配文件与分片不一致时（训练保存过程中中断）补齐
+        self._assigned = min(self._assigned, self._size)
+        self._assign_pending()
+        self._train_in_background()
+    
+    def _save_checkpoint(self):
+        """合并时以下一个版本号一并保存聚类中心和已合并部分的聚类分配"""
+        if self._centroids is not None:
+            self._save_ivf(self._wal_generation + 1)
+        super()._save_checkpoint()
+    
+    def _save_ivf(self, generation: int):
+        """原子保存聚类中心和某个版本中已合并部分的聚类分配"""
+        self._save_array(self.index_path / IVF_CENTROIDS_FILE, self._centroids)
+        self._save_array(self._checkpoint_file(IVF_ASSIGN_FILE, generation),
+                         self._assign[:min(self._assigned, self._compacted_count)])
+    
+    # ==================== 聚类分配 ====================
+    
+    def _append_memory(self, embeddings: np.ndarray, items) -> int:
+        """追加新行后按最近的聚类中心分配（增量插入）"""
+        first_id = super()._append_memory(embeddings, items)
+        self._assigned = min(self._assigned, first_id)
+        self._assign_pending()
+        if self._centroids is None:
+            self._train_in_background()
+        return first_id
+    
+    def _remap_rows(self, keep: np.ndarray):
+        """清除已删除行后按新 ID 重排聚类分配"""
+        if self._centroids is not None:
+            self._assign = self._assign[keep]
+            self._assigned = len(keep)
+        self._layout_version += 1
+    
+    def _assign_pending(self):
+        """为尚未分配聚类的行分配最近的聚类中心（调用方需持有锁）"""
+        if self._centroids is None or self._assigned >= self._size:
+            return
+        self._assign = self._grow(self._assign, self._assigned, self._size)
+        for start in range(self._assigned, self._size, IVF_CHUNK_ROWS):
+            rows = np.arange(start, min(start + IVF_CHUNK_ROWS, self._size))
+            self._assign[rows] = self._nearest_centroids(self._get_rows(rows), self._centroids)
+        self._assigned = self._size
+    
+    @staticmethod
+    def _nearest_centroids(rows: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """每行最接近（内积最大）的聚类中心"""
+        return np.argmax(rows @ centroids.T, axis=1).astype(np.int32)
+    
+    # ==================== 训练 ====================
+    
+    def _kmeans(self, sample: np.ndarray) -> np.ndarray:
+        """球面 k-means：以内积为相似度，聚类中心保持归一化"""
+        rng = np.random.default_rng(0)
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            # 分批分配，按聚类排序后用 reduceat 分段求和
+            sums = np.zeros_like(centroids)
+            counts = np.zeros(self.nlist, dtype=np.int64)
+            for start in range(0, len(sample), IVF_CHUNK_ROWS):
+                chunk = sample[start:start + IVF_CHUNK_ROWS]
+                assign = self._nearest_centroids(chunk, centroids)
+                order = np.argsort(assign, kind="stable")
+                lists, bounds = np.unique(assign[order], return_index=True)
+                sums[lists] += np.add.reduceat(chunk[order], bounds)
+                counts += np.bincount(assign, minlength=self.nlist)
+            
+            # 空聚类用随机样本重新初始化
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms > 0, norms, 1)
+        return centroids.astype(np.float32)
+    
+    def train(self):
+        """
+        训练聚类中心并为所有行分配聚类（已训练时重新训练）
+        
+        采样和最终替换时持有 _write_lock（只在替换的一瞬间持有写锁）；k-means 和已有行的聚类分配
+        在锁外进行，期间搜索和新增不受阻塞
+        """
+        with self._write_lock:
+            live_rows = np.nonzero(~self._deleted[:self._size])[0]
+            if len(live_rows) < self.min_train_rows:
+                return
+            layout_version = self._layout_version
+            rng = np.random.default_rng(0)
+            sample_size = min(len(live_rows), self.nlist * MAX_TRAIN_ROWS_PER_LIST)
+            sample = self._get_rows(np.sort(rng.choice(live_rows, sample_size, replace=False)))
+            # 数据段只追加不修改，锁外读取快照是安全的
+            segments = self._segments()
+            num_rows = self._size
+        
+        centroids = self._kmeans(sample)
+        assign = np.empty(num_rows, dtype=np.int32)
+        for start, segment in segments:
+            for offset in range(0, len(segment), IVF_CHUNK_ROWS):
+                chunk = segment[offset:offset + IVF_CHUNK_ROWS]
+                assign[start + offset:start + offset + len(chunk)] = self._nearest_centroids(chunk, centroids)
+        
+        with self._write_lock:
+            if self._layout_version != layout_version:
+                return  # 训练期间 ID 已重新编号，下次新增时重新训练
+            
+            # 训练期间新增的行
+            if self._size > num_rows:
+                pending = np.arange(num_rows, self._size)
+                assign = np.concatenate([assign, self._nearest_centroids(self._get_rows(pending), centroids)])
+            
+            with self._lock.write():
+                self._centroids = centroids
+                self._assign = assign
+                self._assigned = len(assign)
+            self._save_ivf(self._wal_generation)
+    
+    def _train_in_background(self):
+        """数据量达到训练要求且尚未训练时，启动后台线程训练（同一时间只有一个）"""
+        if self._centroids is not None or self.count() < self.min_train_rows:
+            return
+        if self._train_thread is not None and self._train_thread.is_alive():
+            return
+        self._train_thread = threading.Thread(target=self.train, name=f"train-{self.index_name}", daemon=True)
+        self._train_thread.start()
+    
+    # ==================== 检索 ====================
+    
+    def _similarities(self, query: np.ndarray, exact: bool = False) -> np.ndarray:
+        """只计算 nprobe 个最近聚类中的行，其余行分数为 -inf（未训练或 exact=True 时计算所有行）"""
+        if self._centroids is None or exact:
+            return super()._similarities(query, exact)
+        
+        query = self._normalize_query(query)
+        if query.ndim == 2:
+            # 每个查询扫描的聚类不同，逐个计算
+            return np.stack([self._similarities(q) for q in query], axis=1)
+        
+        probe = np.zeros(self.nlist, dtype=bool)
+        probe[top_k_indices(self._centroids @ query, self.nprobe)] = True
+        candidates = np.nonzero(probe[self._assign[:self._size]])[0]
+        
+        # 候选行直接按 float32 计算
+        similarities = np.full(self._size, -np.inf, dtype=np.float32)
+        for start in range(0, len(candidates), IVF_CHUNK_ROWS):
+            rows = candidates[start:start + IVF_CHUNK_ROWS]
+            similarities[rows] = self._get_rows(rows) @ query
+        
+        # 屏蔽已删除的行
+        if self._deleted_count:
+            similarities[self._deleted[:self._size]] = -np.inf
+        return similarities
+    
+    def evaluate_recall(self, top_k: int = 10, num_queries: int = 100) -> Dict[str, Any]:
+        """以精确检索为基准评估 recall@k（未训练时为精确检索）"""
+        return {**super().evaluate_recall(top_k, num_queries), "trained": self.is_trained}
@@ -8,15 +8,19 @@ from typing import List, Optional
 from fastapi import FastAPI, HTTPException, UploadFile, File, Query, Form
 from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import uvicorn
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from pydantic import BaseModel, Field
+import json
+import time
 import threading
+import numpy as np
+import uvicorn
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
 
-from database import Database
+from database import Database, encode_image_cursor
 from storage import StorageManager
-from vector_index import VectorIndexManager, VectorIndex
+from vector_index import VectorIndexManager, VectorIndex, FILTER_FIELDS, normalize_filters
 from embedding_client import EmbeddingClient
+from ttl_cache import TTLCache
 
 
 # 配置
@@ -62,27 +66,49 @@ TEXT_INDEXES = {
 }
 
 # 初始化组件
+# 分片并行搜索的进程池以 fork 方式启动，必须在任何线程启动之前创建（Database 会启动后台写线程），
+# 过滤属性来源在数据库初始化后再设置（索引在之后创建，创建时从管理器获取）
+embedding_client = EmbeddingClient(str(CONFIG_PATH) if CONFIG_PATH.exists() else None)
+vector_manager = VectorIndexManager(
+    str(VECTOR_INDEX_DIR),
+    search_processes=embedding_client.config.get("search", {}).get("processes", 0)
+)
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 db = Database(str(DB_PATH))
 storage = StorageManager(str(STORAGE_DIR))
-vector_manager = VectorIndexManager(str(VECTOR_INDEX_DIR))
-embedding_client = EmbeddingClient(str(CONFIG_PATH) if CONFIG_PATH.exists() else None)
+vector_manager.attribute_loader = db.get_image_attributes
+db.add_image_listener(vector_manager.invalidate_attributes)  # 图片变更后同步索引中的过滤属性
+
+
+def _index_backend(index_name: str) -> dict:
+    """从 embedding_services.yaml 的 indexes 配置读取检索后端（默认 flat 精确检索）"""
+    index_config = embedding_client.get_index_config(index_name) or {}
+    return {
+        "backend": index_config.get("backend", "flat"),
+        "backend_options": index_config.get("backend_options")
+    }
+
 
 # 获取或创建索引 - 图片
 image_index = vector_manager.get_or_create_index(
-    IMAGE_INDEX_NAME, IMAGE_INDEX_DIMENSION, IMAGE_MODEL_NAME, IMAGE_MODEL_VERSION
+    IMAGE_INDEX_NAME, IMAGE_INDEX_DIMENSION, IMAGE_MODEL_NAME, IMAGE_MODEL_VERSION,
+    **_index_backend(IMAGE_INDEX_NAME)
 )
 
 # 获取或创建索引 - 文本（多个）
 text_indexes = {}
 for index_name, config in TEXT_INDEXES.items():
     text_indexes[index_name] = vector_manager.get_or_create_index(
-        index_name, config["dimension"], config["model_name"], config["model_version"]
+        index_name, config["dimension"], config["model_name"], config["model_version"],
+        **_index_backend(index_name)
     )
 
 # 兼容旧代码：默认文本索引（BGE 效果更好）
 text_index = text_indexes.get("bge_text_v1")
 
+# Qwen3-Embedding-8B 搜索时使用的默认 instruction
+DEFAULT_SEARCH_INSTRUCTION = "Given a web search query, retrieve relevant passages that answer the query"
+
 # FastAPI 应用
 app = FastAPI(
     title="图片管理服务",
@@ -102,6 +128,15 @@ app.add_middleware(
 
 # ==================== 请求/响应模型 ====================
 
+class SearchFilters(BaseModel):
+    """搜索过滤条件（在向量索引内取 top_k 之前应用，数据库中已删除的图片始终被排除）"""
+    source: Optional[List[str]] = None  # 图片来源（任一匹配）
+    status: Optional[List[str]] = None  # 图片状态（pending/ready）
+    method: Optional[List[str]] = None  # 匹配的向量来源（image/vlm1/human...）
+    created_from: Optional[str] = None  # 创建日期下限（YYYY-MM-DD，含当天）
+    created_to: Optional[str] = None  # 创建日期上限（YYYY-MM-DD，含当天）
+
+
 class TextSearchRequest(BaseModel):
     """文本搜索请求"""
     query: str
@@ -109,18 +144,32 @@ class TextSearchRequest(BaseModel):
     index: Optional[str] = None  # 指定使用的索引，默认使用 8B 索引
     rerank: bool = True  # 默认启用重排序（使用 8B Reranker）
     instruction: Optional[str] = None  # 可选的搜索指令（用于 Qwen3-Embedding-8B）
+    filters: Optional[SearchFilters] = None
 
 
 class ImageSearchRequest(BaseModel):
     """以图搜图请求（Base64）"""
     image_base64: str
     top_k: int = 100  # 默认返回100条结果
+    filters: Optional[SearchFilters] = None
 
 
 class CrossModalSearchRequest(BaseModel):
     """跨模态搜索请求（使用 SigLIP2 文本嵌入搜索图片）"""
     query: str
     top_k: int = 100  # 默认返回100条结果
+    filters: Optional[SearchFilters] = None
+
+
+class BatchSearchRequest(BaseModel):
+    """批量搜索请求（queries / images_base64 / sha256s 三选一）"""
+    queries: List[str] = Field([], max_length=1000)  # 文本查询，在 index 指定的文本索引中搜索
+    images_base64: List[str] = Field([], max_length=100)  # 图片查询（Base64），以图搜图（逐张计算嵌入）
+    sha256s: List[str] = Field([], max_length=1000)  # 已入库图片，直接用索引中的向量搜索相似图片（排除自身）
+    index: str = "qwen3_8b_text_v1"  # 文本查询使用的索引（siglip2_text_v1 为跨模态，在图片索引中搜索）
+    top_k: int = Field(10, ge=1, le=1000)
+    instruction: Optional[str] = None  # 可选的搜索指令（用于 Qwen3-Embedding-8B）
+    filters: Optional[SearchFilters] = None  # 所有查询共用的过滤条件
 
 
 class AddDescriptionRequest(BaseModel):
@@ -178,6 +227,7 @@ def list_indexes():
                 "name": IMAGE_INDEX_NAME,
                 "model": IMAGE_MODEL_NAME,
                 "dimension": IMAGE_INDEX_DIMENSION,
+                "backend": image_index.backend,
                 "count": image_index.count()
             }
         ],
@@ -187,6 +237,7 @@ def list_indexes():
                 "model": config["model_name"],
                 "dimension": config["dimension"],
                 "service": config["service_name"],
+                "backend": text_indexes[name].backend,
                 "count": text_indexes[name].count()
             }
             for name, config in TEXT_INDEXES.items()
@@ -194,6 +245,22 @@ def list_indexes():
     }
 
 
+@app.get("/api/indexes/{index_name}/recall")
+def evaluate_index_recall(index_name: str, top_k: int = Query(10, ge=1, le=1000),
+                          num_queries: int = Query(100, ge=1, le=1000)):
+    """
+    评估索引检索的 recall@k（以 float32 精确暴力扫描为基准）
+    
+    用于衡量近似检索（ivf）和量化存储（fp16/int8）的召回损失；
+    随机抽取索引中的向量作为查询，同时返回两种检索的平均耗时
+    """
+    index = image_index if index_name == IMAGE_INDEX_NAME else text_indexes.get(index_name)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"索引 {index_name} 不存在")
+    
+    return {"index": index_name, **index.evaluate_recall(top_k, num_queries)}
+
+
 @app.get("/api/debug/services")
 def debug_services():
     """调试接口：查看服务配置和连通性"""
@@ -406,17 +473,28 @@ def list_images(
     offset: int = Query(0, ge=0),
     limit: int = Query(20, ge=1, le=100),
     source: str = None,
-    status: str = None
+    status: str = None,
+    cursor: Optional[str] = None
 ):
-    """列出图片"""
-    images = db.list_images(offset=offset, limit=limit, source=source, status=status)
+    """
+    列出图片
+    
+    - 按创建时间倒序，翻页时传入上一页返回的 next_cursor（每页耗时与翻页深度无关）；
+      offset 仍然可用，但深层翻页会越来越慢
+    - 没有下一页时 next_cursor 为 null
+    """
+    try:
+        images = db.list_images(offset=offset, limit=limit, source=source, status=status, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     total = db.count_images(source=source, status=status)
     
     return {
         "images": images,
         "total": total,
         "offset": offset,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": encode_image_cursor(images[-1]) if len(images) == limit else None
     }
 
 
@@ -786,20 +864,126 @@ def recompute_embedding(sha256: str, include_text: bool = False):
 
 # ==================== 搜索 ====================
 
+# 文本搜索并发执行各索引的「获取嵌入 + 搜索」（嵌入为网络请求，搜索时 numpy 释放 GIL）；
+# 超时的任务在后台自行结束，不阻塞请求返回，因此使用常驻线程池
+text_search_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="text-search")
+
+
+def _search_timeout(index_name: str, service_name: str) -> float:
+    """索引搜索的超时（秒）：索引配置的 search_timeout，默认为嵌入服务的 timeout"""
+    index_config = embedding_client.get_index_config(index_name) or {}
+    return index_config.get("search_timeout") or embedding_client.get_service_timeout(service_name)
+
+
+def _search_text_index(index_name: str, query: str, instruction: Optional[str],
+                       top_k: int, filters: dict, timeout: float) -> dict:
+    """
+    单个索引的搜索流水线：获取查询嵌入，再在索引中搜索
+    
+    Returns:
+        {results, embed_ms, search_ms}，嵌入服务不可用时 results 为 None
+    """
+    service_name = TEXT_INDEXES[index_name]["service_name"]
+    start = time.perf_counter()
+    query_embedding = embedding_client.get_text_embedding_by_service(
+        query, service_name, instruction=instruction, is_query=True, timeout=timeout
+    )
+    embed_ms = round((time.perf_counter() - start) * 1000, 1)
+    if query_embedding is None:
+        return {"results": None, "embed_ms": embed_ms}
+    
+    # SigLIP2 跨模态搜索：在图片索引中搜索（而非文本索引）
+    search_index = image_index if index_name == "siglip2_text_v1" else text_indexes[index_name]
+    start = time.perf_counter()
+    results = search_index.search_deduplicated(query_embedding, top_k, filters)
+    return {
+        "results": results,
+        "embed_ms": embed_ms,
+        "search_ms": round((time.perf_counter() - start) * 1000, 1)
+    }
+
+
+def _search_filters(filters: Optional[SearchFilters] = None) -> dict:
+    """请求中的过滤条件 → 向量索引的过滤条件（不指定时也会排除数据库中已删除的图片）"""
+    conditions = {}
+    if filters is not None:
+        conditions = {name: getattr(filters, name) for name in FILTER_FIELDS
+                      if getattr(filters, name, None) is not None}
+    try:
+        return normalize_filters(conditions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _enrich_results(results: List[dict], matched_text: bool = False, **fields) -> List[dict]:
+    """
+    补充搜索结果的图片信息（一次 IN 查询批量读取数据库），数据库中不存在或已删除的图片被丢弃
+    
+    Args:
+        matched_text: 是否补充 matched_by 对应的描述文本
+        fields: 附加到每条结果上的字段
+    """
+    images = db.get_images_bulk([r["sha256"] for r in results])
+    descriptions = db.get_descriptions_bulk(list(images)) if matched_text else {}
+    
+    enriched_results = []
+    for r in results:
+        image = images.get(r["sha256"])
+        if not image:
+            continue
+        item = dict(r)
+        if matched_text:
+            methods = descriptions.get(r["sha256"], {})
+            text = methods.get(r["matched_by"])
+            if not text and r["matched_by"] in methods:
+                # 数据库中没有内容时读取描述文件
+                text = storage.get_description(r["sha256"], r["matched_by"])
+            item["matched_text"] = text or ""
+        enriched_results.append({**item, "width": image["width"], "height": image["height"], **fields})
+    return enriched_results
+
+
+# 搜索结果缓存（相同的搜索、前端翻页直接返回）：键中包含所搜索索引和数据库的数据版本，
+# 索引新增/删除向量、图片信息或描述变更后版本递增，旧条目不会再命中，随 LRU 淘汰
+_result_cache_config = embedding_client.config["search"].get("result_cache", {})
+search_result_cache = TTLCache(
+    max_entries=_result_cache_config.get("max_entries", 256),
+    ttl=_result_cache_config.get("ttl_seconds", 600)
+)
+
+
+def _search_cache_key(endpoint: str, params: tuple, filters: Optional[dict], indexes: List[VectorIndex]) -> tuple:
+    """
+    搜索结果缓存的键：接口、请求参数、过滤条件、索引和数据库的数据版本（需在搜索之前调用）
+    
+    缓存的是补充了图片信息和描述文本的完整结果，数据库有写入（如修改描述）后不再命中
+    """
+    return (
+        endpoint,
+        params,
+        json.dumps(filters, sort_keys=True),
+        tuple((index.index_name, index.version) for index in indexes),
+        db.version
+    )
+
+
 @app.post("/api/search/text")
 def search_by_text(req: TextSearchRequest):
     """
     文本搜索
     
     - 使用文本嵌入模型计算查询向量
-    - 在文本索引中搜索
-    - 按 sha256 去重返回结果
+    - 在文本索引中搜索（多个索引并发执行，每个索引有独立的超时，总耗时取决于最慢的服务）
+    - 按 sha256 去重返回结果，indexes_searched 中包含每个索引的耗时
     
     Args:
         query: 搜索文本
         top_k: 返回结果数量
         index: 指定索引 (qwen3_text_v1 / bge_text_v1)，不指定则使用所有索引
+        filters: 过滤条件（来源、状态、向量来源、创建日期）
     """
+    filters = _search_filters(req.filters)
+    
     # 如果指定了索引，验证是否存在
     if req.index and req.index not in text_indexes:
         raise HTTPException(
@@ -815,41 +999,59 @@ def search_by_text(req: TextSearchRequest):
         # 未指定索引，搜索所有索引
         indexes_to_search = TEXT_INDEXES
     
-    # 收集所有索引的搜索结果
-    all_results = []
-    used_models = []
-    failed_services = []
-    
-    # Qwen3-Embedding-8B 搜索时使用的默认 instruction
-    DEFAULT_SEARCH_INSTRUCTION = "Given a web search query, retrieve relevant passages that answer the query"
-    
+    cache_key = _search_cache_key(
+        "text", (req.query, req.index, req.top_k, req.rerank, req.instruction), filters,
+        [image_index if name == "siglip2_text_v1" else text_indexes[name] for name in indexes_to_search]
+    )
+    cached = search_result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # 所有索引并发执行「获取嵌入 + 搜索」
+    # 对于搜索 Query，使用 is_query=True 和 instruction
+    # 用户可以通过 req.instruction 传入自定义指令，否则使用默认指令
+    started = time.perf_counter()
+    pending = []
     for index_name, index_config in indexes_to_search.items():
         service_name = index_config.get("service_name")
-        model_name = index_config.get("model_name")
-        
-        # 使用对应服务获取文本嵌入
-        # 对于搜索 Query，使用 is_query=True 和 instruction
-        # 用户可以通过 req.instruction 传入自定义指令，否则使用默认指令
         if "8b" in service_name.lower():
             instruction = req.instruction if req.instruction else DEFAULT_SEARCH_INSTRUCTION
         else:
             instruction = None
-        query_embedding = embedding_client.get_text_embedding_by_service(
-            req.query, service_name, instruction=instruction, is_query=True
+        timeout = _search_timeout(index_name, service_name)
+        future = text_search_executor.submit(
+            _search_text_index, index_name, req.query, instruction, req.top_k, filters, timeout
         )
-        if query_embedding is None:
-            print(f"警告: 文本嵌入服务 {service_name} 不可用，跳过索引 {index_name}")
-            failed_services.append({"index": index_name, "service": service_name, "model": model_name})
+        pending.append((index_name, index_config, timeout, future))
+    
+    # 收集所有索引的搜索结果（按索引顺序，每个索引最多等到各自的超时）
+    all_results = []
+    used_models = []
+    failed_services = []
+    
+    for index_name, index_config, timeout, future in pending:
+        service_name = index_config.get("service_name")
+        model_name = index_config.get("model_name")
+        try:
+            outcome = future.result(timeout=max(0.0, started + timeout - time.perf_counter()))
+        except FuturesTimeoutError:
+            print(f"警告: 索引 {index_name} 搜索超时（{timeout}s），跳过")
+            failed_services.append({
+                "index": index_name, "service": service_name, "model": model_name,
+                "reason": "timeout", "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+            })
             continue
         
-        # SigLIP2 跨模态搜索：在图片索引中搜索（而非文本索引）
-        if index_name == "siglip2_text_v1":
-            search_index = image_index  # 使用图片索引
-        else:
-            search_index = text_indexes[index_name]
-        results = search_index.search_deduplicated(query_embedding, req.top_k)
+        if outcome["results"] is None:
+            print(f"警告: 文本嵌入服务 {service_name} 不可用，跳过索引 {index_name}")
+            failed_services.append({
+                "index": index_name, "service": service_name, "model": model_name,
+                "reason": "unavailable", "elapsed_ms": outcome["embed_ms"]
+            })
+            continue
         
         # 为每个结果添加索引和模型信息
+        results = outcome["results"]
         for r in results:
             r["index"] = index_name
             r["model"] = model_name
@@ -858,7 +1060,10 @@ def search_by_text(req: TextSearchRequest):
         used_models.append({
             "index": index_name,
             "model": model_name,
-            "result_count": len(results)
+            "result_count": len(results),
+            "embed_ms": outcome["embed_ms"],
+            "search_ms": outcome["search_ms"],
+            "total_ms": round(outcome["embed_ms"] + outcome["search_ms"], 1)
         })
     
     # 区分"服务不可用"和"索引为空/无匹配结果"
@@ -898,19 +1103,8 @@ def search_by_text(req: TextSearchRequest):
     # 取 top_k 个结果
     deduplicated = list(seen_sha256.values())[:req.top_k]
     
-    # 补充图片信息和获取描述文本
-    enriched_results = []
-    for r in deduplicated:
-        image = db.get_image(r["sha256"])
-        if image:
-            # 获取匹配的描述内容
-            matched_text = storage.get_description(r["sha256"], r["matched_by"])
-            enriched_results.append({
-                **r,
-                "matched_text": matched_text or "",
-                "width": image["width"],
-                "height": image["height"]
-            })
+    # 补充图片信息和匹配的描述文本
+    enriched_results = _enrich_results(deduplicated, matched_text=True)
     
     # 如果启用重排序，使用 LLM 精排
     reranked = False
@@ -938,12 +1132,16 @@ def search_by_text(req: TextSearchRequest):
         else:
             print("[Rerank] 重排序服务返回空结果")
     
-    return {
+    response = {
         "query": req.query, 
         "indexes_searched": used_models,
         "reranked": reranked,
         "results": enriched_results
     }
+    # 部分索引失败或重排序失败的结果不缓存，下次请求重试
+    if not failed_services and (reranked or not req.rerank):
+        search_result_cache.put(cache_key, response)
+    return response
 
 
 @app.post("/api/search/crossmodal")
@@ -955,6 +1153,12 @@ def search_crossmodal(req: CrossModalSearchRequest):
     - 在图片索引中直接搜索
     - 无需图片有描述，可直接用自然语言搜索图片
     """
+    filters = _search_filters(req.filters)
+    cache_key = _search_cache_key("crossmodal", (req.query, req.top_k), filters, [image_index])
+    cached = search_result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     # 使用 siglip2 服务获取文本嵌入
     # SigLIP2 是视觉-语言对齐模型，不需要 instruction 和 is_query 参数
     query_embedding = embedding_client.get_text_embedding_by_service(req.query, "siglip2_local")
@@ -962,35 +1166,30 @@ def search_crossmodal(req: CrossModalSearchRequest):
         raise HTTPException(status_code=503, detail="SigLIP2 文本嵌入服务不可用")
     
     # 在图片索引中搜索（而不是文本索引）
-    results = image_index.search_deduplicated(query_embedding, req.top_k)
+    results = image_index.search_deduplicated(query_embedding, req.top_k, filters)
     
     # 补充图片信息
-    enriched_results = []
-    for r in results:
-        image = db.get_image(r["sha256"])
-        if image:
-            enriched_results.append({
-                **r,
-                "width": image["width"],
-                "height": image["height"],
-                "matched_by": "crossmodal"
-            })
+    enriched_results = _enrich_results(results, matched_by="crossmodal")
     
-    return {
+    response = {
         "query": req.query,
         "method": "siglip2_crossmodal",
         "results": enriched_results
     }
+    search_result_cache.put(cache_key, response)
+    return response
 
 
 @app.post("/api/search/image")
-async def search_by_image(file: UploadFile = File(...), top_k: int = Form(10)):
+async def search_by_image(file: UploadFile = File(...), top_k: int = Form(10),
+                          source: Optional[str] = Form(None)):
     """
     以图搜图
     
     - 使用图片嵌入模型计算查询向量
-    - 在图片索引中搜索
+    - 在图片索引中搜索（可按图片来源过滤）
     """
+    filters = _search_filters(SearchFilters(source=[source]) if source else None)
     try:
         # 读取图片
         content = await file.read()
@@ -1001,18 +1200,10 @@ async def search_by_image(file: UploadFile = File(...), top_k: int = Form(10)):
             raise HTTPException(status_code=503, detail="图片嵌入服务不可用")
         
         # 搜索
-        results = image_index.search_deduplicated(query_embedding, top_k)
+        results = image_index.search_deduplicated(query_embedding, top_k, filters)
         
         # 补充图片信息
-        enriched_results = []
-        for r in results:
-            image = db.get_image(r["sha256"])
-            if image:
-                enriched_results.append({
-                    **r,
-                    "width": image["width"],
-                    "height": image["height"]
-                })
+        enriched_results = _enrich_results(results)
         
         return {"results": enriched_results}
     
@@ -1025,6 +1216,7 @@ def search_by_image_base64(req: ImageSearchRequest):
     """以图搜图（Base64 方式）"""
     import base64
     
+    filters = _search_filters(req.filters)
     try:
         # 解码图片
         image_bytes = base64.b64decode(req.image_base64)
@@ -1035,18 +1227,10 @@ def search_by_image_base64(req: ImageSearchRequest):
             raise HTTPException(status_code=503, detail="图片嵌入服务不可用")
         
         # 搜索
-        results = image_index.search_deduplicated(query_embedding, req.top_k)
+        results = image_index.search_deduplicated(query_embedding, req.top_k, filters)
         
         # 补充图片信息
-        enriched_results = []
-        for r in results:
-            image = db.get_image(r["sha256"])
-            if image:
-                enriched_results.append({
-                    **r,
-                    "width": image["width"],
-                    "height": image["height"]
-                })
+        enriched_results = _enrich_results(results)
         
         return {"results": enriched_results}
     
@@ -1055,50 +1239,126 @@ def search_by_image_base64(req: ImageSearchRequest):
 
 
 @app.get("/api/search/similar/{sha256}")
-def search_similar_images(sha256: str, top_k: int = 100):
+def search_similar_images(sha256: str, top_k: int = 100, source: Optional[str] = None):
     """
     通过已有图片的 sha256 搜索相似图片
     
-    - 读取图片的已保存嵌入向量
-    - 在图片索引中搜索相似图片
+    - 从图片索引中取出该图片的嵌入向量
+    - 在图片索引中搜索相似图片（可按图片来源过滤）
     - 排除自身
     """
+    filters = _search_filters(SearchFilters(source=[source]) if source else None)
+    
     # 检查图片是否存在
     image = db.get_image(sha256)
     if not image:
         raise HTTPException(status_code=404, detail=f"图片不存在: {sha256}")
     
-    # 读取已保存的嵌入向量
-    embedding = storage.get_embedding(sha256, "image")
+    cache_key = _search_cache_key("similar", (sha256, top_k), filters, [image_index])
+    cached = search_result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # 直接从内存中的索引取嵌入向量，索引中没有时再读取已保存的文件
+    vectors = image_index.get_vectors(sha256, "image")
+    embedding = vectors[0] if vectors is not None else storage.get_embedding(sha256, "image")
     if embedding is None:
         raise HTTPException(status_code=400, detail="图片嵌入向量不存在，请先计算嵌入")
     
     # 搜索相似图片（多取一个，因为可能包含自身）
-    results = image_index.search_deduplicated(embedding, top_k + 1)
+    results = image_index.search_deduplicated(embedding, top_k + 1, filters)
     
     # 过滤掉自身并补充图片信息
-    enriched_results = []
-    for r in results:
-        if r["sha256"] == sha256:
-            continue  # 跳过自身
-        
-        img = db.get_image(r["sha256"])
-        if img:
-            enriched_results.append({
-                **r,
-                "width": img["width"],
-                "height": img["height"],
-                "matched_by": "image"
-            })
-        
-        if len(enriched_results) >= top_k:
-            break
+    others = [r for r in results if r["sha256"] != sha256]
+    enriched_results = _enrich_results(others, matched_by="image")[:top_k]
     
-    return {
+    response = {
         "source_sha256": sha256,
         "results": enriched_results,
         "total": len(enriched_results)
     }
+    search_result_cache.put(cache_key, response)
+    return response
+
+
+@app.post("/api/search/batch")
+def search_batch(req: BatchSearchRequest):
+    """
+    批量搜索（离线评估、查重等一次发起大量查询的场景）
+    
+    - 所有查询向量拼成矩阵，在索引中用一次矩阵乘法完成搜索
+    - 文本查询使用嵌入服务的批量接口；图片查询逐张计算嵌入；sha256 查询直接取图片索引中的向量
+    - 结果只包含 sha256/score/matched_by，不逐条查询数据库补充图片信息
+    """
+    import base64
+    import binascii
+    
+    provided = [name for name in ("queries", "images_base64", "sha256s") if getattr(req, name)]
+    if len(provided) != 1:
+        raise HTTPException(status_code=400, detail="queries / images_base64 / sha256s 需要且只能提供一种")
+    filters = _search_filters(req.filters)
+    
+    top_k = req.top_k
+    if req.queries:
+        if req.index not in TEXT_INDEXES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"索引 {req.index} 不存在，可选: {list(TEXT_INDEXES.keys())}"
+            )
+        service_name = TEXT_INDEXES[req.index]["service_name"]
+        if "8b" in service_name.lower():
+            instruction = req.instruction if req.instruction else DEFAULT_SEARCH_INSTRUCTION
+        else:
+            instruction = None
+        embeddings = embedding_client.get_text_embeddings_batch_by_service(
+            req.queries, service_name, instruction=instruction, is_query=True
+        )
+        if embeddings is None:
+            raise HTTPException(status_code=503, detail=f"文本嵌入服务 {service_name} 不可用")
+        
+        # SigLIP2 跨模态搜索：在图片索引中搜索（而非文本索引）
+        search_index = image_index if req.index == "siglip2_text_v1" else text_indexes[req.index]
+        labels = req.queries
+    elif req.images_base64:
+        embeddings = []
+        for i, image_base64 in enumerate(req.images_base64):
+            try:
+                image_bytes = base64.b64decode(image_base64)
+            except (binascii.Error, ValueError):
+                raise HTTPException(status_code=400, detail=f"第 {i + 1} 张图片的 Base64 编码无效")
+            embedding = embedding_client.get_image_embedding(image_bytes=image_bytes)
+            if embedding is None:
+                raise HTTPException(status_code=503, detail="图片嵌入服务不可用")
+            embeddings.append(embedding)
+        search_index = image_index
+        labels = list(range(len(req.images_base64)))
+    else:
+        embeddings = []
+        for sha256 in req.sha256s:
+            vectors = image_index.get_vectors(sha256, "image")
+            if vectors is None:
+                raise HTTPException(status_code=400, detail=f"图片不在图片索引中: {sha256}")
+            embeddings.append(vectors[0])
+        search_index = image_index
+        labels = req.sha256s
+        top_k += 1  # 多取一个，因为包含自身
+    
+    try:
+        batch_results = search_index.search_batch(np.stack(embeddings), top_k, deduplicate=True, filters=filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    results = []
+    for label, query_results in zip(labels, batch_results):
+        if req.sha256s:
+            query_results = [r for r in query_results if r["sha256"] != label][:req.top_k]
+        results.append({"query": label, "results": query_results})
+    
+    return {
+        "query_type": provided[0],
+        "index": search_index.index_name,
+        "results": results
+    }
 
 
 # ==================== VLM 配置 ====================
@@ -1164,15 +1424,14 @@ def get_stats():
         "pending_images": db.count_images(status="pending"),
         "failed_images": db.count_images(status="failed"),
         "image_index_count": image_index.count(),
-        "text_index_count": text_index.count()
+        "text_index_count": text_index.count(),
+        "embedding_cache": embedding_client.embedding_cache.stats(),
+        "search_cache": search_result_cache.stats()
     }
 
 
 # ==================== 批量处理 ====================
 
-# 用于保护数据库和存储操作的锁（确保线程安全）
-_db_lock = threading.Lock()
-
 class BatchImportRequest(BaseModel):
     """批量导入请求"""
     directory: str
@@ -1358,18 +1617,56 @@ def generate_caption_with_vlm(image_path: str, prompt_name: str = None,
         return None
 
 
+# 批量导入/生成描述时每处理多少张图片把收集的向量写入索引一次（每个索引一次 add_many）
+INDEX_BATCH_IMAGES = 64
+
+
+class IndexBatch:
+    """
+    收集批量处理中各图片的新向量，flush 时每个索引调用一次 add_many，
+    向量条目合并成一个事务记录到数据库（多个处理线程可以同时 add）
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # (索引名, 模型名, 模型版本) -> [{sha256, method, embedding}, ...]
+    
+    def add(self, index_name: str, model_name: str, model_version: str,
+            sha256: str, method: str, embedding: np.ndarray):
+        with self._lock:
+            self._pending.setdefault((index_name, model_name, model_version), []).append(
+                {"sha256": sha256, "method": method, "embedding": embedding}
+            )
+    
+    def discard(self, sha256: str):
+        """丢弃某张图片尚未写入索引的向量（重新导入时先从索引中移除旧向量）"""
+        with self._lock:
+            for records in self._pending.values():
+                records[:] = [r for r in records if r["sha256"] != sha256]
+    
+    def flush(self):
+        """把收集的向量写入各索引并记录到数据库"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (index_name, model_name, model_version), records in pending.items():
+            _flush_index_batch(index_name, model_name, model_version, records)
+
+
 def import_single_image(file_path: Path, source: str = None, generate_caption: bool = False, 
                         caption_method: str = "vlm", caption_prompt: str = None,
-                        vlm_service: str = None, force_reimport: bool = False) -> dict:
+                        vlm_service: str = None, force_reimport: bool = False,
+                        index_batch: Optional[IndexBatch] = None) -> dict:
     """
     导入单张图片
     
     Args:
         force_reimport: 强制重新导入，即使图片已存在也重新计算嵌入
+        index_batch: 批量导入时收集新向量，由调用方统一写入索引；不指定时返回前写入
     
     Returns:
         导入结果字典
     """
+    batch = index_batch if index_batch is not None else IndexBatch()
     result = {
         "file": str(file_path),
         "status": "unknown",
@@ -1378,82 +1675,76 @@ def import_single_image(file_path: Path, source: str = None, generate_caption: b
     }
     
     try:
-        # 读取文件
-        content = file_path.read_bytes()
-        sha256 = storage.compute_sha256_from_bytes(content)
-        result["sha256"] = sha256
-        
-        # 检查是否已存在
-        already_exists = db.image_exists(sha256)
-        if already_exists and not force_reimport:
-            result["status"] = "skipped"
-            result["message"] = "图片已存在"
-            return result
-        
-        if already_exists and force_reimport:
-            # 强制重新导入：删除旧的向量记录，重新计算嵌入
-            db.delete_vector_entries(sha256)
-            image_index.remove(sha256)
-            for idx in text_indexes.values():
-                idx.remove(sha256)
+        # 数据库写操作进入写入队列，与其他导入线程的写入合并成事务，返回前等待提交
+        with db.write_behind():
+            # 读取文件
+            content = file_path.read_bytes()
+            sha256 = storage.compute_sha256_from_bytes(content)
+            result["sha256"] = sha256
             
-            # 获取已存在的图片信息
-            existing = db.get_image(sha256)
-            meta = {
-                "width": existing["width"],
-                "height": existing["height"],
-                "file_size": existing["file_size"],
-                "format": existing["format"]
-            }
-            image_path = storage.get_image_path(sha256)
-            result["message"] = "重新导入"
-        else:
-            # 新图片：保存文件
-            image_path, meta = storage.save_image_from_bytes(content, sha256)
+            # 检查是否已存在
+            already_exists = db.image_exists(sha256)
+            if already_exists and not force_reimport:
+                result["status"] = "skipped"
+                result["message"] = "图片已存在"
+                return result
+            
+            if already_exists and force_reimport:
+                # 强制重新导入：删除旧的向量记录，重新计算嵌入
+                db.delete_vector_entries(sha256)
+                batch.discard(sha256)
+                image_index.remove(sha256)
+                for idx in text_indexes.values():
+                    idx.remove(sha256)
+                
+                # 获取已存在的图片信息
+                existing = db.get_image(sha256)
+                meta = {
+                    "width": existing["width"],
+                    "height": existing["height"],
+                    "file_size": existing["file_size"],
+                    "format": existing["format"]
+                }
+                image_path = storage.get_image_path(sha256)
+                result["message"] = "重新导入"
+            else:
+                # 新图片：保存文件
+                image_path, meta = storage.save_image_from_bytes(content, sha256)
+                
+                # 添加数据库记录
+                db.add_image(
+                    sha256=sha256,
+                    width=meta["width"],
+                    height=meta["height"],
+                    file_size=meta["file_size"],
+                    format=meta["format"],
+                    source=source
+                )
+                result["message"] = "新导入"
+            
+            # 计算图片嵌入 (这是I/O密集型操作，可以并发)
+            embedding = embedding_client.get_image_embedding(image_path=str(image_path))
             
-            # 添加数据库记录
-            db.add_image(
-                sha256=sha256,
-                width=meta["width"],
-                height=meta["height"],
-                file_size=meta["file_size"],
-                format=meta["format"],
-                source=source
-            )
-            result["message"] = "新导入"
-        
-        # 计算图片嵌入 (这是I/O密集型操作，不需要加锁)
-        embedding = embedding_client.get_image_embedding(image_path=str(image_path))
-        
-        # 数据库和索引操作需要加锁
-        with _db_lock:
             if embedding is not None:
                 # 保存嵌入到文件
                 storage.save_embedding(sha256, "image", embedding)
                 
-                # 添加到向量索引
-                image_index.add(embedding, sha256, "image")
-                
-                # 记录到数据库
-                db.add_vector_entry(
-                    sha256, "image", IMAGE_MODEL_NAME, IMAGE_MODEL_VERSION, IMAGE_INDEX_NAME
-                )
+                # 添加到向量索引并记录到数据库（与同一批的其他图片一起写入）
+                batch.add(IMAGE_INDEX_NAME, IMAGE_MODEL_NAME, IMAGE_MODEL_VERSION, sha256, "image", embedding)
                 
                 db.update_image_status(sha256, "ready")
             else:
                 db.update_image_status(sha256, "pending")
-        
-        # 可选：生成描述
-        if generate_caption:
-            # VLM 调用不需要加锁（I/O密集型）
-            caption = generate_caption_with_vlm(str(image_path), prompt_name=caption_prompt, 
-                                                vlm_service=vlm_service)
-            if caption:
-                # 计算文本嵌入（I/O密集型）
-                all_embeddings = embedding_client.get_all_text_embeddings(caption)
-                
-                # 数据库和索引操作需要加锁
-                with _db_lock:
+            
+            # 可选：生成描述
+            if generate_caption:
+                # VLM 调用（I/O密集型，可以并发）
+                caption = generate_caption_with_vlm(str(image_path), prompt_name=caption_prompt, 
+                                                    vlm_service=vlm_service)
+                if caption:
+                    # 计算文本嵌入（I/O密集型）
+                    all_embeddings = embedding_client.get_all_text_embeddings(caption)
+                    
                     # 保存描述
                     storage.save_description(sha256, caption_method, caption)
                     db.add_description(sha256, caption_method, caption)
@@ -1473,17 +1764,19 @@ def import_single_image(file_path: Path, source: str = None, generate_caption: b
                         if index_name and index_name in text_indexes:
                             emb_filename = f"{caption_method}_{model_name.replace('-', '_')}"
                             storage.save_embedding(sha256, emb_filename, emb)
-                            text_indexes[index_name].add(emb, sha256, caption_method)
-                            db.add_vector_entry(sha256, caption_method, model_name, model_version, index_name)
+                            batch.add(index_name, model_name, model_version, sha256, caption_method, emb)
                     
                     db.update_description_embedding(sha256, caption_method, True)
-                result["caption"] = caption[:100] + "..." if len(caption) > 100 else caption
-        
-        result["status"] = "imported"
-        result["message"] = "导入成功"
-        result["width"] = meta["width"]
-        result["height"] = meta["height"]
+                    result["caption"] = caption[:100] + "..." if len(caption) > 100 else caption
+            
+            result["status"] = "imported"
+            result["message"] = "导入成功"
+            result["width"] = meta["width"]
+            result["height"] = meta["height"]
         
+        if index_batch is None:
+            batch.flush()
+            
     except Exception as e:
         result["status"] = "failed"
         result["message"] = str(e)
@@ -1530,7 +1823,9 @@ def batch_import_directory(req: BatchImportRequest):
     failed = 0
     details = []
     
-    for file_path in image_files:
+    # 新向量每 INDEX_BATCH_IMAGES 张图片写入索引一次
+    index_batch = IndexBatch()
+    for i, file_path in enumerate(image_files, 1):
         result = import_single_image(
             file_path, 
             source=req.source, 
@@ -1538,7 +1833,8 @@ def batch_import_directory(req: BatchImportRequest):
             caption_method=req.caption_method,
             caption_prompt=req.caption_prompt,
             vlm_service=req.vlm_service,
-            force_reimport=req.force_reimport
+            force_reimport=req.force_reimport,
+            index_batch=index_batch
         )
         details.append(result)
         
@@ -1548,6 +1844,10 @@ def batch_import_directory(req: BatchImportRequest):
             skipped += 1
         else:
             failed += 1
+        
+        if i % INDEX_BATCH_IMAGES == 0:
+            index_batch.flush()
+    index_batch.flush()
     
     return {
         "total_files": len(image_files),
@@ -1615,6 +1915,7 @@ def batch_import_directory_stream(req: BatchImportRequest):
         failed = 0
         start_time = time.time()
         completed_count = 0
+        index_batch = IndexBatch()  # 新向量每完成 INDEX_BATCH_IMAGES 个文件写入索引一次
         
         # 定义处理单个文件的函数
         def process_file(file_path, index):
@@ -1626,7 +1927,8 @@ def batch_import_directory_stream(req: BatchImportRequest):
                 caption_method=req.caption_method,
                 caption_prompt=req.caption_prompt,
                 vlm_service=req.vlm_service,
-                force_reimport=req.force_reimport
+                force_reimport=req.force_reimport,
+                index_batch=index_batch
             )
             return {
                 "index": index,
@@ -1645,6 +1947,8 @@ def batch_import_directory_stream(req: BatchImportRequest):
             
             # 按完成顺序处理结果
             for future in as_completed(futures):
+                if completed_count % INDEX_BATCH_IMAGES == 0:
+                    index_batch.flush()
                 try:
                     res = future.result()
                     result = res["result"]
@@ -1695,6 +1999,8 @@ def batch_import_directory_stream(req: BatchImportRequest):
                     
                     yield f"event: progress\ndata: {json.dumps({'current': completed_count, 'total': total, 'percent': round(completed_count / total * 100, 1), 'imported': imported, 'skipped': skipped, 'failed': failed, 'speed': round(speed, 2), 'eta': round(eta, 1), 'elapsed': round(elapsed, 1), 'item': {'file': 'unknown', 'status': 'error', 'message': str(e), 'time': 0}})}\n\n"
         
+        index_batch.flush()
+        
         # 发送完成事件
         total_elapsed = time.time() - start_time
         complete_data = {
@@ -1718,9 +2024,11 @@ def batch_import_directory_stream(req: BatchImportRequest):
     )
 
 
-def _process_single_image(img: dict, method: str, prompt_name: Optional[str], vlm_service: Optional[str]):
-    """处理单张图片的描述生成（供并发调用）"""
+def _process_single_image(img: dict, method: str, prompt_name: Optional[str], vlm_service: Optional[str],
+                          index_batch: Optional[IndexBatch] = None):
+    """处理单张图片的描述生成（供并发调用，新向量收集到 index_batch 中由调用方写入索引）"""
     sha256 = img["sha256"]
+    batch = index_batch if index_batch is not None else IndexBatch()
     
     # 获取图片路径
     image_path = storage.get_image_path(sha256)
@@ -1733,37 +2041,32 @@ def _process_single_image(img: dict, method: str, prompt_name: Optional[str], vl
     if not caption:
         return {"sha256": sha256, "status": "failed", "message": "VLM 服务失败"}
     
-    # 数据库和存储操作需要加锁
-    with _db_lock:
-        # 保存描述
-        storage.save_description(sha256, method, caption)
-        db.add_description(sha256, method, caption)
-        
-        # 计算文本嵌入
-        all_embeddings = embedding_client.get_all_text_embeddings(caption)
+    # 保存描述
+    storage.save_description(sha256, method, caption)
+    db.add_description(sha256, method, caption)
+    
+    # 计算文本嵌入
+    all_embeddings = embedding_client.get_all_text_embeddings(caption)
+    
+    for service_name, emb_info in all_embeddings.items():
+        emb = emb_info["embedding"]
+        model_name = emb_info["model_name"]
+        model_version = emb_info["model_version"]
         
-        for service_name, emb_info in all_embeddings.items():
-            emb = emb_info["embedding"]
-            model_name = emb_info["model_name"]
-            model_version = emb_info["model_version"]
-            
-            index_name = None
-            for idx_name, idx_config in TEXT_INDEXES.items():
-                if idx_config["service_name"] == service_name:
-                    index_name = idx_name
-                    break
-            
-            if index_name and index_name in text_indexes:
-                emb_filename = f"{method}_{model_name.replace('-', '_')}"
-                storage.save_embedding(sha256, emb_filename, emb)
-                text_indexes[index_name].add(emb, sha256, method)
-                
-                try:
-                    db.add_vector_entry(sha256, method, model_name, model_version, index_name)
-                except:
-                    pass  # 忽略重复记录
+        index_name = None
+        for idx_name, idx_config in TEXT_INDEXES.items():
+            if idx_config["service_name"] == service_name:
+                index_name = idx_name
+                break
         
-        db.update_description_embedding(sha256, method, True)
+        if index_name and index_name in text_indexes:
+            emb_filename = f"{method}_{model_name.replace('-', '_')}"
+            storage.save_embedding(sha256, emb_filename, emb)
+            batch.add(index_name, model_name, model_version, sha256, method, emb)
+    
+    if index_batch is None:
+        batch.flush()
+    db.update_description_embedding(sha256, method, True)
     
     return {
         "sha256": sha256, 
@@ -1812,12 +2115,13 @@ def batch_generate_captions(
     processed = 0
     failed = 0
     results = []
+    index_batch = IndexBatch()  # 新向量每完成 INDEX_BATCH_IMAGES 张图片写入索引一次
     
     # 使用线程池并发处理
     with ThreadPoolExecutor(max_workers=concurrency) as executor:
         # 提交所有任务
         future_to_img = {
-            executor.submit(_process_single_image, img, method, prompt, vlm_service): img
+            executor.submit(_process_single_image, img, method, prompt, vlm_service, index_batch): img
             for img in images_to_process
         }
         
@@ -1829,6 +2133,9 @@ def batch_generate_captions(
                 processed += 1
             else:
                 failed += 1
+            if len(results) % INDEX_BATCH_IMAGES == 0:
+                index_batch.flush()
+    index_batch.flush()
     
     return {
         "total": len(images),
@@ -1952,7 +2259,68 @@ class RebuildIndexRequest(BaseModel):
     """更新嵌入请求"""
     index_name: str  # 索引名称，如 qwen3_8b_text_v1
     concurrency: int = 4  # 并发数量
-    batch_size: int = 500  # 内部批次大小（用于分批获取数据，避免内存问题）
+    batch_size: int = 500  # 内部批次大小（每累计这么多条嵌入批量写入一次索引）
+
+
+def _compute_description_embedding(desc: dict, service_name: str, model_name: str) -> dict:
+    """计算单条描述的嵌入并保存到文件（供并发调用，不写索引）"""
+    sha256 = desc["image_sha256"]
+    method = desc["method"]
+    content = desc["content"]
+    
+    try:
+        # 获取嵌入向量
+        embedding = embedding_client.get_text_embedding_by_service(content, service_name, use_cache=False)
+        if embedding is None:
+            return {"sha256": sha256, "method": method, "status": "failed", "error": "嵌入服务返回空"}
+        
+        # 保存嵌入文件
+        emb_filename = f"{method}_{model_name.replace('-', '_')}"
+        storage.save_embedding(sha256, emb_filename, embedding)
+        
+        return {"sha256": sha256, "method": method, "status": "success", "embedding": embedding}
+    
+    except Exception as e:
+        return {"sha256": sha256, "method": method, "status": "failed", "error": str(e)}
+
+
+def _imap_bounded(executor: ThreadPoolExecutor, fn, items, max_pending: int):
+    """
+    按完成顺序产出 fn(item) 的结果；items 按需读取，同一时间最多 max_pending 个任务在途，
+    内存占用与 items 的总数无关
+    """
+    pending = set()
+    for item in items:
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(fn, item))
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def _flush_index_batch(index_name: str, model_name: str, model_version: str, pending: List[dict]):
+    """将一批已计算的嵌入一次性写入向量索引并记录到数据库，然后清空 pending"""
+    if not pending:
+        return
+    
+    index = image_index if index_name == IMAGE_INDEX_NAME else text_indexes[index_name]
+    index.add_many(
+        [r.pop("embedding") for r in pending],
+        [r["sha256"] for r in pending],
+        [r["method"] for r in pending]
+    )
+    
+    # 整批记录合并成一个事务提交（每条记录独立，重复记录失败不影响其他记录）
+    try:
+        with db.write_behind():
+            for r in pending:
+                db.add_vector_entry(r["sha256"], r["method"], model_name, model_version, index_name)
+    except Exception:
+        pass  # 忽略重复记录
+    
+    pending.clear()
 
 
 @app.post("/api/batch/rebuild-index")
@@ -1987,9 +2355,8 @@ def batch_rebuild_index(req: RebuildIndexRequest):
             detail=f"嵌入服务 {service_name} 未配置 endpoint"
         )
     
-    # 获取缺少该索引的所有描述
-    descriptions = db.get_descriptions_missing_index(req.index_name, limit=100000)
-    total = len(descriptions)
+    # 缺少该索引的描述数量（描述在处理时分批读取，不一次性加载）
+    total = db.count_descriptions_missing_index(req.index_name)
     
     if total == 0:
         return {
@@ -2003,49 +2370,27 @@ def batch_rebuild_index(req: RebuildIndexRequest):
     processed = 0
     failed = 0
     failed_list = []
+    pending = []  # 已计算嵌入、等待批量写入索引的结果
     
     def process_single(desc: dict) -> dict:
-        """处理单条描述"""
-        sha256 = desc["image_sha256"]
-        method = desc["method"]
-        content = desc["content"]
-        
-        try:
-            # 获取嵌入向量
-            embedding = embedding_client.get_text_embedding_by_service(content, service_name)
-            if embedding is None:
-                return {"sha256": sha256, "method": method, "status": "failed", "error": "嵌入服务返回空"}
-            
-            # 保存嵌入文件
-            emb_filename = f"{method}_{model_name.replace('-', '_')}"
-            storage.save_embedding(sha256, emb_filename, embedding)
-            
-            # 添加到向量索引
-            text_indexes[req.index_name].add(embedding, sha256, method)
-            
-            # 记录到数据库
-            try:
-                db.add_vector_entry(sha256, method, model_name, model_version, req.index_name)
-            except:
-                pass  # 忽略重复记录
-            
-            return {"sha256": sha256, "method": method, "status": "success"}
-        
-        except Exception as e:
-            return {"sha256": sha256, "method": method, "status": "failed", "error": str(e)}
+        """处理单条描述（只计算并保存嵌入，索引由主线程批量写入）"""
+        return _compute_description_embedding(desc, service_name, model_name)
     
-    # 使用线程池并发处理
+    # 使用线程池并发处理：边读取边提交，在途任务数有上限
     with ThreadPoolExecutor(max_workers=req.concurrency) as executor:
-        futures = [executor.submit(process_single, desc) for desc in descriptions]
-        
-        for future in as_completed(futures):
-            result = future.result()
+        descriptions = db.iter_descriptions_missing_index(req.index_name)
+        for result in _imap_bounded(executor, process_single, descriptions, req.concurrency * 2):
             if result["status"] == "success":
                 processed += 1
+                pending.append(result)
+                if len(pending) >= req.batch_size:
+                    _flush_index_batch(req.index_name, model_name, model_version, pending)
             else:
                 failed += 1
                 failed_list.append(result)
     
+    _flush_index_batch(req.index_name, model_name, model_version, pending)
+    
     # 获取索引当前数量
     new_count = text_indexes[req.index_name].count()
     
@@ -2069,7 +2414,7 @@ def batch_rebuild_index_stream(req: RebuildIndexRequest):
     Args:
         index_name: 要更新的索引名称
         concurrency: 并发数量
-        batch_size: 内部批次大小
+        batch_size: 内部批次大小（批量写入索引）
     """
     from fastapi.responses import StreamingResponse
     
@@ -2088,9 +2433,8 @@ def batch_rebuild_index_stream(req: RebuildIndexRequest):
     def generate():
         import json
         
-        # 先统计总数（获取所有缺失的数量）
-        all_missing = db.get_descriptions_missing_index(req.index_name, limit=100000)
-        total = len(all_missing)
+        # 先统计总数（描述在处理时分批读取，不一次性加载）
+        total = db.count_descriptions_missing_index(req.index_name)
         
         yield f"event: init\ndata: {json.dumps({'total': total, 'index_name': req.index_name, 'model': model_name})}\n\n"
         
@@ -2101,38 +2445,20 @@ def batch_rebuild_index_stream(req: RebuildIndexRequest):
         
         processed = 0
         failed = 0
+        pending = []
         
         def process_single(desc: dict) -> dict:
-            sha256 = desc["image_sha256"]
-            method = desc["method"]
-            content = desc["content"]
-            
-            try:
-                embedding = embedding_client.get_text_embedding_by_service(content, service_name)
-                if embedding is None:
-                    return {"sha256": sha256, "method": method, "status": "failed", "error": "嵌入服务返回空"}
-                
-                emb_filename = f"{method}_{model_name.replace('-', '_')}"
-                storage.save_embedding(sha256, emb_filename, embedding)
-                text_indexes[req.index_name].add(embedding, sha256, method)
-                
-                try:
-                    db.add_vector_entry(sha256, method, model_name, model_version, req.index_name)
-                except:
-                    pass
-                
-                return {"sha256": sha256, "method": method, "status": "success"}
-            except Exception as e:
-                return {"sha256": sha256, "method": method, "status": "failed", "error": str(e)}
+            return _compute_description_embedding(desc, service_name, model_name)
         
-        # 并发处理所有数据
+        # 并发处理所有数据：边读取边提交，在途任务数有上限
         with ThreadPoolExecutor(max_workers=req.concurrency) as executor:
-            futures = {executor.submit(process_single, desc): desc for desc in all_missing}
-            
-            for future in as_completed(futures):
-                result = future.result()
+            descriptions = db.iter_descriptions_missing_index(req.index_name)
+            for result in _imap_bounded(executor, process_single, descriptions, req.concurrency * 2):
                 if result["status"] == "success":
                     processed += 1
+                    pending.append(result)
+                    if len(pending) >= req.batch_size:
+                        _flush_index_batch(req.index_name, model_name, model_version, pending)
                 else:
                     failed += 1
                 
@@ -2141,10 +2467,12 @@ def batch_rebuild_index_stream(req: RebuildIndexRequest):
                     "processed": processed,
                     "failed": failed,
                     "total": total,
-                    "current": result
+                    "current": {k: v for k, v in result.items() if k != "embedding"}
                 }
                 yield f"event: progress\ndata: {json.dumps(progress_data)}\n\n"
         
+        _flush_index_batch(req.index_name, model_name, model_version, pending)
+        
         # 完成
         new_count = text_indexes[req.index_name].count()
         complete_data = {
@@ -2176,7 +2504,7 @@ def get_rebuild_index_status():
     
     for index_name, config in TEXT_INDEXES.items():
         index_count = text_indexes[index_name].count()
-        missing_count = len(db.get_descriptions_missing_index(index_name, limit=10000))
+        missing_count = db.count_descriptions_missing_index(index_name)
         
         status.append({
             "index_name": index_name,
@@ -2267,11 +2595,13 @@ def batch_generate_captions_stream(
             yield f"event: complete\ndata: {json.dumps(complete_data)}\n\n"
             return
         
-        # 使用线程池并发处理
+        # 使用线程池并发处理，新向量每完成 INDEX_BATCH_IMAGES 张图片写入索引一次
+        index_batch = IndexBatch()
+        
         def worker(img, index):
             sha256 = img["sha256"]
             item_start = time.time()
-            result = _process_single_image(img, method, prompt, vlm_service)
+            result = _process_single_image(img, method, prompt, vlm_service, index_batch)
             result["index"] = index
             result["time"] = round(time.time() - item_start, 2)
             results_queue.put(result)
@@ -2289,6 +2619,8 @@ def batch_generate_captions_stream(
                 try:
                     result = results_queue.get(timeout=0.5)
                     completed += 1
+                    if completed % INDEX_BATCH_IMAGES == 0:
+                        index_batch.flush()
                     
                     if result["status"] == "success":
                         processed += 1
@@ -2321,6 +2653,7 @@ def batch_generate_captions_stream(
                     yield f"event: progress\ndata: {json.dumps(progress_data)}\n\n"
                 except queue.Empty:
                     continue
+        index_batch.flush()
         
         complete_data = {
             "total": total,
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+VectorIndex 并发基准测试
+在后台持续批量导入（含追加日志写入和合并）的同时，多个线程并发搜索，统计搜索延迟分位数
+
+用法: python bench_vector_index.py [--rows 200000] [--dimension 1152] [--searchers 4] [--seconds 10]
+                                  [--processes 8 --shard-size 25000]  # 分片并行搜索
+                                  [--filters '{"source": "upload"}' --loader-ms 20]  # 带过滤条件搜索
+"""
+import argparse
+import json
+import tempfile
+import threading
+import time
+import numpy as np
+
+from vector_index import VectorIndexManager
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000) if latencies else float("nan")
+
+
+def make_attribute_loader(loader_ms):
+    """
+    模拟 Database.get_image_attributes：每次查询耗时 loader_ms 毫秒，
+    图片按 sha256 轮流分配到几个来源
+    """
+    sources = ("upload", "crawler", "import")
+    
+    def load(sha256s):
+        time.sleep(loader_ms / 1000)
+        return {
+            sha256: {"source": sources[int(sha256, 16) % len(sources)], "status": "done",
+                     "created_at": "2024-01-01 00:00:00", "is_deleted": 0}
+            for sha256 in (sha256s or [])
+        }
+    
+    return load
+
+
+def run_searches(index, queries, stop, latencies, top_k, filters=None):
+    """持续搜索直到 stop 被设置，记录每次搜索的耗时"""
+    i = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        index.search_deduplicated(queries[i % len(queries)], top_k, filters=filters)
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def run_imports(index, rng, stop, batch_size, imported):
+    """持续批量导入直到 stop 被设置（模拟 /api/batch/import/stream）"""
+    while not stop.is_set():
+        embeddings = rng.standard_normal((batch_size, index.dimension), dtype=np.float32)
+        sha256s = [f"{imported[0] + i:032x}" for i in range(batch_size)]
+        index.add_many(embeddings, sha256s, "image")
+        imported[0] += batch_size
+
+
+def bench(index, seconds, searchers, top_k, import_batch_size, filters=None):
+    """运行一轮测试，import_batch_size 为 0 时不导入；filters 为 None 时不带过滤条件"""
+    rng = np.random.default_rng(1)
+    queries = rng.standard_normal((64, index.dimension), dtype=np.float32)
+    stop = threading.Event()
+    latencies = [[] for _ in range(searchers)]
+    imported = [index.count()]
+    start_count = imported[0]
+    
+    threads = [
+        threading.Thread(target=run_searches, args=(index, queries, stop, latencies[i], top_k, filters))
+        for i in range(searchers)
+    ]
+    if import_batch_size:
+        threads.append(threading.Thread(target=run_imports, args=(index, rng, stop, import_batch_size, imported)))
+    
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    
+    merged = [x for part in latencies for x in part]
+    return {
+        "searches": len(merged),
+        "qps": len(merged) / seconds,
+        "p50_ms": percentile_ms(merged, 50),
+        "p99_ms": percentile_ms(merged, 99),
+        "max_ms": max(merged) * 1000 if merged else float("nan"),
+        "imported": imported[0] - start_count
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VectorIndex 并发搜索 + 导入基准测试")
+    parser.add_argument("--rows", type=int, default=200000, help="初始行数")
+    parser.add_argument("--dimension", type=int, default=1152, help="向量维度")
+    parser.add_argument("--searchers", type=int, default=4, help="并发搜索线程数")
+    parser.add_argument("--seconds", type=float, default=10, help="每轮测试时长（秒）")
+    parser.add_argument("--top-k", type=int, default=100)
+    parser.add_argument("--import-batch", type=int, default=64, help="每次导入的行数")
+    parser.add_argument("--wal-compact-rows", type=int, default=10000, help="追加日志合并阈值")
+    parser.add_argument("--processes", type=int, default=0, help="分片并行搜索的进程数（0 为不启用）")
+    parser.add_argument("--shard-size", type=int, default=100000, help="每个分片的行数")
+    parser.add_argument("--filters", type=json.loads, default=None,
+                        help='搜索过滤条件（JSON，如 \'{"source": "upload"}\'），不设置时不过滤')
+    parser.add_argument("--loader-ms", type=float, default=20, help="模拟数据库读取过滤属性的耗时（毫秒）")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as index_dir:
+        attribute_loader = make_attribute_loader(args.loader_ms) if args.filters is not None else None
+        manager = VectorIndexManager(index_dir, attribute_loader=attribute_loader, search_processes=args.processes)
+        index = manager.get_or_create_index("bench", args.dimension, "bench", "1.0", backend_options={
+            "wal_compact_rows": args.wal_compact_rows, "shard_size": args.shard_size
+        })
+        rng = np.random.default_rng(0)
+        for start in range(0, args.rows, 50000):
+            n = min(50000, args.rows - start)
+            index.add_many(rng.standard_normal((n, args.dimension), dtype=np.float32),
+                           [f"{i:032x}" for i in range(start, start + n)], "image")
+        print(f"索引: {index.count()} 行 x {args.dimension} 维，{args.searchers} 个搜索线程，"
+              f"{args.processes} 个搜索进程，每轮 {args.seconds}s，过滤条件 {args.filters}")
+        
+        for name, batch in (("仅搜索", 0), ("搜索 + 并发导入", args.import_batch)):
+            result = bench(index, args.seconds, args.searchers, args.top_k, batch, args.filters)
+            print(f"[{name}] 搜索 {result['searches']} 次 ({result['qps']:.1f} qps)  "
+                  f"p50 {result['p50_ms']:.1f}ms  p99 {result['p99_ms']:.1f}ms  max {result['max_ms']:.1f}ms  "
+                  f"导入 {result['imported']} 行")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,40 +2,294 @@
 SQLite 数据库管理模块
 管理图片索引信息
 """
+import base64
+import json
+import queue
 import sqlite3
+import time
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Tuple, Iterator
+from itertools import islice
 from contextlib import contextmanager
+from concurrent.futures import Future, wait
 import threading
 
 
+# 按 sha256 批量查询时每条 SQL 的参数个数（SQLite 默认上限为 999）
+IN_QUERY_CHUNK = 500
+
+# 连接参数：WAL 模式下 synchronous=NORMAL 仍能保证数据库一致（断电时可能丢失最近提交的事务）
+DEFAULT_SYNCHRONOUS = "NORMAL"
+DEFAULT_CACHE_SIZE_KB = 64 * 1024  # 每个连接的页缓存
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024  # 内存映射读取的字节数
+DEFAULT_BUSY_TIMEOUT_MS = 5000  # 其他进程持有写锁时的等待时间
+DEFAULT_READERS = 8  # 只读连接数上限
+
+# 按主键分批遍历大表时每批读取的行数
+SCAN_CHUNK = 500
+
+# 批量写入（write_behind）时每个事务最多合并的写操作数和等待时间
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_INTERVAL_MS = 50
+
+
+def encode_image_cursor(image: Dict[str, Any]) -> str:
+    """图片列表的翻页游标：最后一条记录的 (created_at, sha256)，编码为 URL 安全的字符串（NULL 编码为 null）"""
+    key = json.dumps([image["created_at"], image["sha256"]])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_image_cursor(cursor: str) -> Tuple[Optional[str], str]:
+    """
+    解析翻页游标（最后一条记录没有创建时间时 created_at 为 None）
+    
+    Raises:
+        ValueError: 游标格式错误
+    """
+    try:
+        created_at, sha256 = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError(f"翻页游标格式错误: {cursor}")
+    return (None if created_at is None else str(created_at)), str(sha256)
+
+
 class Database:
-    """SQLite 数据库管理器"""
+    """
+    SQLite 数据库管理器
     
-    def __init__(self, db_path: str):
+    WAL 模式下读写互不阻塞：所有写入经由唯一的写连接（同一时间只有一个线程持有），
+    读取从只读连接池中借用连接，导入事务进行中图片列表、搜索结果补充等读取照常进行。
+    
+    写操作默认在调用线程中立即提交；批量导入时在 write_behind() 中调用，写操作进入写入队列，
+    由后台写线程把多个线程的写入合并成一个事务提交
+    """
+    
+    def __init__(self, db_path: str, synchronous: str = DEFAULT_SYNCHRONOUS,
+                 cache_size_kb: int = DEFAULT_CACHE_SIZE_KB, mmap_size: int = DEFAULT_MMAP_SIZE,
+                 readers: int = DEFAULT_READERS, batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_interval_ms: float = DEFAULT_BATCH_INTERVAL_MS):
+        """
+        Args:
+            db_path: 数据库文件路径
+            synchronous: PRAGMA synchronous（OFF/NORMAL/FULL）
+            cache_size_kb: 每个连接的页缓存大小（KB）
+            mmap_size: 内存映射读取的字节数（0 表示不使用）
+            readers: 只读连接数上限，读取并发超过时等待空闲连接
+            batch_size: 批量写入时每个事务最多合并的写操作数
+            batch_interval_ms: 批量写入时第一个写操作最多等待多久提交（遇到 flush 屏障时立即提交）
+        """
         self.db_path = db_path
-        self._local = threading.local()
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.batch_size = batch_size
+        self.batch_interval_ms = batch_interval_ms
+        self._image_listeners: List[Callable[[str], None]] = []
+        
+        # 数据版本：每次提交写操作后递增。搜索结果中的图片信息和描述文本来自数据库，
+        # 搜索结果缓存的键中包含此版本，数据库有写入后旧条目不再命中
+        self.version = 0
+        self._version_lock = threading.Lock()
+        
+        # 写连接：用可重入锁保证同一时间只有一个线程在写
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer_lock = threading.RLock()
+        
+        # 只读连接池：按需创建，最多 readers 个
+        self._readers: "queue.LifoQueue[Optional[sqlite3.Connection]]" = queue.LifoQueue()
+        for _ in range(readers):
+            self._readers.put(None)  # 尚未创建的连接
+        
+        # 写入队列：(op, changed, future)，op 为 None 表示 flush 屏障；整个为 None 表示停止写线程
+        self._write_queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._local = threading.local()  # pending: 当前线程在 write_behind() 中加入队列的写操作
+        self._write_thread = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._write_thread.start()
+        
         self._init_db()
     
-    def _get_conn(self) -> sqlite3.Connection:
-        """获取线程本地的数据库连接"""
-        if not hasattr(self._local, 'conn') or self._local.conn is None:
-            self._local.conn = sqlite3.connect(self.db_path)
-            self._local.conn.row_factory = sqlite3.Row
-        return self._local.conn
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        """创建连接并设置 PRAGMA（连接在线程间传递，由写锁/连接池保证同一时间只有一个线程使用）"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=DEFAULT_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size={-int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
     
     @contextmanager
     def get_cursor(self):
-        """获取数据库游标的上下文管理器"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
+        """获取写连接游标的上下文管理器（持有写锁，正常退出时提交，异常时回滚）"""
+        with self._writer_lock:
+            cursor = self._writer.cursor()
+            try:
+                yield cursor
+                self._writer.commit()
+            except Exception as e:
+                self._writer.rollback()
+                raise e
+    
+    @contextmanager
+    def read_cursor(self):
+        """从只读连接池借用连接的游标（不阻塞写入，也不被写入阻塞）"""
+        conn = self._readers.get()
+        try:
+            if conn is None:
+                conn = self._connect(readonly=True)
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+    
+    # ==================== 写入 ====================
+    
+    def _write(self, op: Callable[[sqlite3.Cursor], Any], changed: Optional[str] = None) -> Any:
+        """
+        执行写操作 op(cursor)，返回 op 的返回值
+        
+        当前线程处于 write_behind() 中时只加入写入队列并返回 None。
+        changed 为图片 sha256 时，op 返回真值表示图片有变更，提交后通知图片变更回调
+        """
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            future = Future()
+            self._write_queue.put((op, changed, future))
+            pending.append(future)
+            return None
+        
+        with self.get_cursor() as cursor:
+            result = op(cursor)
+        self._bump_version()
+        if changed is not None and result:
+            self._notify_image_changed(changed)
+        return result
+    
+    def _bump_version(self):
+        """数据版本加一（写连接的调用线程和后台写线程都会递增，在 _version_lock 内进行）"""
+        with self._version_lock:
+            self.version += 1
+    
+    @contextmanager
+    def write_behind(self):
+        """
+        批量写入：上下文中当前线程的写操作只加入写入队列、不等待提交（返回 None），
+        由后台写线程与其他线程的写入合并成事务
+        
+        退出时等待这些写操作全部提交（flush 屏障），有写操作失败时抛出第一个错误
+        （每个写操作在独立的保存点中执行，失败的写操作不影响同一事务中的其他写操作）
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield  # 嵌套时由最外层等待
+            return
+        
+        pending = self._local.pending = []
         try:
-            yield cursor
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
+            yield
+        finally:
+            self._local.pending = None
+            if pending:
+                self.flush()
+        for future in pending:
+            if future.exception() is not None:
+                raise future.exception()
+    
+    def flush(self):
+        """写入屏障：立即提交写入队列中已有的写操作，并等待提交完成"""
+        future = Future()
+        self._write_queue.put((None, None, future))
+        wait([future])
+    
+    def _write_loop(self):
+        """后台写线程：每次取出最多 batch_size 个写操作，合并成一个事务提交"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            
+            batch = [item]
+            deadline = time.monotonic() + self.batch_interval_ms / 1000
+            while len(batch) < self.batch_size and batch[-1][0] is not None:
+                # 等待到截止时间；已过截止时间时只取出队列中已有的写操作
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._write_queue.get(timeout > 0, max(timeout, 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write_queue.put(None)  # 提交当前批次后再停止
+                    break
+                batch.append(item)
+            
+            self._commit_batch(batch)
+    
+    def _commit_batch(self, batch: List[tuple]):
+        """在一个事务中执行一批写操作（每个操作一个保存点），提交后通知变更并完成 future"""
+        outcomes = []  # (是否成功, 返回值或异常)
+        with self._writer_lock:
+            cursor = self._writer.cursor()
+            try:
+                cursor.execute("BEGIN")
+                for op, changed, future in batch:
+                    if op is None:
+                        outcomes.append((True, None))
+                        continue
+                    cursor.execute("SAVEPOINT write_op")
+                    try:
+                        outcomes.append((True, op(cursor)))
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write_op")
+                        outcomes.append((False, e))
+                    cursor.execute("RELEASE write_op")
+                self._writer.commit()
+            except Exception as e:
+                self._writer.rollback()
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+        self._bump_version()
+        
+        for (op, changed, future), (ok, value) in zip(batch, outcomes):
+            if not ok:
+                future.set_exception(value)
+                continue
+            if changed is not None and value:
+                try:
+                    self._notify_image_changed(changed)
+                except Exception as e:
+                    print(f"[Database] 图片变更回调失败: {e}")
+            future.set_result(value)
+    
+    def close(self):
+        """停止写线程（提交队列中剩余的写操作）并关闭所有连接（正在使用的只读连接在归还后不再关闭）"""
+        self._write_queue.put(None)
+        self._write_thread.join()
+        with self._writer_lock:
+            self._writer.close()
+        while True:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                conn.close()
+    
+    @staticmethod
+    def _select_in(cursor: sqlite3.Cursor, query: str, values: List[str]) -> List[sqlite3.Row]:
+        """
+        执行带 IN 条件的查询，values 按 IN_QUERY_CHUNK 分批
+        
+        Args:
+            query: SQL，其中的 {placeholders} 替换为 IN 的占位符
+        """
+        rows = []
+        for start in range(0, len(values), IN_QUERY_CHUNK):
+            chunk = values[start:start + IN_QUERY_CHUNK]
+            cursor.execute(query.format(placeholders=",".join("?" * len(chunk))), chunk)
+            rows.extend(cursor.fetchall())
+        return rows
     
     def _init_db(self):
         """初始化数据库表结构"""
@@ -91,84 +345,221 @@ class Database:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_desc_method ON descriptions(method)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_vector_index ON vector_entries(index_name, id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_vector_sha256 ON vector_entries(image_sha256)")
+            # 查找缺少某个索引的描述（descriptions LEFT JOIN vector_entries）时在索引内完成连接
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_vector_sha256_method_index
+                ON vector_entries(image_sha256, method, index_name)
+            """)
+            
+            # 图片列表：按 (created_at, sha256) 倒序翻页，每种过滤组合一个复合索引，
+            # 过滤和排序都在索引中完成，每页只读取 limit 行
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_list ON images(is_deleted, created_at, sha256)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_list_source ON images(is_deleted, source, created_at, sha256)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_list_status ON images(is_deleted, status, created_at, sha256)")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_images_list_source_status
+                ON images(is_deleted, source, status, created_at, sha256)
+            """)
+            
+            self._init_image_counts(cursor)
+    
+    def _init_image_counts(self, cursor: sqlite3.Cursor):
+        """
+        图片计数表：按 (来源, 状态) 统计未删除的图片数量，由触发器随 images 表的增删改维护，
+        count_images 不再全表 COUNT(*)（空来源/状态记为空字符串）
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS image_counts (
+                source TEXT NOT NULL,
+                status TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (source, status)
+            )
+        """)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_image_counts_insert'")
+        if cursor.fetchone() is not None:
+            return
+        
+        # 首次创建（或从旧版本升级）：在同一事务中按现有数据初始化计数并创建触发器
+        cursor.execute("BEGIN")
+        cursor.execute("DELETE FROM image_counts")
+        cursor.execute("""
+            INSERT INTO image_counts (source, status, count)
+            SELECT IFNULL(source, ''), IFNULL(status, ''), COUNT(*) FROM images
+            WHERE is_deleted = 0 GROUP BY 1, 2
+        """)
+        increment = """
+            INSERT OR IGNORE INTO image_counts (source, status) SELECT IFNULL(NEW.source, ''), IFNULL(NEW.status, '')
+                WHERE NEW.is_deleted = 0;
+            UPDATE image_counts SET count = count + 1
+                WHERE NEW.is_deleted = 0 AND source = IFNULL(NEW.source, '') AND status = IFNULL(NEW.status, '');
+        """
+        decrement = """
+            UPDATE image_counts SET count = count - 1
+                WHERE OLD.is_deleted = 0 AND source = IFNULL(OLD.source, '') AND status = IFNULL(OLD.status, '');
+        """
+        cursor.execute(f"CREATE TRIGGER trg_image_counts_insert AFTER INSERT ON images BEGIN {increment} END")
+        cursor.execute(f"CREATE TRIGGER trg_image_counts_delete AFTER DELETE ON images BEGIN {decrement} END")
+        cursor.execute(f"""
+            CREATE TRIGGER trg_image_counts_update AFTER UPDATE OF source, status, is_deleted ON images
+            BEGIN {decrement} {increment} END
+        """)
     
     # ==================== 图片操作 ====================
     
+    def add_image_listener(self, callback: Callable[[str], None]):
+        """注册图片变更回调（新增、状态变更、删除后以 sha256 调用），用于同步向量索引中的过滤属性"""
+        self._image_listeners.append(callback)
+    
+    def _notify_image_changed(self, sha256: str):
+        """通知图片变更（已提交后调用）"""
+        for callback in self._image_listeners:
+            callback(sha256)
+    
     def add_image(self, sha256: str, width: int, height: int, 
                   file_size: int, format: str, source: str = None) -> bool:
         """添加图片记录"""
-        try:
-            with self.get_cursor() as cursor:
+        def op(cursor):
+            try:
                 cursor.execute("""
                     INSERT INTO images (sha256, width, height, file_size, format, source, status)
                     VALUES (?, ?, ?, ?, ?, ?, 'pending')
                 """, (sha256, width, height, file_size, format, source))
+            except sqlite3.IntegrityError:
+                return False  # 已存在
             return True
-        except sqlite3.IntegrityError:
-            return False  # 已存在
+        return self._write(op, changed=sha256)
     
     def get_image(self, sha256: str) -> Optional[Dict[str, Any]]:
         """获取图片信息"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT * FROM images WHERE sha256 = ? AND is_deleted = 0
             """, (sha256,))
             row = cursor.fetchone()
             return dict(row) if row else None
     
+    def get_images_bulk(self, sha256s: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        批量获取图片信息（用于补充搜索结果，一次 IN 查询代替逐条 get_image）
+        
+        Returns:
+            {sha256: 图片信息}，不存在或已删除的图片不出现在结果中
+        """
+        with self.read_cursor() as cursor:
+            rows = self._select_in(cursor, """
+                SELECT * FROM images WHERE sha256 IN ({placeholders}) AND is_deleted = 0
+            """, list(dict.fromkeys(sha256s)))
+            return {row["sha256"]: dict(row) for row in rows}
+    
     def update_image_status(self, sha256: str, status: str) -> bool:
         """更新图片状态"""
-        with self.get_cursor() as cursor:
+        def op(cursor):
             cursor.execute("""
                 UPDATE images SET status = ? WHERE sha256 = ?
             """, (status, sha256))
             return cursor.rowcount > 0
+        return self._write(op, changed=sha256)
     
     def delete_image(self, sha256: str, hard: bool = False) -> bool:
         """删除图片（软删除或硬删除）"""
-        with self.get_cursor() as cursor:
+        def op(cursor):
             if hard:
                 cursor.execute("DELETE FROM images WHERE sha256 = ?", (sha256,))
+                deleted = cursor.rowcount > 0
                 cursor.execute("DELETE FROM descriptions WHERE image_sha256 = ?", (sha256,))
                 cursor.execute("DELETE FROM vector_entries WHERE image_sha256 = ?", (sha256,))
-            else:
-                cursor.execute("""
-                    UPDATE images SET is_deleted = 1, deleted_at = ? WHERE sha256 = ?
-                """, (datetime.now(), sha256))
+                return deleted
+            cursor.execute("""
+                UPDATE images SET is_deleted = 1, deleted_at = ? WHERE sha256 = ?
+            """, (datetime.now(), sha256))
             return cursor.rowcount > 0
+        return self._write(op, changed=sha256)
     
     def image_exists(self, sha256: str) -> bool:
         """检查图片是否存在"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT 1 FROM images WHERE sha256 = ? AND is_deleted = 0
             """, (sha256,))
             return cursor.fetchone() is not None
     
+    def get_image_attributes(self, sha256s: List[str] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        批量获取图片的过滤属性（用于向量索引的过滤搜索，包含已软删除的图片）
+        
+        Args:
+            sha256s: 要查询的图片，None 表示全部
+        
+        Returns:
+            {sha256: {source, status, created_at, is_deleted}}，不存在的图片不出现在结果中
+        """
+        columns = "sha256, source, status, created_at, is_deleted"
+        attributes = {}
+        with self.read_cursor() as cursor:
+            if sha256s is None:
+                cursor.execute(f"SELECT {columns} FROM images")
+                rows = cursor.fetchall()
+            else:
+                rows = self._select_in(cursor, f"""
+                    SELECT {columns} FROM images WHERE sha256 IN ({{placeholders}})
+                """, sha256s)
+            for row in rows:
+                attributes[row["sha256"]] = dict(row)
+        return attributes
+    
     def list_images(self, offset: int = 0, limit: int = 20, 
-                    source: str = None, status: str = None) -> List[Dict[str, Any]]:
-        """列出图片"""
-        with self.get_cursor() as cursor:
-            query = "SELECT * FROM images WHERE is_deleted = 0"
-            params = []
-            
-            if source:
-                query += " AND source = ?"
-                params.append(source)
-            if status:
-                query += " AND status = ?"
-                params.append(status)
-            
-            query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-            params.extend([limit, offset])
+                    source: str = None, status: str = None,
+                    cursor: str = None) -> List[Dict[str, Any]]:
+        """
+        列出图片（按创建时间倒序）
+        
+        Args:
+            cursor: 翻页游标（上一页最后一条记录的 encode_image_cursor），从该记录之后开始，
+                    每页耗时与翻页深度无关；offset 翻页需要跳过前面所有行，只适合浅层翻页
+        
+        Raises:
+            ValueError: 游标格式错误
+        """
+        query = "SELECT * FROM images WHERE is_deleted = 0"
+        params = []
+        
+        if source:
+            query += " AND source = ?"
+            params.append(source)
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        order = " ORDER BY created_at DESC, sha256 DESC LIMIT ? OFFSET ?"
+        
+        with self.read_cursor() as db_cursor:
+            if not cursor:
+                db_cursor.execute(query + order, params + [limit, offset])
+                return [dict(row) for row in db_cursor.fetchall()]
             
-            cursor.execute(query, params)
-            return [dict(row) for row in cursor.fetchall()]
+            # 游标翻页：没有创建时间（NULL）的行排在最后，但行值比较不包含 NULL，
+            # 先取游标之后有创建时间的行，不足时再按 sha256 倒序接着取 NULL 的行（两段都走索引）
+            created_at, sha256 = decode_image_cursor(cursor)
+            wanted = offset + limit
+            rows = []
+            if created_at is not None:
+                db_cursor.execute(query + " AND (created_at, sha256) < (?, ?)" + order,
+                                  params + [created_at, sha256, wanted, 0])
+                rows = db_cursor.fetchall()
+            if len(rows) < wanted:
+                null_query = query + " AND created_at IS NULL"
+                null_params = list(params)
+                if created_at is None:
+                    null_query += " AND sha256 < ?"
+                    null_params.append(sha256)
+                db_cursor.execute(null_query + " ORDER BY sha256 DESC LIMIT ?", null_params + [wanted - len(rows)])
+                rows += db_cursor.fetchall()
+            return [dict(row) for row in rows[offset:]]
     
     def count_images(self, source: str = None, status: str = None) -> int:
-        """统计图片数量"""
-        with self.get_cursor() as cursor:
-            query = "SELECT COUNT(*) FROM images WHERE is_deleted = 0"
+        """统计图片数量（读取触发器维护的计数表）"""
+        with self.read_cursor() as cursor:
+            query = "SELECT IFNULL(SUM(count), 0) FROM image_counts WHERE 1 = 1"
             params = []
             
             if source:
@@ -185,36 +576,54 @@ class Database:
     
     def add_description(self, image_sha256: str, method: str, content: str) -> bool:
         """添加描述"""
-        try:
-            with self.get_cursor() as cursor:
+        def op(cursor):
+            try:
                 cursor.execute("""
                     INSERT OR REPLACE INTO descriptions (image_sha256, method, content, has_embedding)
                     VALUES (?, ?, ?, 0)
                 """, (image_sha256, method, content))
+            except Exception:
+                return False
             return True
-        except Exception:
-            return False
+        return self._write(op)
     
     def get_descriptions(self, image_sha256: str) -> List[Dict[str, Any]]:
         """获取图片的所有描述"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT * FROM descriptions WHERE image_sha256 = ?
             """, (image_sha256,))
             return [dict(row) for row in cursor.fetchall()]
     
+    def get_descriptions_bulk(self, sha256s: List[str]) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        批量获取多张图片的描述内容（用于补充搜索结果的匹配文本）
+        
+        Returns:
+            {sha256: {method: content}}，没有描述的图片不出现在结果中
+        """
+        descriptions = {}
+        with self.read_cursor() as cursor:
+            rows = self._select_in(cursor, """
+                SELECT image_sha256, method, content FROM descriptions WHERE image_sha256 IN ({placeholders})
+            """, list(dict.fromkeys(sha256s)))
+            for row in rows:
+                descriptions.setdefault(row["image_sha256"], {})[row["method"]] = row["content"]
+        return descriptions
+    
     def update_description_embedding(self, image_sha256: str, method: str, has_embedding: bool) -> bool:
         """更新描述的嵌入状态"""
-        with self.get_cursor() as cursor:
+        def op(cursor):
             cursor.execute("""
                 UPDATE descriptions SET has_embedding = ? 
                 WHERE image_sha256 = ? AND method = ?
             """, (1 if has_embedding else 0, image_sha256, method))
             return cursor.rowcount > 0
+        return self._write(op)
     
     def get_descriptions_without_embedding(self, limit: int = 100) -> List[Dict[str, Any]]:
         """获取未计算嵌入的描述"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT d.*, i.status as image_status
                 FROM descriptions d
@@ -229,16 +638,17 @@ class Database:
     def add_vector_entry(self, image_sha256: str, method: str, 
                          model: str, model_version: str, index_name: str) -> int:
         """添加向量索引条目，返回 ID"""
-        with self.get_cursor() as cursor:
+        def op(cursor):
             cursor.execute("""
                 INSERT INTO vector_entries (image_sha256, method, model, model_version, index_name)
                 VALUES (?, ?, ?, ?, ?)
             """, (image_sha256, method, model, model_version, index_name))
             return cursor.lastrowid
+        return self._write(op)
     
     def get_vector_entry(self, entry_id: int) -> Optional[Dict[str, Any]]:
         """根据 ID 获取向量条目"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT * FROM vector_entries WHERE id = ?
             """, (entry_id,))
@@ -247,7 +657,7 @@ class Database:
     
     def get_vector_entries_by_sha256(self, image_sha256: str) -> List[Dict[str, Any]]:
         """获取图片的所有向量条目"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT * FROM vector_entries WHERE image_sha256 = ?
             """, (image_sha256,))
@@ -255,44 +665,70 @@ class Database:
     
     def delete_vector_entries(self, image_sha256: str) -> int:
         """删除图片的所有向量条目"""
-        with self.get_cursor() as cursor:
+        def op(cursor):
             cursor.execute("""
                 DELETE FROM vector_entries WHERE image_sha256 = ?
             """, (image_sha256,))
             return cursor.rowcount
+        return self._write(op)
     
     def get_vector_entry_count(self, index_name: str) -> int:
         """获取索引中的条目数量"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT COUNT(*) FROM vector_entries WHERE index_name = ?
             """, (index_name,))
             return cursor.fetchone()[0]
     
-    def get_all_descriptions_with_content(self, limit: int = None, offset: int = 0) -> List[Dict[str, Any]]:
+    def _iter_descriptions(self, query: str, params: tuple = (), chunk_size: int = SCAN_CHUNK) -> Iterator[Dict[str, Any]]:
+        """
+        按主键 (image_sha256, method) 分批遍历描述（keyset 翻页，每批一次查询）
+        
+        Args:
+            query: 以 WHERE 条件结尾、可追加 AND 条件的查询，d 为 descriptions 的别名；
+                   遍历过程中已读过的行被修改（如补上了向量条目）不影响后续批次
+        
+        Yields:
+            每条描述的字典；每批之间归还只读连接，调用方处理得慢也不占用连接
+        """
+        after = None
+        while True:
+            sql = query
+            args = params
+            if after is not None:
+                sql += " AND (d.image_sha256, d.method) > (?, ?)"
+                args = params + after
+            sql += " ORDER BY d.image_sha256, d.method LIMIT ?"
+            with self.read_cursor() as cursor:
+                cursor.execute(sql, args + (chunk_size,))
+                rows = [dict(row) for row in cursor.fetchall()]
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            after = (rows[-1]["image_sha256"], rows[-1]["method"])
+    
+    def get_all_descriptions_with_content(self, limit: int = None, offset: int = 0) -> Iterator[Dict[str, Any]]:
         """
         获取所有描述及其内容（用于批量重建索引）
         
+        按主键分批读取、逐条返回，内存占用与描述总数无关
+        
         Returns:
-            包含 image_sha256, method, content 的列表
+            包含 image_sha256, method, content 的迭代器（按 image_sha256, method 排序）
         """
-        with self.get_cursor() as cursor:
-            query = """
-                SELECT d.image_sha256, d.method, d.content
-                FROM descriptions d
-                JOIN images i ON d.image_sha256 = i.sha256
-                WHERE i.is_deleted = 0 AND d.content IS NOT NULL AND d.content != ''
-                ORDER BY d.image_sha256
-            """
-            if limit:
-                query += f" LIMIT {limit} OFFSET {offset}"
-            
-            cursor.execute(query)
-            return [dict(row) for row in cursor.fetchall()]
+        descriptions = self._iter_descriptions("""
+            SELECT d.image_sha256, d.method, d.content
+            FROM descriptions d
+            CROSS JOIN images i ON d.image_sha256 = i.sha256  -- 以 descriptions 为外层循环，按主键顺序分批读取
+            WHERE i.is_deleted = 0 AND d.content IS NOT NULL AND d.content != ''
+        """)
+        if limit:
+            return islice(descriptions, offset, offset + limit)
+        return descriptions
     
     def count_all_descriptions(self) -> int:
         """统计所有有效描述的数量"""
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT COUNT(*) 
                 FROM descriptions d
@@ -312,7 +748,7 @@ class Database:
         Returns:
             缺少该索引的描述列表
         """
-        with self.get_cursor() as cursor:
+        with self.read_cursor() as cursor:
             cursor.execute("""
                 SELECT d.image_sha256, d.method, d.content
                 FROM descriptions d
@@ -325,4 +761,32 @@ class Database:
                 LIMIT ?
             """, (index_name, limit))
             return [dict(row) for row in cursor.fetchall()]
+    
+    def iter_descriptions_missing_index(self, index_name: str, chunk_size: int = SCAN_CHUNK) -> Iterator[Dict[str, Any]]:
+        """逐条遍历缺少指定索引的描述（image_sha256, method, content），内存占用与描述总数无关"""
+        return self._iter_descriptions("""
+            SELECT d.image_sha256, d.method, d.content
+            FROM descriptions d
+            CROSS JOIN images i ON d.image_sha256 = i.sha256  -- 以 descriptions 为外层循环，按主键顺序分批读取
+            LEFT JOIN vector_entries v ON d.image_sha256 = v.image_sha256 
+                AND d.method = v.method AND v.index_name = ?
+            WHERE i.is_deleted = 0 
+                AND d.content IS NOT NULL AND d.content != ''
+                AND v.id IS NULL
+        """, (index_name,), chunk_size)
+    
+    def count_descriptions_missing_index(self, index_name: str) -> int:
+        """统计缺少指定索引的描述数量"""
+        with self.read_cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*)
+                FROM descriptions d
+                JOIN images i ON d.image_sha256 = i.sha256
+                LEFT JOIN vector_entries v ON d.image_sha256 = v.image_sha256 
+                    AND d.method = v.method AND v.index_name = ?
+                WHERE i.is_deleted = 0 
+                    AND d.content IS NOT NULL AND d.content != ''
+                    AND v.id IS NULL
+            """, (index_name,))
+            return cursor.fetchone()[0]
 
@@ -12,6 +12,16 @@ from pathlib import Path
 import base64
 import yaml
 
+from ttl_cache import TTLCache
+
+
+# 查询嵌入缓存的默认容量和有效期（秒）
+EMBEDDING_CACHE_MAX_ENTRIES = 2048
+EMBEDDING_CACHE_TTL = 3600
+
+# 批量文本嵌入每次请求的最大文本数（与嵌入服务 /embed/texts 的上限一致），超过时分批请求
+EMBED_TEXTS_BATCH_SIZE = 32
+
 
 class EmbeddingClient:
     """嵌入服务客户端"""
@@ -34,6 +44,13 @@ class EmbeddingClient:
         defaults = self.ai_config.get("defaults", {})
         self.image_service = self._map_service_name(defaults.get("image_embedding", "siglip2"))
         self.text_service = self._map_service_name(defaults.get("text_embedding", "embed_8b"))
+        
+        # 查询文本嵌入缓存（热门查询、翻页请求无需重复请求嵌入服务）
+        cache_config = self.config["search"].get("embedding_cache", {})
+        self.embedding_cache = TTLCache(
+            max_entries=cache_config.get("max_entries", EMBEDDING_CACHE_MAX_ENTRIES),
+            ttl=cache_config.get("ttl_seconds", EMBEDDING_CACHE_TTL)
+        )
     
     def _load_ai_config(self) -> dict:
         """加载 aiserver/config.yaml（统一服务配置）"""
@@ -104,7 +121,8 @@ class EmbeddingClient:
             "defaults": self.ai_config.get("defaults", {}),
             "indexes": self.local_config.get("indexes", {}),
             "vlm_services": self.local_config.get("vlm_services", {}),
-            "vlm": self.local_config.get("vlm", {})
+            "vlm": self.local_config.get("vlm", {}),
+            "search": self.local_config.get("search", {})
         }
     
     def _map_service_name(self, name: str) -> str:
@@ -310,7 +328,8 @@ class EmbeddingClient:
         return services
     
     def get_text_embedding_by_service(self, text: str, service_name: str, 
-                                       instruction: str = None, is_query: bool = True) -> Optional[np.ndarray]:
+                                       instruction: str = None, is_query: bool = True,
+                                       timeout: float = None, use_cache: bool = True) -> Optional[np.ndarray]:
         """
         使用指定服务获取文本嵌入
         
@@ -319,6 +338,9 @@ class EmbeddingClient:
             service_name: 服务名称
             instruction: 任务指令（仅对支持 instruction 的模型如 Qwen3-Embedding-8B 有效）
             is_query: True 表示是查询，False 表示是文档
+            timeout: 请求超时（秒），默认使用服务配置的 timeout
+            use_cache: 是否使用查询嵌入缓存（按服务、指令、is_query 和规范化后的文本缓存；
+                       批量计算描述嵌入等一次性请求应传 False，避免挤掉热门查询）
         
         Returns:
             嵌入向量
@@ -328,7 +350,16 @@ class EmbeddingClient:
         if not endpoint:
             print(f"服务 {service_name} 缺少 endpoint 配置")
             return None
-        timeout = service.get("timeout", 30)
+        if timeout is None:
+            timeout = self.get_service_timeout(service_name)
+        
+        cache_key = None
+        if use_cache:
+            # 规范化空白字符，首尾空格或多余空格不同的查询共用缓存
+            cache_key = (service_name, instruction or "", is_query, " ".join(text.split()))
+            cached = self.embedding_cache.get(cache_key)
+            if cached is not None:
+                return cached.copy()  # 调用方可以原地修改
         
         try:
             # 构建请求体
@@ -343,10 +374,55 @@ class EmbeddingClient:
             )
             response.raise_for_status()
             data = response.json()
-            return np.array(data["embedding"], dtype=np.float32)
+            embedding = np.array(data["embedding"], dtype=np.float32)
         except Exception as e:
             print(f"使用 {service_name} 获取文本嵌入失败: {e}")
             return None
+        
+        if cache_key is not None:
+            self.embedding_cache.put(cache_key, embedding.copy())
+        return embedding
+    
+    def get_text_embeddings_batch_by_service(self, texts: List[str], service_name: str,
+                                             instruction: str = None, is_query: bool = True) -> Optional[np.ndarray]:
+        """
+        使用指定服务批量获取文本嵌入（每次请求最多 EMBED_TEXTS_BATCH_SIZE 条，按顺序拼接结果）
+        
+        Args:
+            texts: 文本列表
+            service_name: 服务名称
+            instruction: 任务指令（仅对支持 instruction 的模型如 Qwen3-Embedding-8B 有效）
+            is_query: True 表示是查询，False 表示是文档
+        
+        Returns:
+            嵌入向量矩阵 (N, dimension)
+        """
+        service = self._get_service_config(service_name)
+        endpoint = service.get("endpoint")
+        if not endpoint:
+            print(f"服务 {service_name} 缺少 endpoint 配置")
+            return None
+        timeout = service.get("timeout", 30)
+        
+        try:
+            embeddings = []
+            for start in range(0, len(texts), EMBED_TEXTS_BATCH_SIZE):
+                payload = {"texts": texts[start:start + EMBED_TEXTS_BATCH_SIZE], "is_query": is_query}
+                if instruction:
+                    payload["instruction"] = instruction
+                
+                response = requests.post(
+                    f"{endpoint}/embed/texts",
+                    json=payload,
+                    timeout=timeout
+                )
+                response.raise_for_status()
+                data = response.json()
+                embeddings.append(np.array(data["embeddings"], dtype=np.float32))
+            return np.concatenate(embeddings)
+        except Exception as e:
+            print(f"使用 {service_name} 批量获取文本嵌入失败: {e}")
+            return None
     
     def get_all_text_embeddings(self, text: str, is_query: bool = False) -> dict:
         """
@@ -364,7 +440,7 @@ class EmbeddingClient:
             service_name = service["service_name"]
             # 对于文档嵌入，不需要 instruction
             embedding = self.get_text_embedding_by_service(
-                text, service_name, instruction=None, is_query=is_query
+                text, service_name, instruction=None, is_query=is_query, use_cache=is_query
             )
             if embedding is not None:
                 results[service_name] = {
@@ -375,6 +451,10 @@ class EmbeddingClient:
                 }
         return results
     
+    def get_service_timeout(self, service_name: str) -> float:
+        """服务配置的请求超时（秒）"""
+        return self._get_service_config(service_name).get("timeout", 30)
+    
     def get_index_config(self, index_name: str) -> Optional[dict]:
         """获取索引配置"""
         return self.config.get("indexes", {}).get(index_name)
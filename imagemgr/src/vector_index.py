@@ -2,18 +2,184 @@
 向量索引管理模块
 管理嵌入向量的存储和检索
 """
+import os
+import re
 import json
+import time
 import numpy as np
+from datetime import date
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, Callable, Set
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+
+# 内存缓冲区的初始容量（行数），之后按 2 倍增长
+INITIAL_CAPACITY = 1024
+
+# 旧数据一次性归一化时每批处理的行数（控制临时内存）
+NORMALIZE_CHUNK_ROWS = 65536
+
+# 追加日志（WAL）文件：新增向量先追加到这里，定期合并进分片文件
+WAL_EMBEDDINGS_FILE = "wal_embeddings.f32"  # 定长 float32 行
+WAL_IDS_FILE = "wal_ids.jsonl"  # 首行为 {"generation": n}，之后每行一条 {sha256, method} 或删除记录 {delete: sha256}
+
+# 检查点文件：每次合并/清理都以新的版本号（wal_generation）命名写出，不覆盖当前版本的文件，
+# 最后原子替换 meta.json（记录版本号和分片文件列表）即为提交，之后再删除旧版本的文件。
+# 文件名为 {名称}_{版本号}.npy，旧格式索引的文件名不带版本号
+
+# 已合并分片中被删除（墓碑标记）的行 ID
+TOMBSTONES_FILE = "tombstones"
+
+# 列式 ID 元数据：ID 即行号，sha256 定长字节串，method 存编码并另存编码表
+IDS_SHA256_FILE = "ids_sha256"  # S32
+IDS_METHOD_FILE = "ids_method"  # int16，method 在编码表中的下标
+IDS_METHODS_TABLE_FILE = "ids_methods.json"  # method 编码表（只增不减，所有版本共用）
+LEGACY_IDS_FILE = "ids.json"  # 旧格式：[{id, sha256, method}, ...]
+SHA256_WIDTH = 32
+
+# 分片文件：{分片名}.npy，粗筛副本为 {分片名}.{粗筛标记}.npy；分片名为 embeddings_{序号}_{版本号}
+SHARD_PREFIX = "embeddings_"
+
+# 粗筛副本：分片另存一份低维前缀（MRL 截断后重新归一化）和/或 fp16、int8（每维 scale/offset）量化的副本，
+# 搜索时先在粗筛副本上扫描，候选再用 float32 分片精确重排
+QUANTIZATIONS = ("fp16", "int8")
+
+# 粗筛副本解码为 float32 计算时每批处理的行数（控制临时内存）
+COARSE_CHUNK_ROWS = 4096
+
+# 批量搜索时相似度矩阵 (行数, 查询数) 的内存上限，超过时分批计算
+BATCH_SIMILARITIES_BYTES = 256 * 1024 * 1024
+
+# 按图片分组保存的过滤属性（从数据库同步）中图片的状态
+IMAGE_UNSYNCED = 0  # 尚未同步（或没有数据来源）
+IMAGE_LIVE = 1  # 数据库中存在且未删除
+IMAGE_REMOVED = 2  # 数据库中已软删除或不存在
+
+# 搜索过滤条件支持的字段
+FILTER_FIELDS = ("source", "status", "method", "created_from", "created_to", "include_deleted")
+
+# 创建日期按天分桶：距 1970-01-01 的天数
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    选出分数最高的 top_k 个下标（按分数降序）
+    
+    先用 argpartition 做 O(N) 的部分选择，再只对这 k 个候选排序
+    """
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(scores, len(scores) - top_k)[-top_k:]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+
+def day_bucket(value) -> int:
+    """日期（date 或以 YYYY-MM-DD 开头的字符串，如数据库中的 created_at）→ 距 1970-01-01 的天数"""
+    if not isinstance(value, date):
+        value = date.fromisoformat(str(value)[:10])
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    校验并规范化搜索过滤条件
+    
+    filters 为 None 表示不过滤；否则为字典（空字典只排除数据库中已删除/不存在的图片）：
+        source / status / method: 取值或取值列表（任一匹配）
+        created_from / created_to: 创建日期范围（YYYY-MM-DD，含两端）
+        include_deleted: 是否包含数据库中已删除/不存在的图片（默认 False）
+    
+    Returns:
+        规范化后的过滤条件（取值统一为列表，日期转为天数），None 表示不过滤
+    
+    Raises:
+        ValueError: 字段未知或日期格式错误
+    """
+    if filters is None:
+        return None
+    unknown = set(filters) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"未知的过滤字段: {', '.join(sorted(unknown))}，可选: {', '.join(FILTER_FIELDS)}")
+    
+    normalized = {"include_deleted": bool(filters.get("include_deleted", False))}
+    for field in ("source", "status", "method"):
+        value = filters.get(field)
+        if value is not None:
+            normalized[field] = [value] if isinstance(value, str) else list(value)
+    for field in ("created_from", "created_to"):
+        value = filters.get(field)
+        if value is not None:
+            try:
+                normalized[field] = day_bucket(value)
+            except ValueError:
+                raise ValueError(f"{field} 日期格式错误（应为 YYYY-MM-DD）: {value}")
+    return normalized
+
+
+class RWLock:
+    """
+    读写锁：多个读者可以同时持有，写者独占
+    
+    有写者等待时新的读者排队，避免持续不断的搜索让写入饿死
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+    
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
 
 
 class VectorIndex:
-    """向量索引管理器"""
+    """向量索引管理器（精确检索：对所有行做暴力扫描）"""
+    
+    backend = "flat"
+    sharded_search = True  # 是否支持交给进程池按分片并行扫描（子类自定义了扫描方式时关闭）
+    checkpoint_files = (IDS_SHA256_FILE, IDS_METHOD_FILE, TOMBSTONES_FILE)  # 按版本号命名的检查点文件
     
     def __init__(self, index_dir: str, index_name: str, dimension: int, 
-                 model_name: str, model_version: str, shard_size: int = 100000):
+                 model_name: str, model_version: str, shard_size: int = 100000,
+                 wal_compact_rows: int = 10000, use_mmap: bool = True,
+                 purge_deleted_ratio: float = 0.2, quantization: Optional[str] = None,
+                 prefix_dimension: Optional[int] = None, rescore_factor: int = 10):
         """
         初始化向量索引
         
@@ -24,17 +190,91 @@ class VectorIndex:
             model_name: 模型名称
             model_version: 模型版本
             shard_size: 每个分片的最大条目数
+            wal_compact_rows: 追加日志累计多少条后合并进分片文件
+            use_mmap: 以内存映射方式只读打开分片文件（启动快，多进程共享页缓存）
+            purge_deleted_ratio: 已删除行占比超过该值时，在后台重写索引清除已删除的行
+            quantization: 量化模式（None/fp16/int8）；启用后分片先在量化副本上粗筛，
+                          再对 top_k * rescore_factor 个候选用 float32 行精确重排
+            prefix_dimension: 粗筛只使用前若干维（Matryoshka 表示学习训练的模型，如 Qwen3-Embedding），
+                              可与 quantization 同时使用
+            rescore_factor: 粗筛后参与精确重排的候选数倍数
         """
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f"未知的量化模式: {quantization}，可选: {', '.join(QUANTIZATIONS)}")
+        if prefix_dimension is not None and not 0 < prefix_dimension < dimension:
+            raise ValueError(f"前缀维度必须在 1 到 {dimension - 1} 之间: {prefix_dimension}")
         self.index_path = Path(index_dir) / index_name
         self.index_name = index_name
         self.dimension = dimension
         self.model_name = model_name
         self.model_version = model_version
         self.shard_size = shard_size
+        self.wal_compact_rows = wal_compact_rows
+        self.use_mmap = use_mmap
+        self.purge_deleted_ratio = purge_deleted_ratio
+        self.quantization = quantization
+        self.prefix_dimension = prefix_dimension
+        self.rescore_factor = rescore_factor
+        
+        # 并发控制：搜索持有读锁，可以并行；写入（新增/删除/合并/清理）之间用 _write_lock 串行，
+        # 磁盘读写只持有 _write_lock，只在更新内存状态的一瞬间持有写锁，搜索不会被磁盘 IO 阻塞
+        self._lock = RWLock()
+        self._write_lock = threading.Lock()
+        # 已合并的行保存在分片文件中（内存映射），之后新增的行保存在内存缓冲区中
+        self._shards: List[np.ndarray] = []
+        self._shard_names: List[str] = []  # 各分片的文件名（不含扩展名）
+        self._coarse_shards: List[Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]] = []  # 粗筛副本 (codes, offset, scale)
+        self._shard_files: List[Tuple[str, int]] = []  # 分片并行搜索时子进程扫描的文件 (路径, inode)
+        self.search_pool: Optional[ProcessPoolExecutor] = None  # 分片并行搜索的进程池（由 VectorIndexManager 设置）
+        self._buffer = np.empty((0, dimension), dtype=np.float32)  # 预分配的尾部缓冲区，按 2 倍扩容
+        self._size = 0  # 总行数（分片 + 缓冲区）
+        
+        # ID 映射信息（列式存储，ID 即行号）
+        self._sha256s = np.empty(0, dtype=f"S{SHA256_WIDTH}")
+        self._method_codes = np.empty(0, dtype=np.int16)
+        self._methods: List[str] = []  # method 编码表
+        self._method_ids: Dict[str, int] = {}
+        
+        # 按图片分组（用于按 sha256 去重）：每行所属的组号，每组的第一行（组号 → sha256）和未删除的行数。
+        # sha256 → 行的查找不为每张图片建 Python 对象：前 _sorted_rows 行按 sha256 稳定排序的行 ID
+        # 保存在 _sha256_order 中，用 searchsorted 二分查找；之后新增的行在尾部顺序比较，
+        # 其中新出现的组记在 _new_groups 中（sha256 → 组号），合并时一并排序
+        self._groups = np.empty(0, dtype=np.int32)
+        self._num_groups = 0
+        self._group_first_row = np.empty(0, dtype=np.int64)
+        self._group_live = np.zeros(0, dtype=np.int32)
+        self._live_groups = 0  # 仍有未删除行的组数
+        self._sha256_order = np.empty(0, dtype=np.int64)
+        self._sorted_rows = 0
+        self._new_groups: Dict[bytes, int] = {}
+        self._group_epoch = 0  # 组号重新计算（加载、清理）的次数
         
-        self._lock = threading.Lock()
-        self._embeddings: List[np.ndarray] = []  # 内存中的嵌入向量
-        self._ids: List[Dict[str, Any]] = []  # ID 映射信息
+        # 墓碑删除：被删除的行只做标记，搜索时屏蔽，由后台清理
+        self._deleted = np.zeros(0, dtype=bool)
+        self._deleted_count = 0
+        self._purge_thread: Optional[threading.Thread] = None
+        
+        # 按图片分组的过滤属性（与组号对齐，只保存在内存中，以数据库为准）：
+        # 图片状态、来源和处理状态的编码（-1 表示空）、创建日期（天数，-1 表示未知）
+        self.attribute_loader: Optional[Callable[[Optional[List[str]]], Dict[str, Dict[str, Any]]]] = None
+        self._group_state = np.zeros(0, dtype=np.int8)
+        self._group_source = np.zeros(0, dtype=np.int16)
+        self._group_status = np.zeros(0, dtype=np.int16)
+        self._group_day = np.zeros(0, dtype=np.int32)
+        self._attribute_codes: Dict[str, Dict[str, int]] = {"source": {}, "status": {}}  # 编码表
+        self._attribute_pending: Optional[Set[str]] = None  # 待同步的 sha256，None 表示全部
+        self._attribute_pending_lock = threading.Lock()
+        self._attribute_sync_lock = threading.Lock()
+        
+        self._compacted_count = 0  # 已写入分片文件的条目数（缓冲区第 0 行对应的 ID）
+        self._wal_count = 0  # 追加日志中尚未合并的条目数
+        self._wal_generation = 0  # 每次合并后递增，用于识别过期的追加日志和检查点文件
+        self._legacy_layout = False  # 旧格式索引：检查点文件名不带版本号，加载后合并一次转换为新格式
+        
+        # 数据版本：新增、删除或过滤属性失效时递增，搜索结果缓存以此判断缓存是否过期；
+        # 这几处持有的锁各不相同，统一通过 _bump_version 在 _version_lock 内递增
+        self.version = 0
+        self._version_lock = threading.Lock()
         
         self._init_index()
     
@@ -44,17 +284,56 @@ class VectorIndex:
         
         # 加载或创建元信息
         meta_path = self.index_path / "meta.json"
+        needs_normalize = False
+        shard_names = []
         if meta_path.exists():
             with open(meta_path, "r") as f:
                 meta = json.load(f)
                 # 验证一致性
                 if meta.get("dimension") != self.dimension:
                     raise ValueError(f"维度不匹配: 期望 {self.dimension}, 实际 {meta.get('dimension')}")
+                self._wal_generation = meta.get("wal_generation", 0)
+                # 旧版本索引没有归一化标记，可能包含未归一化的向量
+                needs_normalize = not meta.get("normalized", False)
+                # 旧格式索引没有分片文件列表，分片按序号命名
+                self._legacy_layout = "shards" not in meta
+                shard_names = meta.get("shards", [])
         else:
             self._save_meta()
         
-        # 加载现有数据
-        self._load_data()
+        # 加载期间持有 _write_lock，后台线程（清理、训练）等加载和迁移完成后再开始
+        with self._write_lock:
+            # 加载现有数据
+            self._load_data(shard_names)
+            
+            if needs_normalize:
+                self._migrate_normalize()
+            elif self._legacy_layout:
+                self._compact()
+            else:
+                self._remove_stale_files()
+    
+    def _migrate_normalize(self):
+        """一次性迁移：归一化旧数据中的所有向量并重写分片，之后搜索无需再归一化"""
+        def normalize(chunk: np.ndarray):
+            norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+            chunk /= np.where(norms > 0, norms, 1)  # 避免除零
+        
+        # 分片是只读映射，逐个读入内存归一化后重写
+        for i, shard in enumerate(self._shards):
+            data = np.array(shard, dtype=np.float32)
+            for start in range(0, len(data), NORMALIZE_CHUNK_ROWS):
+                normalize(data[start:start + NORMALIZE_CHUNK_ROWS])
+            name = self._new_shard_name(i)
+            self._save_shard(name, data)
+            self._set_shard(i, name)
+        
+        tail = self._tail
+        for start in range(0, len(tail), NORMALIZE_CHUNK_ROWS):
+            normalize(tail[start:start + NORMALIZE_CHUNK_ROWS])
+        
+        # 合并一次，元信息中写入归一化标记
+        self._compact()
     
     def _save_meta(self):
         """保存元信息"""
@@ -64,56 +343,835 @@ class VectorIndex:
             "model_name": self.model_name,
             "model_version": self.model_version,
             "shard_size": self.shard_size,
-            "total_count": len(self._ids)
+            "total_count": self.count(),
+            "wal_generation": self._wal_generation,
+            "shards": self._shard_names,
+            "normalized": True,  # 存储的向量均已归一化
+            "backend": self.backend,
+            "backend_options": self._backend_options()
         }
         meta_path = self.index_path / "meta.json"
-        with open(meta_path, "w") as f:
+        tmp_path = meta_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
             json.dump(meta, f, indent=2)
+        os.replace(tmp_path, meta_path)
     
-    def _load_data(self):
-        """加载索引数据"""
+    def _backend_options(self) -> Dict[str, Any]:
+        """检索后端参数（写入元信息，重新加载时使用）"""
+        return {
+            "quantization": self.quantization,
+            "prefix_dimension": self.prefix_dimension,
+            "rescore_factor": self.rescore_factor
+        }
+    
+    def _load_data(self, shard_names: List[str]):
+        """加载索引数据（meta.json 中记录的分片文件 + 追加日志）"""
         # 加载 IDs
-        ids_path = self.index_path / "ids.json"
-        if ids_path.exists():
-            with open(ids_path, "r") as f:
-                self._ids = json.load(f)
-        
-        # 加载嵌入向量分片
-        shard_idx = 0
-        embeddings_list = []
-        while True:
-            shard_path = self.index_path / f"embeddings_{shard_idx}.npy"
-            if not shard_path.exists():
-                break
-            embeddings_list.append(np.load(shard_path))
-            shard_idx += 1
+        sha256s, method_codes = self._load_ids()
         
-        if embeddings_list:
-            self._embeddings = [np.vstack(embeddings_list)]
-        else:
-            self._embeddings = []
-    
-    def _save_data(self):
-        """保存索引数据"""
-        # 保存 IDs
-        ids_path = self.index_path / "ids.json"
-        with open(ids_path, "w") as f:
-            json.dump(self._ids, f)
-        
-        # 保存嵌入向量（分片）
-        if self._embeddings:
-            all_embeddings = self._embeddings[0] if len(self._embeddings) == 1 else np.vstack(self._embeddings)
+        if self._legacy_layout:
+            shard_names = []
+            while (self.index_path / f"{SHARD_PREFIX}{len(shard_names)}.npy").exists():
+                shard_names.append(f"{SHARD_PREFIX}{len(shard_names)}")
+        
+        # 打开嵌入向量分片（内存映射，不读入私有内存）
+        for shard_idx, name in enumerate(shard_names):
+            self._set_shard(shard_idx, name)
+            self._size += len(self._shards[-1])
+        
+        if self._size != len(sha256s) or len(method_codes) != len(sha256s):
+            raise ValueError(f"索引 {self.index_name} 数据不一致: 分片共 {self._size} 行, "
+                             f"ID 元数据 {len(sha256s)}/{len(method_codes)} 条")
+        
+        self._compacted_count = self._size
+        self._sha256s = sha256s
+        self._method_codes = method_codes
+        self._deleted = np.zeros(self._size, dtype=bool)
+        
+        # 恢复已合并部分的墓碑标记
+        tombstones_path = self._committed_file(TOMBSTONES_FILE)
+        if tombstones_path.exists():
+            self._deleted[np.load(tombstones_path)] = True
+        self._deleted_count = int(self._deleted.sum())
+        
+        self._rebuild_lookup()
+        
+        # 重放追加日志
+        self._replay_wal()
+    
+    def _load_ids(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        加载列式 ID 元数据，旧格式的 ids.json 会被一次性转换
+        
+        Returns:
+            (sha256 数组, method 编码数组)
+        """
+        table_path = self.index_path / IDS_METHODS_TABLE_FILE
+        if table_path.exists():
+            with open(table_path, "r") as f:
+                self._methods = json.load(f)
+            self._method_ids = {m: i for i, m in enumerate(self._methods)}
+        
+        sha256_path = self._committed_file(IDS_SHA256_FILE)
+        if sha256_path.exists():
+            return np.load(sha256_path), np.load(self._committed_file(IDS_METHOD_FILE))
+        
+        legacy_path = self.index_path / LEGACY_IDS_FILE
+        if not self._legacy_layout or not legacy_path.exists():
+            return np.empty(0, dtype=f"S{SHA256_WIDTH}"), np.empty(0, dtype=np.int16)
+        
+        # 转换后的列式文件在加载后的合并中写出，旧文件届时删除
+        with open(legacy_path, "r") as f:
+            ids = json.load(f)
+        sha256s = np.array([e["sha256"] for e in ids], dtype=f"S{SHA256_WIDTH}")
+        method_codes = np.array([self._method_code(e["method"]) for e in ids], dtype=np.int16)
+        return sha256s, method_codes
+    
+    def _checkpoint_file(self, name: str, generation: int) -> Path:
+        """某个版本的检查点文件路径"""
+        return self.index_path / f"{name}_{generation}.npy"
+    
+    def _committed_file(self, name: str) -> Path:
+        """当前版本（meta.json 中的 wal_generation）的检查点文件路径，旧格式索引的文件名不带版本号"""
+        if self._legacy_layout:
+            return self.index_path / f"{name}.npy"
+        return self._checkpoint_file(name, self._wal_generation)
+    
+    def _save_array(self, path: Path, data: np.ndarray):
+        """原子保存单个数组文件"""
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp_path, path)
+    
+    def _save_ids(self, sha256s: np.ndarray, method_codes: np.ndarray, generation: int):
+        """保存某个版本的列式 ID 元数据（编码表先写，只增不减）"""
+        tmp_path = self.index_path / f"{IDS_METHODS_TABLE_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._methods, f)
+        os.replace(tmp_path, self.index_path / IDS_METHODS_TABLE_FILE)
+        self._save_array(self._checkpoint_file(IDS_SHA256_FILE, generation), sha256s)
+        self._save_array(self._checkpoint_file(IDS_METHOD_FILE, generation), method_codes)
+    
+    def _method_code(self, method: str) -> int:
+        """获取 method 的编码，新 method 追加到编码表"""
+        code = self._method_ids.get(method)
+        if code is None:
+            code = len(self._methods)
+            self._methods.append(method)
+            self._method_ids[method] = code
+        return code
+    
+    def _entry(self, row: int) -> Dict[str, Any]:
+        """构造某一行的 ID 信息 {id, sha256, method}"""
+        return {
+            "id": int(row),
+            "sha256": self._sha256s[row].decode(),
+            "method": self._methods[self._method_codes[row]]
+        }
+    
+    def _rebuild_lookup(self):
+        """根据列式 ID 和墓碑标记批量重建分组与 sha256 查找表"""
+        self._set_lookup(*self._build_lookup(self._sha256s[:self._size]))
+        self._group_live = np.bincount(self._groups[:self._size][~self._deleted[:self._size]],
+                                       minlength=self._num_groups).astype(np.int32)
+        self._live_groups = int(np.count_nonzero(self._group_live))
+        self._reset_attributes()
+    
+    def _set_lookup(self, order: np.ndarray, groups: np.ndarray, first_rows: np.ndarray):
+        """切换到 _build_lookup 算出的分组（组号重新编号；调用方需持有写锁或正在加载）"""
+        self._sha256_order = order
+        self._sorted_rows = len(order)
+        self._new_groups = {}
+        self._groups = groups
+        self._num_groups = len(first_rows)
+        self._group_first_row = first_rows
+        self._group_epoch += 1
+    
+    @staticmethod
+    def _argsort_sha256s(sha256s: np.ndarray) -> np.ndarray:
+        """
+        sha256 列的稳定排序（相同 sha256 的行按 ID 升序）
+        
+        先按前 8 字节（大端 uint64，与字节串的大小顺序一致）排序，比直接排序定长字节串快得多；
+        只有出现前缀相同而后续字节不同的行时，才退回按全部字节多键排序
+        """
+        keys = np.ascontiguousarray(sha256s).view(">u8").reshape(-1, SHA256_WIDTH // 8)
+        order = np.argsort(keys[:, 0], kind="stable")
+        sorted_keys = keys[order]
+        same_prefix = sorted_keys[1:, 0] == sorted_keys[:-1, 0]
+        if (same_prefix & (sorted_keys[1:, 1:] != sorted_keys[:-1, 1:]).any(axis=1)).any():
+            order = np.lexsort(keys.T[::-1])
+        return order
+    
+    @staticmethod
+    def _build_lookup(sha256s: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        批量计算分组：排序一次 sha256 列，相同 sha256 的连续一段即为一组，组号按 sha256 顺序编号
+        
+        Returns:
+            (按 sha256 排序的行 ID, 每行组号, 每组的第一行)
+        """
+        order = VectorIndex._argsort_sha256s(sha256s)
+        sorted_sha256s = sha256s[order]
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = sorted_sha256s[1:] != sorted_sha256s[:-1]
+        groups = np.empty(len(order), dtype=np.int32)
+        groups[order] = np.cumsum(starts) - 1
+        return order, groups, order[starts]
+    
+    def _sha256_key(self, sha256: str) -> np.ndarray:
+        """sha256 转换为与 ID 列相同类型的定长字节串"""
+        return np.array(sha256.encode(), dtype=f"S{SHA256_WIDTH}")
+    
+    def _lookup_groups(self, keys: np.ndarray) -> np.ndarray:
+        """批量查找 sha256（定长字节串数组）所属的组号，不在索引中的为 -1（调用方需持有锁或 _write_lock）"""
+        groups = np.full(len(keys), -1, dtype=np.int64)
+        if self._sorted_rows:
+            sorted_part = self._sha256s[:self._sorted_rows]
+            positions = np.searchsorted(sorted_part, keys, sorter=self._sha256_order)
+            rows = self._sha256_order[np.minimum(positions, self._sorted_rows - 1)]
+            found = sorted_part[rows] == keys
+            groups[found] = self._groups[rows[found]]
+        if self._new_groups:
+            for i in np.nonzero(groups < 0)[0]:
+                groups[i] = self._new_groups.get(bytes(keys[i]), -1)
+        return groups
+    
+    def _sha256_rows(self, sha256: str) -> np.ndarray:
+        """某张图片所有未删除的行 ID（按 ID 升序；调用方需持有锁或 _write_lock）"""
+        key = self._sha256_key(sha256)
+        sorted_part = self._sha256s[:self._sorted_rows]
+        start = np.searchsorted(sorted_part, key, side="left", sorter=self._sha256_order)
+        end = np.searchsorted(sorted_part, key, side="right", sorter=self._sha256_order)
+        rows = self._sha256_order[start:end]
+        if self._size > self._sorted_rows:
+            tail_rows = np.nonzero(self._sha256s[self._sorted_rows:self._size] == key)[0]
+            rows = np.concatenate([rows, tail_rows + self._sorted_rows])
+        return rows[~self._deleted[rows]]
+    
+    def _reset_attributes(self):
+        """按当前的组清空过滤属性，全部标记为待同步"""
+        num_groups = self._num_groups
+        self._group_state = np.full(num_groups, IMAGE_UNSYNCED, dtype=np.int8)
+        self._group_source = np.full(num_groups, -1, dtype=np.int16)
+        self._group_status = np.full(num_groups, -1, dtype=np.int16)
+        self._group_day = np.full(num_groups, -1, dtype=np.int32)
+        with self._attribute_pending_lock:
+            self._attribute_pending = None
+    
+    def _grow_attributes(self, start: int):
+        """为编号从 start 开始的新组补齐过滤属性，并加入待同步列表（调用方需持有写锁）"""
+        end = self._num_groups
+        if end <= start:
+            return
+        for name, fill in (("_group_state", IMAGE_UNSYNCED), ("_group_source", -1),
+                           ("_group_status", -1), ("_group_day", -1)):
+            column = self._grow(getattr(self, name), start, end)
+            column[start:end] = fill
+            setattr(self, name, column)
+        with self._attribute_pending_lock:
+            if self._attribute_pending is not None:
+                self._attribute_pending.update(
+                    sha256.decode() for sha256 in self._sha256s[self._group_first_row[start:end]])
+    
+    def _remap_attributes(self, old_groups: np.ndarray):
+        """组号重新计算后按新组号重排过滤属性，新组 g 对应旧组 old_groups[g]（调用方需持有写锁）"""
+        self._group_state = self._group_state[old_groups]
+        self._group_source = self._group_source[old_groups]
+        self._group_status = self._group_status[old_groups]
+        self._group_day = self._group_day[old_groups]
+    
+    def _attribute_code(self, field: str, value: Optional[str]) -> int:
+        """获取来源/处理状态的编码（None 为 -1），新取值追加到编码表"""
+        if value is None:
+            return -1
+        codes = self._attribute_codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = len(codes)
+            codes[value] = code
+        return code
+    
+    def invalidate_attributes(self, sha256: str):
+        """数据库中的图片信息有变更时调用：下次带过滤条件搜索前重新同步该图片的属性"""
+        with self._lock.read():
+            if self._lookup_groups(self._sha256_key(sha256)[None])[0] < 0:
+                return  # 不在索引中，加入索引时会作为新组同步
+        with self._attribute_pending_lock:
+            if self._attribute_pending is not None:
+                self._attribute_pending.add(sha256)
+        self._bump_version()
+    
+    def _bump_version(self):
+        """数据版本加一（在 _version_lock 内递增，不同锁下的并发递增不会丢失）"""
+        with self._version_lock:
+            self.version += 1
+    
+    def sync_attributes(self):
+        """
+        从 attribute_loader（数据库）同步待更新图片的过滤属性
+        
+        待同步的是新加入索引和数据库中有变更的图片，通常只需一次批量查询；刚加载时同步全部图片。
+        没有待同步的图片时直接返回；查询和转换期间不持有索引的锁（不与新增/合并互相等待），
+        只在写回属性列时短暂持有写锁。多个同步之间用 _attribute_sync_lock 串行，避免旧结果覆盖新结果
+        """
+        if self.attribute_loader is None:
+            return
+        with self._attribute_pending_lock:
+            if self._attribute_pending is not None and not self._attribute_pending:
+                return
+        with self._attribute_sync_lock:
+            # 先取读锁再取 _attribute_pending_lock（与新增时的加锁顺序一致）
+            with self._lock.read(), self._attribute_pending_lock:
+                pending = self._attribute_pending
+                if pending is not None and not pending:
+                    return  # 等待期间已被其他线程同步
+                self._attribute_pending = set()
+                # 全部同步时以当前的组为准（之后新增的组已在新的待同步列表中），组号即下标
+                epoch = self._group_epoch
+                if pending is None:
+                    first_rows = self._group_first_row[:self._num_groups]
+                    sha256s = [sha256.decode() for sha256 in self._sha256s[first_rows]]
+                    groups = np.arange(len(sha256s), dtype=np.int64)
+                else:
+                    sha256s = list(pending)
+                    keys = np.array([sha256.encode() for sha256 in sha256s], dtype=f"S{SHA256_WIDTH}")
+                    groups = self._lookup_groups(keys)
+            try:
+                attributes = self.attribute_loader(None if pending is None else sha256s)
+            except Exception:
+                # 查询失败时放回待同步列表，下次重试
+                with self._attribute_pending_lock:
+                    if pending is None:
+                        self._attribute_pending = None
+                    elif self._attribute_pending is not None:
+                        self._attribute_pending |= pending
+                raise
             
-            # 分片保存
-            num_shards = (len(all_embeddings) + self.shard_size - 1) // self.shard_size
-            for i in range(num_shards):
-                start = i * self.shard_size
-                end = min((i + 1) * self.shard_size, len(all_embeddings))
-                shard_path = self.index_path / f"embeddings_{i}.npy"
-                np.save(shard_path, all_embeddings[start:end])
+            # 锁外把属性转换为列
+            state = np.full(len(sha256s), IMAGE_REMOVED, dtype=np.int8)  # 数据库中不存在
+            source = np.full(len(sha256s), -1, dtype=np.int16)
+            status = np.full(len(sha256s), -1, dtype=np.int16)
+            day = np.full(len(sha256s), -1, dtype=np.int32)
+            for i, sha256 in enumerate(sha256s):
+                image = attributes.get(sha256)
+                if image is None:
+                    continue
+                state[i] = IMAGE_REMOVED if image.get("is_deleted") else IMAGE_LIVE
+                source[i] = self._attribute_code("source", image.get("source"))
+                status[i] = self._attribute_code("status", image.get("status"))
+                if image.get("created_at"):
+                    day[i] = day_bucket(image["created_at"])
+            
+            with self._lock.write():
+                if self._group_epoch != epoch:
+                    # 期间清理过已删除的行，组号已重新计算（新增只追加新组，不改变已有组号）
+                    keys = np.array([sha256.encode() for sha256 in sha256s], dtype=f"S{SHA256_WIDTH}")
+                    groups = self._lookup_groups(keys)
+                keep = groups >= 0  # 已不在索引中的图片
+                self._group_state[groups[keep]] = state[keep]
+                self._group_source[groups[keep]] = source[keep]
+                self._group_status[groups[keep]] = status[keep]
+                self._group_day[groups[keep]] = day[keep]
+    
+    def _filter_mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """
+        把规范化的过滤条件转换为行掩码（True 为保留，已排除墓碑标记的行；调用方需持有锁）
+        
+        图片级条件先在组上计算，再按每行的组号展开，整个过滤只是几次向量化比较
+        """
+        if filters is None:
+            return None
+        num_groups = self._num_groups
+        keep = np.ones(num_groups, dtype=bool)
+        if not filters["include_deleted"]:
+            keep &= self._group_state[:num_groups] != IMAGE_REMOVED
+        for field, column in (("source", self._group_source), ("status", self._group_status)):
+            if field in filters:
+                codes = [self._attribute_codes[field][v] for v in filters[field] if v in self._attribute_codes[field]]
+                keep &= np.isin(column[:num_groups], codes)
+        day = self._group_day[:num_groups]
+        if "created_from" in filters:
+            keep &= (day != -1) & (day >= filters["created_from"])
+        if "created_to" in filters:
+            keep &= (day != -1) & (day <= filters["created_to"])
+        
+        mask = keep[self._groups[:self._size]]
+        if self._deleted_count:
+            mask &= ~self._deleted[:self._size]
+        if "method" in filters:
+            codes = [self._method_ids[m] for m in filters["method"] if m in self._method_ids]
+            mask &= np.isin(self._method_codes[:self._size], codes)
+        return mask
+    
+    def _replay_wal(self):
+        """重放追加日志中尚未合并的条目"""
+        wal_ids_path = self.index_path / WAL_IDS_FILE
+        wal_emb_path = self.index_path / WAL_EMBEDDINGS_FILE
+        
+        if not wal_ids_path.exists():
+            self._reset_wal()
+            return
+        
+        records = []
+        clean = True
+        with open(wal_ids_path, "r") as f:
+            try:
+                header = json.loads(f.readline())
+            except json.JSONDecodeError:
+                header = {}
+            if header.get("generation") != self._wal_generation:
+                # 日志属于已合并的旧版本（合并过程中中断），直接丢弃
+                self._reset_wal()
+                return
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    clean = False  # 末尾写了一半的记录
+                    break
+        
+        rows = np.empty((0, self.dimension), dtype=np.float32)
+        if wal_emb_path.exists():
+            data = np.fromfile(wal_emb_path, dtype=np.float32)
+            num_rows = len(data) // self.dimension
+            clean = clean and wal_emb_path.stat().st_size == num_rows * self.dimension * 4
+            rows = data[:num_rows * self.dimension].reshape(num_rows, self.dimension)
+        
+        # 按顺序重放新增和删除记录；向量和新增记录分两个文件追加，以两者中较短的为准
+        added = 0
+        pending = []
+        applied = 0
+        for record in records:
+            if "delete" in record:
+                if pending:
+                    self._append_memory(rows[added:added + len(pending)], pending)
+                    added += len(pending)
+                    pending = []
+                self._delete_sha256(record["delete"])
+            else:
+                if added + len(pending) >= len(rows):
+                    break
+                pending.append((record["sha256"], record["method"]))
+            applied += 1
+        if pending:
+            self._append_memory(rows[added:added + len(pending)], pending)
+            added += len(pending)
+        self._wal_count = applied
+        
+        if not clean or applied != len(records) or added != len(rows):
+            # 日志末尾不完整，合并一次得到干净的状态
+            self._compact()
+    
+    def _reset_wal(self):
+        """清空追加日志，写入当前版本号"""
+        with open(self.index_path / WAL_EMBEDDINGS_FILE, "wb"):
+            pass
+        with open(self.index_path / WAL_IDS_FILE, "w") as f:
+            f.write(json.dumps({"generation": self._wal_generation}) + "\n")
+        self._wal_count = 0
+    
+    def _append_wal_delete(self, sha256: str):
+        """将删除记录追加到日志"""
+        with open(self.index_path / WAL_IDS_FILE, "a") as f:
+            f.write(json.dumps({"delete": sha256}) + "\n")
+        self._wal_count += 1
+    
+    def _append_wal(self, embeddings: np.ndarray, items: List[Tuple[str, str]]):
+        """将新增条目追加到日志（每个向量只写一次）"""
+        with open(self.index_path / WAL_EMBEDDINGS_FILE, "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self.index_path / WAL_IDS_FILE, "a") as f:
+            f.write("".join(
+                json.dumps({"sha256": sha256, "method": method}) + "\n"
+                for sha256, method in items
+            ))
+        self._wal_count += len(items)
+    
+    @property
+    def _coarse_tag(self) -> Optional[str]:
+        """粗筛副本的文件名标记（如 p256.int8），未启用时为 None"""
+        parts = []
+        if self.prefix_dimension:
+            parts.append(f"p{self.prefix_dimension}")
+        if self.quantization:
+            parts.append(self.quantization)
+        return ".".join(parts) or None
+    
+    def _coarse_rows(self, rows: np.ndarray) -> np.ndarray:
+        """截取前缀维度并重新归一化（未启用前缀时原样返回）"""
+        if not self.prefix_dimension:
+            return rows
+        prefix = np.array(rows[:, :self.prefix_dimension], dtype=np.float32)
+        norms = np.linalg.norm(prefix, axis=1, keepdims=True)
+        prefix /= np.where(norms > 0, norms, 1)
+        return prefix
+    
+    def _new_shard_name(self, shard_idx: int) -> str:
+        """第 shard_idx 个分片在下一个版本中的文件名（不覆盖当前版本的文件）"""
+        return f"{SHARD_PREFIX}{shard_idx}_{self._wal_generation + 1}"
+    
+    def _shard_arrays(self, name: str, data: np.ndarray) -> List[Tuple[str, np.ndarray]]:
+        """分片对应的所有文件及内容：float32 向量，以及启用时的粗筛副本"""
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        arrays = [(f"{name}.npy", data)]
+        tag = self._coarse_tag
+        if tag is None:
+            return arrays
+        
+        coarse = self._coarse_rows(data)
+        if self.quantization == "fp16":
+            coarse = coarse.astype(np.float16)
+        elif self.quantization == "int8":
+            # 每维按该分片的最小/最大值线性映射到 [-128, 127]：x ≈ offset + scale * code
+            low = coarse.min(axis=0)
+            scale = (coarse.max(axis=0) - low) / 255
+            scale[scale == 0] = 1
+            codes = np.empty(coarse.shape, dtype=np.int8)
+            for start in range(0, len(coarse), COARSE_CHUNK_ROWS):
+                chunk = np.rint((coarse[start:start + COARSE_CHUNK_ROWS] - low) / scale) - 128
+                codes[start:start + len(chunk)] = np.clip(chunk, -128, 127)
+            coarse = codes
+            arrays.append((f"{name}.{tag}_params.npy",
+                           np.stack([low + 128 * scale, scale]).astype(np.float32)))
+        arrays.insert(1, (f"{name}.{tag}.npy", coarse))
+        return arrays
+    
+    def _save_shard(self, name: str, data: np.ndarray, coarse_only: bool = False) -> List[str]:
+        """原子写入分片文件及其粗筛副本（或只写粗筛副本），返回写入的文件名列表"""
+        names = []
+        for file_name, array in self._shard_arrays(name, data)[1 if coarse_only else 0:]:
+            self._save_array(self.index_path / file_name, array)
+            names.append(file_name)
+        return names
+    
+    def _open_shard(self, name: str) -> np.ndarray:
+        """打开分片文件（内存映射或完整读入）"""
+        return np.load(self.index_path / f"{name}.npy", mmap_mode="r" if self.use_mmap else None)
+    
+    def _open_coarse_shard(self, name: str, shard: np.ndarray):
+        """
+        打开分片的粗筛副本
+        
+        不存在或与分片行数不一致时（新启用或更换了粗筛方式、写入中断）重新生成，并删除其他方式的旧副本
+        """
+        mmap_mode = "r" if self.use_mmap else None
+        tag = self._coarse_tag
+        coarse_path = self.index_path / f"{name}.{tag}.npy"
+        params_path = self.index_path / f"{name}.{tag}_params.npy"
+        
+        def load():
+            if not coarse_path.exists() or (self.quantization == "int8" and not params_path.exists()):
+                return None
+            coarse = np.load(coarse_path, mmap_mode=mmap_mode)
+            if len(coarse) != len(shard):
+                return None
+            if self.quantization == "int8":
+                offset, scale = np.load(params_path)
+                return coarse, offset, scale
+            return coarse, None, None
+        
+        loaded = load()
+        if loaded is None:
+            names = self._save_shard(name, shard, coarse_only=True)
+            for path in self.index_path.glob(f"{name}.*.npy"):
+                if path.name not in names:
+                    path.unlink()
+            loaded = load()
+        return loaded
+    
+    def _open_shard_files(self, name: str):
+        """
+        打开分片及其粗筛副本，返回 (分片, 粗筛副本, 扫描文件)
+        
+        扫描文件为分片并行搜索时子进程打开的文件（启用粗筛时为粗筛副本）的 (路径, inode)，
+        子进程据此确认文件没有被之后的合并/清理替换
+        """
+        shard = self._open_shard(name)
+        coarse = self._open_coarse_shard(name, shard) if self._coarse_tag else None
+        path = self.index_path / (f"{name}.{self._coarse_tag}.npy" if coarse else f"{name}.npy")
+        return shard, coarse, (str(path), path.stat().st_ino)
+    
+    def _set_shard(self, shard_idx: int, name: str, opened=None):
+        """把分片及其粗筛副本放到第 shard_idx 个位置（opened 为 _open_shard_files 的返回值）"""
+        shard, coarse, scan_file = opened or self._open_shard_files(name)
+        if shard_idx == len(self._shards):
+            self._shards.append(shard)
+            self._shard_names.append(name)
+            self._shard_files.append(scan_file)
+        else:
+            self._shards[shard_idx] = shard
+            self._shard_names[shard_idx] = name
+            self._shard_files[shard_idx] = scan_file
+        if self._coarse_tag:
+            if shard_idx == len(self._coarse_shards):
+                self._coarse_shards.append(coarse)
+            else:
+                self._coarse_shards[shard_idx] = coarse
+    
+    def _compact(self):
+        """
+        将追加日志合并进分片文件
+        
+        缓冲区中的行先填满最后一个未满的分片，再写成新分片；之前的分片保持不变。
+        改写和新增的分片以下一个版本号命名，不覆盖当前版本的文件，由 _save_checkpoint 提交。
+        写文件期间搜索照常使用旧的分片和缓冲区，全部写好后在写锁内一次性切换到新分片并清空缓冲区。
+        （调用方需持有 _write_lock）
+        """
+        tail = self._tail
+        pos = 0
+        opened = {}
+        
+        # 填满最后一个未满的分片
+        if self._shards and len(self._shards[-1]) < self.shard_size and len(tail) > 0:
+            last = len(self._shards) - 1
+            fill = min(self.shard_size - len(self._shards[last]), len(tail))
+            name = self._new_shard_name(last)
+            self._save_shard(name, np.concatenate([self._shards[last], tail[:fill]]))
+            opened[last] = (name, self._open_shard_files(name))
+            pos = fill
+        
+        # 剩余的行写成新分片
+        shard_idx = len(self._shards)
+        while pos < len(tail):
+            chunk = tail[pos:pos + self.shard_size]
+            name = self._new_shard_name(shard_idx)
+            self._save_shard(name, chunk)
+            opened[shard_idx] = (name, self._open_shard_files(name))
+            shard_idx += 1
+            pos += len(chunk)
+        
+        # 新增的行并入 sha256 排序（持有 _write_lock，期间不会再新增）
+        order = self._argsort_sha256s(self._sha256s[:self._size])
+        
+        with self._lock.write():
+            for shard_idx in sorted(opened):
+                self._set_shard(shard_idx, *opened[shard_idx])
+            self._compacted_count = self._size
+            self._buffer = np.empty((0, self.dimension), dtype=np.float32)
+            self._sha256_order = order
+            self._sorted_rows = len(order)
+            self._new_groups = {}
+        
+        self._save_checkpoint()
+    
+    def _save_checkpoint(self):
+        """
+        提交新版本（分片已写好）：以下一个版本号保存 IDs 和墓碑标记，再原子替换 meta.json，
+        之后清空追加日志并删除旧版本的文件。
+        meta.json 替换之前中断时，重新加载仍使用旧版本的文件并重放追加日志；之后中断时旧日志按版本号丢弃
+        """
+        generation = self._wal_generation + 1
+        self._save_ids(self._sha256s[:self._size], self._method_codes[:self._size], generation)
+        if self._deleted_count:
+            self._save_array(self._checkpoint_file(TOMBSTONES_FILE, generation),
+                             np.nonzero(self._deleted[:self._size])[0])
         
-        # 更新元信息
+        # 元信息写入新版本号和分片文件列表后，新版本即生效，旧日志视为已合并
+        self._wal_generation = generation
         self._save_meta()
+        self._legacy_layout = False
+        self._reset_wal()
+        self._remove_stale_files()
+    
+    def _remove_stale_files(self):
+        """删除不属于当前版本的分片和检查点文件（已被替换的旧版本，或合并/清理中断留下的文件）"""
+        shard_names = set(self._shard_names)
+        checkpoint_names = {self._committed_file(name).name for name in self.checkpoint_files}
+        checkpoint_pattern = re.compile(rf"({'|'.join(self.checkpoint_files)})(_\d+)?\.npy(\.tmp)?")
+        for path in self.index_path.iterdir():
+            name = path.name
+            if name.startswith(SHARD_PREFIX):
+                stale = name.endswith(".tmp") or name.split(".")[0] not in shard_names
+            elif checkpoint_pattern.fullmatch(name):
+                stale = name not in checkpoint_names
+            else:
+                stale = name == LEGACY_IDS_FILE and not self._legacy_layout
+            if stale:
+                path.unlink()
+    
+    def _purge(self):
+        """
+        清除已删除的行：把所有未删除的行重写成新分片，ID 重新编号
+        
+        新分片以下一个版本号命名，不覆盖当前版本的文件；已映射的旧分片不受影响，搜索照常进行，
+        最后在写锁内一次性切换到新分片和新的 ID 映射，再由 _save_checkpoint 提交（调用方需持有 _write_lock）
+        """
+        keep = np.nonzero(~self._deleted[:self._size])[0]
+        sha256s = self._sha256s[keep]
+        method_codes = self._method_codes[keep]
+        
+        num_shards = (len(keep) + self.shard_size - 1) // self.shard_size
+        names = [self._new_shard_name(i) for i in range(num_shards)]
+        for i, name in enumerate(names):
+            self._save_shard(name, self._get_rows(keep[i * self.shard_size:(i + 1) * self.shard_size]))
+        
+        # 锁外打开新分片并计算分组
+        opened = [self._open_shard_files(name) for name in names]
+        lookup = self._build_lookup(sha256s)
+        old_groups = self._groups[keep][lookup[2]]  # 新组号 → 旧组号
+        
+        with self._lock.write():
+            self._clear_memory()
+            for i in range(num_shards):
+                self._set_shard(i, names[i], opened[i])
+            self._size = len(keep)
+            self._compacted_count = self._size
+            self._sha256s = sha256s
+            self._method_codes = method_codes
+            self._deleted = np.zeros(self._size, dtype=bool)
+            self._set_lookup(*lookup)
+            self._group_live = np.bincount(self._groups, minlength=self._num_groups).astype(np.int32)
+            self._live_groups = self._num_groups
+            self._remap_attributes(old_groups)
+            self._remap_rows(keep)
+        
+        self._save_checkpoint()
+    
+    def _remap_rows(self, keep: np.ndarray):
+        """清除已删除行后 ID 重新编号，新 ID i 对应旧 ID keep[i]；子类在此重排与行对齐的附加数据"""
+        pass
+    
+    def _purge_in_background(self):
+        """已删除行占比超过阈值时，启动后台线程清理（同一时间只有一个）"""
+        if self._size == 0 or self._deleted_count / self._size < self.purge_deleted_ratio:
+            return
+        if self._purge_thread is not None and self._purge_thread.is_alive():
+            return
+        
+        def run():
+            with self._write_lock:
+                # 等待锁期间可能已被清理
+                if self._deleted_count / max(self._size, 1) >= self.purge_deleted_ratio:
+                    self._purge()
+        
+        self._purge_thread = threading.Thread(target=run, name=f"purge-{self.index_name}", daemon=True)
+        self._purge_thread.start()
+    
+    @property
+    def _tail(self) -> np.ndarray:
+        """缓冲区中有效行的视图（不拷贝）"""
+        return self._buffer[:self._size - self._compacted_count]
+    
+    def _segments(self) -> List[Tuple[int, np.ndarray]]:
+        """按顺序返回所有数据段 [(起始 ID, 矩阵)]：各分片 + 尾部缓冲区"""
+        segments = []
+        start = 0
+        for shard in self._shards:
+            segments.append((start, shard))
+            start += len(shard)
+        if self._size > start:
+            segments.append((start, self._tail))
+        return segments
+    
+    def _get_rows(self, indices: np.ndarray) -> np.ndarray:
+        """按 ID 取出若干行（拷贝）"""
+        indices = np.asarray(indices, dtype=np.int64)
+        rows = np.empty((len(indices), self.dimension), dtype=np.float32)
+        for start, segment in self._segments():
+            mask = (indices >= start) & (indices < start + len(segment))
+            if mask.any():
+                rows[mask] = segment[indices[mask] - start]
+        return rows
+    
+    @staticmethod
+    def _grow(array: np.ndarray, used: int, capacity: int) -> np.ndarray:
+        """容量不足时按 2 倍扩容，保留前 used 行"""
+        if capacity <= len(array):
+            return array
+        new_capacity = max(INITIAL_CAPACITY, len(array))
+        while new_capacity < capacity:
+            new_capacity *= 2
+        grown = np.empty((new_capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:used] = array[:used]
+        return grown
+    
+    def _clear_memory(self):
+        """清空所有数据段、ID 映射和分组"""
+        self._shards = []
+        self._shard_names = []
+        self._coarse_shards = []
+        self._shard_files = []
+        self._buffer = np.empty((0, self.dimension), dtype=np.float32)
+        self._size = 0
+        self._compacted_count = 0
+        self._sha256s = np.empty(0, dtype=f"S{SHA256_WIDTH}")
+        self._method_codes = np.empty(0, dtype=np.int16)
+        self._groups = np.empty(0, dtype=np.int32)
+        self._num_groups = 0
+        self._group_first_row = np.empty(0, dtype=np.int64)
+        self._group_live = np.zeros(0, dtype=np.int32)
+        self._live_groups = 0
+        self._sha256_order = np.empty(0, dtype=np.int64)
+        self._sorted_rows = 0
+        self._new_groups = {}
+        self._deleted = np.zeros(0, dtype=bool)
+        self._deleted_count = 0
+    
+    def _append_entries(self, items: List[Tuple[str, str]]):
+        """追加 ID 映射和分组信息（ID 接在已有条目之后）"""
+        first_id = self._size
+        end = first_id + len(items)
+        self._sha256s = self._grow(self._sha256s, first_id, end)
+        self._method_codes = self._grow(self._method_codes, first_id, end)
+        self._groups = self._grow(self._groups, first_id, end)
+        self._deleted = self._grow(self._deleted, first_id, end)
+        self._deleted[first_id:end] = False
+        keys = np.array([sha256.encode() for sha256, _ in items], dtype=f"S{SHA256_WIDTH}")
+        self._sha256s[first_id:end] = keys
+        self._method_codes[first_id:end] = [self._method_code(method) for _, method in items]
+        
+        # 已有的组批量查找，新出现的 sha256 依次编号为新组
+        groups = self._lookup_groups(keys)
+        num_groups = self._num_groups
+        new_rows = []
+        for offset in np.nonzero(groups < 0)[0]:
+            key = bytes(keys[offset])
+            group = self._new_groups.get(key)
+            if group is None:
+                group = self._num_groups
+                self._new_groups[key] = group
+                self._num_groups += 1
+                new_rows.append(first_id + offset)
+            groups[offset] = group
+        self._groups[first_id:end] = groups
+        self._group_first_row = self._grow(self._group_first_row, num_groups, self._num_groups)
+        self._group_first_row[num_groups:self._num_groups] = new_rows
+        self._group_live = self._grow(self._group_live, num_groups, self._num_groups)
+        self._group_live[num_groups:self._num_groups] = 0
+        
+        # 没有未删除行的组（新组，或删除后重新加入的图片）重新计入
+        touched = np.unique(groups)
+        self._live_groups += int(np.count_nonzero(self._group_live[touched] == 0))
+        np.add.at(self._group_live, groups, 1)
+        self._grow_attributes(num_groups)
+    
+    def _append_memory(self, embeddings: np.ndarray, items: List[Tuple[str, str]]) -> int:
+        """
+        追加到尾部缓冲区和 ID 映射（均摊 O(dimension)）
+        
+        Returns:
+            第一条新增条目的 ID
+        """
+        first_id = self._size
+        tail_size = self._size - self._compacted_count
+        self._buffer = self._grow(self._buffer, tail_size, tail_size + len(embeddings))
+        self._buffer[tail_size:tail_size + len(embeddings)] = embeddings
+        self._append_entries(items)
+        self._size += len(embeddings)
+        return first_id
+    
+    def _delete_sha256(self, sha256: str) -> int:
+        """给某张图片的所有行打上墓碑标记，返回标记的行数"""
+        rows = self._sha256_rows(sha256)
+        if len(rows) == 0:
+            return 0
+        self._deleted[rows] = True
+        self._deleted_count += len(rows)
+        self._group_live[self._groups[rows[0]]] = 0
+        self._live_groups -= 1
+        return len(rows)
     
     def add(self, embedding: np.ndarray, sha256: str, method: str = "image") -> int:
         """
@@ -127,113 +1185,430 @@ class VectorIndex:
         Returns:
             向量在索引中的位置 ID
         """
-        with self._lock:
-            # 确保向量是正确维度
-            embedding = np.array(embedding, dtype=np.float32).reshape(1, -1)
-            if embedding.shape[1] != self.dimension:
-                raise ValueError(f"向量维度不匹配: 期望 {self.dimension}, 实际 {embedding.shape[1]}")
-            
-            # 归一化向量（用于余弦相似度计算）
-            norm = np.linalg.norm(embedding)
-            if norm > 0:
-                embedding = embedding / norm
-            
-            # 添加到内存
-            if not self._embeddings:
-                self._embeddings = [embedding]
-            else:
-                self._embeddings[0] = np.vstack([self._embeddings[0], embedding])
-            
-            # 记录 ID 映射
-            entry_id = len(self._ids)
-            self._ids.append({
-                "id": entry_id,
-                "sha256": sha256,
-                "method": method
-            })
+        return self.add_many(np.asarray(embedding).reshape(1, -1), [sha256], method)[0]
+    
+    def add_many(self, embeddings: np.ndarray, sha256s: List[str],
+                 methods=None) -> List[int]:
+        """
+        批量添加向量到索引（一次加锁、一次写入日志）
+        
+        Args:
+            embeddings: 嵌入向量矩阵 (N, dimension)
+            sha256s: 每个向量对应的图片 SHA256
+            methods: 嵌入来源列表，或所有向量共用的单个来源（默认 image）
+        
+        Returns:
+            新增向量在索引中的位置 ID 列表
+        """
+        embeddings = np.array(embeddings, dtype=np.float32)
+        if len(sha256s) == 0 and embeddings.size == 0:
+            return []
+        
+        embeddings = embeddings.reshape(len(sha256s), -1)
+        if embeddings.shape[1] != self.dimension:
+            raise ValueError(f"向量维度不匹配: 期望 {self.dimension}, 实际 {embeddings.shape[1]}")
+        
+        if methods is None:
+            methods = "image"
+        if isinstance(methods, str):
+            methods = [methods] * len(sha256s)
+        if len(methods) != len(sha256s):
+            raise ValueError(f"数量不匹配: {len(sha256s)} 个 sha256, {len(methods)} 个 method")
+        for sha256 in sha256s:
+            if len(sha256) > SHA256_WIDTH or not sha256.isascii():
+                raise ValueError(f"sha256 必须是不超过 {SHA256_WIDTH} 位的 ASCII 字符串: {sha256}")
+        
+        # 归一化向量（用于余弦相似度计算）
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms > 0, norms, 1)
+        
+        with self._write_lock:
+            # 添加到内存并记录 ID 映射（只在这一步阻塞搜索）
+            items = list(zip(sha256s, methods))
+            with self._lock.write():
+                first_id = self._append_memory(embeddings, items)
+                self._bump_version()
             
-            # 保存数据
-            self._save_data()
+            # 追加到日志，累计到一定数量后合并进分片
+            self._append_wal(embeddings, items)
+            if self._wal_count >= self.wal_compact_rows:
+                self._compact()
             
-            return entry_id
+            return list(range(first_id, first_id + len(sha256s)))
     
-    def search(self, query: np.ndarray, top_k: int = 10) -> List[Tuple[int, float, Dict]]:
+    def search(self, query: np.ndarray, top_k: int = 10,
+               filters: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float, Dict]]:
         """
         搜索最相似的向量
         
         Args:
             query: 查询向量
             top_k: 返回数量
+            filters: 过滤条件（见 normalize_filters），在取 top_k 之前以掩码方式应用
         
         Returns:
             [(id, score, {sha256, method}), ...]
         """
-        with self._lock:
-            if not self._embeddings or len(self._ids) == 0:
+        filters = self._prepare_filters(filters)
+        with self._lock.read():
+            if self.count() == 0:
                 return []
             
-            # 归一化查询向量
-            query = np.array(query, dtype=np.float32).reshape(1, -1)
-            query_norm = np.linalg.norm(query)
-            if query_norm > 0:
-                query = query / query_norm
-            
-            # 获取所有嵌入向量并归一化（兼容未归一化的旧数据）
-            all_embeddings = self._embeddings[0].copy()
-            norms = np.linalg.norm(all_embeddings, axis=1, keepdims=True)
-            norms = np.where(norms > 0, norms, 1)  # 避免除零
-            all_embeddings = all_embeddings / norms
+            candidates = top_k * (self.rescore_factor if self._coarse_tag else 1)
+            similarities = self._filtered_similarities(query, self._filter_mask(filters), candidates)
+            similarities = self._search_similarities(query, top_k, similarities)
             
-            # 计算余弦相似度
-            similarities = np.dot(all_embeddings, query.T).flatten()
+            # 获取 top_k（部分选择，无需全量排序；已删除的行分数为 -inf）
+            top_indices = top_k_indices(similarities, min(top_k, self.count()))
+            return self._search_results(similarities, top_indices)
+    
+    def search_deduplicated(self, query: np.ndarray, top_k: int = 10,
+                            filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        搜索并按 sha256 去重（每张图只保留最高分）
+        
+        在索引内按图片分组取最大值，保证返回 top_k 张不同的图片
+        
+        Args:
+            query: 查询向量
+            top_k: 返回数量
+            filters: 过滤条件（见 normalize_filters），在取 top_k 之前以掩码方式应用
+        
+        Returns:
+            [{sha256, score, matched_by}, ...]
+        """
+        filters = self._prepare_filters(filters)
+        with self._lock.read():
+            if self.count() == 0:
+                return []
             
-            # 获取 top_k
-            top_k = min(top_k, len(similarities))
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
+            mask = self._filter_mask(filters)
+            candidates = top_k * (self.rescore_factor if self._coarse_tag else 1)
+            similarities = self._filtered_similarities(query, mask, candidates, per_group=True)
+            return self._deduplicated_results(query, similarities, top_k, mask)
+    
+    def search_batch(self, queries: np.ndarray, top_k: int = 10,
+                     deduplicate: bool = False,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List]:
+        """
+        批量搜索：每批查询与每个数据段只做一次矩阵乘法，再按列部分选择 top_k
+        
+        Args:
+            queries: 查询向量矩阵 (Q, dimension)
+            top_k: 每个查询的返回数量
+            deduplicate: 是否按 sha256 去重
+            filters: 所有查询共用的过滤条件（见 normalize_filters）
+        
+        Returns:
+            每个查询一个结果列表，格式同 search（deduplicate=True 时同 search_deduplicated）
+        """
+        queries = np.array(queries, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dimension:
+            raise ValueError(f"查询矩阵形状不匹配: 期望 (Q, {self.dimension}), 实际 {queries.shape}")
+        
+        filters = self._prepare_filters(filters)
+        with self._lock.read():
+            if self.count() == 0 or top_k <= 0:
+                return [[] for _ in range(len(queries))]
             
             results = []
-            for idx in top_indices:
-                results.append((
-                    int(idx),
-                    float(similarities[idx]),
-                    self._ids[idx]
-                ))
+            k = min(top_k, self.count())
+            mask = self._filter_mask(filters)
+            batch_size = max(1, BATCH_SIMILARITIES_BYTES // (4 * self._size))
+            for start in range(0, len(queries), batch_size):
+                batch = queries[start:start + batch_size]
+                similarities = self._filtered_similarities(batch, mask)  # (行数, 查询数)
+                
+                if deduplicate or self._coarse_tag:
+                    # 去重和精确重排按查询逐个处理（相似度已由矩阵乘法算好）
+                    for query, column in zip(batch, similarities.T):
+                        column = np.ascontiguousarray(column)
+                        if deduplicate:
+                            results.append(self._deduplicated_results(query, column, top_k, mask))
+                        else:
+                            column = self._search_similarities(query, top_k, column)
+                            results.append(self._search_results(column, top_k_indices(column, k)))
+                    continue
+                
+                # 按列部分选择 top_k，再只对这 k 行排序
+                if k < self._size:
+                    top_rows = np.argpartition(similarities, self._size - k, axis=0)[-k:]
+                else:
+                    top_rows = np.broadcast_to(np.arange(self._size)[:, None], similarities.shape)
+                top_scores = np.take_along_axis(similarities, top_rows, axis=0)
+                top_rows = np.take_along_axis(top_rows, np.argsort(-top_scores, axis=0, kind="stable"), axis=0)
+                for column, rows in zip(similarities.T, top_rows.T):
+                    results.append(self._search_results(column, rows))
             
             return results
     
-    def search_deduplicated(self, query: np.ndarray, top_k: int = 10) -> List[Dict[str, Any]]:
+    def _search_results(self, similarities: np.ndarray, top_indices: np.ndarray) -> List[Tuple[int, float, Dict]]:
+        """把 top_k 行整理成 search 的返回格式"""
+        results = []
+        for idx in top_indices:
+            if similarities[idx] == -np.inf:
+                break  # 近似检索未覆盖的行同样为 -inf，不足 top_k 时提前结束
+            results.append((
+                int(idx),
+                float(similarities[idx]),
+                self._entry(idx)
+            ))
+        return results
+    
+    def _deduplicated_results(self, query: np.ndarray, similarities: np.ndarray,
+                              top_k: int, mask: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """按图片分组取 top_k，整理成 search_deduplicated 的返回格式（mask 为过滤掩码；调用方需持有锁）"""
+        if self._coarse_tag:
+            # 粗筛出候选图片，对这些图片的所有（符合过滤条件的）行精确重排
+            pool = self._top_k_group_rows(similarities, top_k * self.rescore_factor)
+            pool = pool[similarities[pool] != -np.inf]
+            in_pool = np.zeros(self._num_groups, dtype=bool)
+            in_pool[self._groups[pool]] = True
+            live = ~self._deleted[:self._size] if mask is None else mask
+            rows = np.nonzero(in_pool[self._groups[:self._size]] & live)[0]
+            similarities = self._rescore(query, rows)
+        top_indices = self._top_k_group_rows(similarities, top_k)
+        
+        return [
+            {
+                "sha256": self._sha256s[idx].decode(),
+                "score": float(similarities[idx]),
+                "matched_by": self._methods[self._method_codes[idx]]
+            }
+            for idx in top_indices
+            if similarities[idx] != -np.inf
+        ]
+    
+    def _prepare_filters(self, filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """规范化过滤条件；需要过滤时先同步待更新的图片属性（在取读锁之前调用）"""
+        filters = normalize_filters(filters)
+        if filters is not None:
+            self.sync_attributes()
+        return filters
+    
+    def _filtered_similarities(self, query: np.ndarray, mask: Optional[np.ndarray],
+                               candidates: Optional[int] = None, per_group: bool = False) -> np.ndarray:
         """
-        搜索并按 sha256 去重（每张图只保留最高分）
+        计算相似度，不符合过滤条件的行分数为 -inf（调用方需持有锁）
         
-        Args:
-            query: 查询向量
-            top_k: 返回数量
+        设置了进程池且给出 candidates（调用方最终只使用分数最高的 candidates 行，per_group=True 时为
+        candidates 张图片）时按分片并行计算，只保留每个分片的候选行，其余行为 -inf
+        """
+        if (candidates is not None and self.search_pool is not None and self.sharded_search
+                and self._shards and np.ndim(query) == 1):
+            if per_group:
+                # 一张图片最多有 m 行，分片内排在入选图片最佳行之前的行不超过 (candidates - 1) * m 行
+                candidates *= int(np.bincount(self._groups[:self._size]).max())
+            return self._sharded_similarities(query, mask, candidates)
+        
+        similarities = self._similarities(query)
+        if mask is not None:
+            similarities[~mask] = -np.inf
+        return similarities
+    
+    def _sharded_similarities(self, query: np.ndarray, mask: Optional[np.ndarray], candidates: int) -> np.ndarray:
+        """
+        分片并行计算相似度（scatter-gather）
+        
+        每个分片交给进程池中的一个进程扫描（子进程按路径内存映射同一文件，共享页缓存），
+        只取回各分片分数最高的 candidates 行；尾部缓冲区在本进程内计算。
+        全局前 candidates 行必然在各分片的前 candidates 行中，合并结果与整体扫描一致（调用方需持有锁）
+        """
+        query = self._normalize_query(query)
+        coarse = self._coarse_tag is not None
+        weights = self._coarse_rows(query.reshape(1, -1)).reshape(-1) if coarse else query
+        if mask is None and self._deleted_count:
+            mask = ~self._deleted[:self._size]
+        
+        shard_segments = self._segments()[:len(self._shards)]
+        similarities = np.full(self._size, -np.inf, dtype=np.float32)
+        if self._size > self._compacted_count:
+            tail = self._tail
+            np.dot(self._coarse_rows(tail) if coarse else tail, weights,
+                   out=similarities[self._compacted_count:])
+        
+        # scatter-gather：分片交给子进程；提交或等待失败时尚未取回结果的分片在本进程内计算
+        pool = self.search_pool
+        results = [None] * len(shard_segments)
+        try:
+            futures = []
+            for i, (start, shard) in enumerate(shard_segments):
+                path, inode = self._shard_files[i]
+                offset, scale = self._coarse_shards[i][1:] if coarse else (None, None)
+                shard_mask = None if mask is None else mask[start:start + len(shard)]
+                futures.append(pool.submit(
+                    _scan_shard, path, inode, len(shard), weights, offset, scale, shard_mask, candidates
+                ))
+            for i, future in enumerate(futures):
+                results[i] = future.result()
+        except BrokenProcessPool as e:
+            # 子进程异常退出（如被 OOM killer 杀死）后进程池不再可用；当前进程已有多个线程，
+            # 不能再以 fork 方式重建，之后该索引改为在本进程内扫描
+            print(f"[VectorIndex] 搜索进程池已损坏，{self.index_name} 改为本进程计算: {e}")
+            if self.search_pool is pool:
+                self.search_pool = None
+        except Exception as e:
+            print(f"[VectorIndex] 分片并行搜索失败，改为本进程计算: {e}")
+        
+        for i, ((start, shard), result) in enumerate(zip(shard_segments, results)):
+            if result is None:
+                # 分片文件已被替换（或子进程出错），本进程内计算该分片
+                out = similarities[start:start + len(shard)]
+                if coarse:
+                    self._coarse_dot(self._coarse_shards[i], weights, out)
+                else:
+                    np.dot(shard, weights, out=out)
+            else:
+                rows, scores = result
+                similarities[start + rows] = scores
+        
+        if mask is not None:
+            similarities[~mask] = -np.inf
+        return similarities
+    
+    def _normalize_query(self, query: np.ndarray) -> np.ndarray:
+        """归一化查询向量（二维时按行归一化查询矩阵）"""
+        query = np.array(query, dtype=np.float32)
+        if query.ndim != 2:
+            query = query.reshape(-1)
+        norms = np.linalg.norm(query, axis=-1, keepdims=True)
+        return query / np.where(norms > 0, norms, 1)
+    
+    def _similarities(self, query: np.ndarray, exact: bool = False) -> np.ndarray:
+        """
+        计算查询向量与所有行的余弦相似度（调用方需持有锁）
+        
+        query 为 (dimension,) 时返回 (行数,)；为查询矩阵 (Q, dimension) 时返回 (行数, Q)，
+        每个数据段只做一次矩阵乘法。
+        启用粗筛副本时分片部分在副本上计算、尾部缓冲区按前缀在线计算（近似值），
+        exact=True 时全部按 float32 全维计算
+        """
+        query = self._normalize_query(query)
+        coarse = self._coarse_tag is not None and not exact
+        if coarse:
+            query = self._coarse_rows(query.reshape(-1, self.dimension)).reshape(query.shape[:-1] + (-1,))
+        weights = query.T  # (维度,) 或 (维度, Q)
+        
+        # 存储的向量已归一化，对每个数据段做一次矩阵-向量（矩阵）乘法
+        similarities = np.empty((self._size,) + query.shape[:-1], dtype=np.float32)
+        for i, (start, segment) in enumerate(self._segments()):
+            out = similarities[start:start + len(segment)]
+            if not coarse:
+                np.dot(segment, weights, out=out)
+            elif i < len(self._coarse_shards):
+                self._coarse_dot(self._coarse_shards[i], weights, out)
+            else:
+                np.dot(self._coarse_rows(segment), weights, out=out)
+        
+        # 屏蔽已删除的行
+        if self._deleted_count:
+            similarities[self._deleted[:self._size]] = -np.inf
+        return similarities
+    
+    @staticmethod
+    def _coarse_dot(coarse, query: np.ndarray, out: np.ndarray):
+        """粗筛副本与查询向量（或转置后的查询矩阵）的内积：分批解码为 float32 后做矩阵乘法"""
+        rows, offset, scale = coarse
+        weights = query if scale is None else query * scale.reshape((-1,) + (1,) * (query.ndim - 1))
+        for start in range(0, len(rows), COARSE_CHUNK_ROWS):
+            chunk = np.asarray(rows[start:start + COARSE_CHUNK_ROWS], dtype=np.float32)
+            np.dot(chunk, weights, out=out[start:start + len(chunk)])
+        if offset is not None:
+            out += np.float32(offset @ query)
+    
+    def _rescore(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """用 float32 行精确计算指定行的相似度，其余行为 -inf"""
+        similarities = np.full(self._size, -np.inf, dtype=np.float32)
+        similarities[rows] = self._get_rows(rows) @ self._normalize_query(query)
+        return similarities
+    
+    def _search_similarities(self, query: np.ndarray, top_k: int,
+                             similarities: Optional[np.ndarray] = None) -> np.ndarray:
+        """search 使用的相似度：启用粗筛副本时粗筛 top_k * rescore_factor 个候选后精确重排"""
+        if similarities is None:
+            similarities = self._similarities(query)
+        if self._coarse_tag:
+            pool = top_k_indices(similarities, top_k * self.rescore_factor)
+            similarities = self._rescore(query, pool[similarities[pool] != -np.inf])
+        return similarities
+    
+    def _top_k_group_rows(self, similarities: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        按图片分组取每组最高分，返回分数最高的 top_k 个组各自的最佳行（按分数降序）
+        """
+        top_k = min(top_k, self._live_groups)  # 只统计仍有未删除行的图片
+        num_groups = self._num_groups
+        if num_groups == self._size:
+            # 每张图只有一个向量，无需分组
+            return top_k_indices(similarities, top_k)
+        
+        groups = self._groups[:self._size]
+        
+        # 分段取最大值：每组的最高分
+        best = np.full(num_groups, -np.inf, dtype=np.float32)
+        np.maximum.at(best, groups, similarities)
+        top_groups = top_k_indices(best, top_k)
+        
+        # 找出入选组中取得最高分的行
+        rank = np.full(num_groups, -1, dtype=np.int64)
+        rank[top_groups] = np.arange(len(top_groups))
+        row_rank = rank[groups]
+        candidates = np.nonzero((row_rank >= 0) & (similarities == best[groups]))[0]
+        
+        rows = np.empty(len(top_groups), dtype=np.int64)
+        rows[row_rank[candidates[::-1]]] = candidates[::-1]  # 同分时保留 ID 较小的行
+        return rows
+    
+    def evaluate_recall(self, top_k: int = 10, num_queries: int = 100) -> Dict[str, Any]:
+        """
+        以 float32 精确暴力扫描为基准评估 search 的 recall@k
+        
+        随机抽取索引中的向量作为查询，比较两者的 top_k 结果，并统计平均耗时
         
         Returns:
-            [{sha256, score, matched_by, matched_text}, ...]
-        """
-        # 多取一些结果用于去重
-        raw_results = self.search(query, top_k * 3)
-        
-        # 按 sha256 去重
-        seen = {}
-        for idx, score, info in raw_results:
-            sha256 = info["sha256"]
-            if sha256 not in seen or score > seen[sha256]["score"]:
-                seen[sha256] = {
-                    "sha256": sha256,
-                    "score": score,
-                    "matched_by": info["method"]
-                }
-        
-        # 排序并返回 top_k
-        results = sorted(seen.values(), key=lambda x: x["score"], reverse=True)
-        return results[:top_k]
+            {recall, top_k, num_queries, search_ms, exact_ms, backend, 后端参数...}
+        """
+        report = {"backend": self.backend, **self._backend_options(), "top_k": top_k}
+        with self._lock.read():
+            live_rows = np.nonzero(~self._deleted[:self._size])[0]
+            if len(live_rows) == 0:
+                return {**report, "recall": None, "num_queries": 0}
+            rng = np.random.default_rng()
+            queries = self._get_rows(rng.choice(live_rows, min(num_queries, len(live_rows)), replace=False))
+        
+        hits = 0
+        expected = 0
+        search_time = 0.0
+        exact_time = 0.0
+        for query in queries:
+            with self._lock.read():
+                k = min(top_k, self.count())
+                start = time.perf_counter()
+                similarities = self._search_similarities(query, k)
+                rows = top_k_indices(similarities, k)
+                search_time += time.perf_counter() - start
+                
+                start = time.perf_counter()
+                exact_rows = top_k_indices(self._similarities(query, exact=True), k)
+                exact_time += time.perf_counter() - start
+            
+            hits += len(np.intersect1d(rows[similarities[rows] != -np.inf], exact_rows))
+            expected += len(exact_rows)
+        
+        return {
+            **report,
+            "recall": hits / max(expected, 1),
+            "num_queries": len(queries),
+            "search_ms": search_time * 1000 / len(queries),
+            "exact_ms": exact_time * 1000 / len(queries)
+        }
     
     def remove(self, sha256: str) -> int:
         """
         从索引中移除指定 sha256 的所有向量
-        注意：这会导致 ID 重新编号，需要重建索引
+        
+        只做墓碑标记（O(该图片的行数)），搜索时屏蔽；已删除的行占比超过
+        purge_deleted_ratio 时在后台重写索引清除，届时 ID 会重新编号
         
         Args:
             sha256: 要移除的图片 SHA256
@@ -241,58 +1616,149 @@ class VectorIndex:
         Returns:
             移除的数量
         """
-        with self._lock:
-            # 找到要移除的索引
-            remove_indices = [i for i, info in enumerate(self._ids) if info["sha256"] == sha256]
-            
-            if not remove_indices:
+        with self._write_lock:
+            with self._lock.write():
+                removed = self._delete_sha256(sha256)
+                if removed:
+                    self._bump_version()
+            if not removed:
                 return 0
             
-            # 创建保留的索引
-            keep_indices = [i for i in range(len(self._ids)) if i not in remove_indices]
-            
-            # 更新数据
-            if keep_indices and self._embeddings:
-                self._embeddings[0] = self._embeddings[0][keep_indices]
-                self._ids = [self._ids[i] for i in keep_indices]
-                # 重新编号
-                for i, entry in enumerate(self._ids):
-                    entry["id"] = i
-            else:
-                self._embeddings = []
-                self._ids = []
-            
-            # 保存数据
-            self._save_data()
+            self._append_wal_delete(sha256)
+            if self._wal_count >= self.wal_compact_rows:
+                self._compact()
             
-            return len(remove_indices)
+            self._purge_in_background()
+            return removed
+    
+    def get_vectors(self, sha256: str, method: str = None) -> Optional[np.ndarray]:
+        """
+        获取某张图片在索引中的向量（已归一化）
+        
+        Args:
+            sha256: 图片 SHA256
+            method: 只返回指定来源的向量，None 表示全部
+        
+        Returns:
+            向量矩阵 (k, dimension)，按 ID 顺序；图片不在索引中时返回 None
+        """
+        with self._lock.read():
+            rows = self._sha256_rows(sha256)
+            if method is not None:
+                rows = rows[self._method_codes[rows] == self._method_ids.get(method, -1)]
+            if len(rows) == 0:
+                return None
+            return self._get_rows(rows)
+    
+    def contains(self, sha256: str) -> bool:
+        """图片是否在索引中（有未删除的向量）"""
+        with self._lock.read():
+            group = self._lookup_groups(self._sha256_key(sha256)[None])[0]
+            return bool(group >= 0 and self._group_live[group] > 0)
     
     def count(self) -> int:
-        """返回索引中的向量数量"""
-        return len(self._ids)
+        """返回索引中的向量数量（不含已删除的）"""
+        return self._size - self._deleted_count
     
     def get_info(self, entry_id: int) -> Optional[Dict[str, Any]]:
         """根据 ID 获取信息"""
-        if 0 <= entry_id < len(self._ids):
-            return self._ids[entry_id]
+        if 0 <= entry_id < self._size and not self._deleted[entry_id]:
+            return self._entry(entry_id)
         return None
 
 
+# 分片并行搜索子进程中已打开的文件：路径 → (inode, 内存映射)
+_scan_files: Dict[str, Tuple[int, np.ndarray]] = {}
+
+
+def _scan_shard(path: str, inode: int, num_rows: int, query: np.ndarray,
+                offset: Optional[np.ndarray], scale: Optional[np.ndarray],
+                mask: Optional[np.ndarray], count: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    在进程池的子进程中扫描一个分片（或其粗筛副本），返回分数最高的 count 行 (行号, 分数)
+    
+    文件按路径内存映射后缓存；文件已被合并/清理替换（inode 与主进程不一致）时返回 None，由主进程计算
+    """
+    cached = _scan_files.get(path)
+    if cached is None or cached[0] != inode:
+        try:
+            if os.stat(path).st_ino != inode:
+                return None
+            rows = np.load(path, mmap_mode="r")
+            if os.stat(path).st_ino != inode:
+                return None
+        except FileNotFoundError:
+            return None
+        # 顺便释放已删除文件的映射（清除已删除行后分片数可能变少）
+        for stale in [p for p in _scan_files if not os.path.exists(p)]:
+            del _scan_files[stale]
+        cached = _scan_files[path] = (inode, rows)
+    
+    similarities = np.empty(num_rows, dtype=np.float32)
+    VectorIndex._coarse_dot((cached[1][:num_rows], offset, scale), query, similarities)
+    if mask is not None:
+        similarities[~mask] = -np.inf
+    top = top_k_indices(similarities, count)
+    return top, similarities[top]
+
+
 class VectorIndexManager:
     """向量索引管理器，管理多个索引"""
     
-    def __init__(self, index_dir: str):
+    def __init__(self, index_dir: str,
+                 attribute_loader: Optional[Callable[[Optional[List[str]]], Dict[str, Dict[str, Any]]]] = None,
+                 search_processes: int = 0):
+        """
+        Args:
+            index_dir: 索引目录
+            attribute_loader: 按 sha256 列表（None 表示全部）批量读取图片过滤属性的函数，
+                              如 Database.get_image_attributes，设置到所有索引上
+            search_processes: 分片并行搜索的进程数，0 表示在当前进程内扫描；
+                              所有索引共用一个进程池，每个分片一个任务
+        """
         self.index_dir = Path(index_dir)
         self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.attribute_loader = attribute_loader
+        self.search_pool: Optional[ProcessPoolExecutor] = None
+        if search_processes > 0:
+            # fork 方式启动：子进程不重新导入主模块；第一次提交任务时一次性启动全部子进程，
+            # 在这里提前启动，避免之后在已有多个线程的进程中 fork
+            self.search_pool = ProcessPoolExecutor(search_processes, mp_context=multiprocessing.get_context("fork"))
+            self.search_pool.submit(int).result()
         self._indexes: Dict[str, VectorIndex] = {}
     
+    @staticmethod
+    def _index_class(backend: str):
+        """根据检索后端名称获取索引类"""
+        if backend == "flat":
+            return VectorIndex
+        if backend == "ivf":
+            from ann_index import IVFVectorIndex
+            return IVFVectorIndex
+        raise ValueError(f"未知的检索后端: {backend}，可选: flat, ivf")
+    
+    def _configure(self, index: VectorIndex):
+        """把过滤属性来源和进程池设置到索引上"""
+        index.attribute_loader = self.attribute_loader
+        index.search_pool = self.search_pool
+    
     def get_or_create_index(self, index_name: str, dimension: int,
-                            model_name: str, model_version: str) -> VectorIndex:
-        """获取或创建索引"""
+                            model_name: str, model_version: str,
+                            backend: str = "flat",
+                            backend_options: Optional[Dict[str, Any]] = None) -> VectorIndex:
+        """
+        获取或创建索引
+        
+        Args:
+            backend: 检索后端（flat: 精确检索；ivf: 倒排近似检索）
+            backend_options: 检索后端参数（如 ivf 的 nlist/nprobe）
+        """
         if index_name not in self._indexes:
-            self._indexes[index_name] = VectorIndex(
-                str(self.index_dir), index_name, dimension, model_name, model_version
+            self._indexes[index_name] = self._index_class(backend)(
+                str(self.index_dir), index_name, dimension, model_name, model_version,
+                **(backend_options or {})
             )
+            self._configure(self._indexes[index_name])
         return self._indexes[index_name]
     
     def get_index(self, index_name: str) -> Optional[VectorIndex]:
@@ -307,17 +1773,24 @@ class VectorIndexManager:
             if meta_path.exists():
                 with open(meta_path, "r") as f:
                     meta = json.load(f)
-                self._indexes[index_name] = VectorIndex(
+                self._indexes[index_name] = self._index_class(meta.get("backend", "flat"))(
                     str(self.index_dir),
                     index_name,
                     meta["dimension"],
                     meta["model_name"],
-                    meta["model_version"]
+                    meta["model_version"],
+                    **meta.get("backend_options", {})
                 )
+                self._configure(self._indexes[index_name])
                 return self._indexes[index_name]
         
         return None
     
+    def invalidate_attributes(self, sha256: str):
+        """数据库中的图片信息有变更时调用，通知所有已加载的索引重新同步该图片的过滤属性"""
+        for index in list(self._indexes.values()):
+            index.invalidate_attributes(sha256)
+    
     def list_indexes(self) -> List[Dict[str, Any]]:
         """列出所有索引"""
         indexes = []
@@ -327,6 +1800,9 @@ class VectorIndexManager:
                 if meta_path.exists():
                     with open(meta_path, "r") as f:
                         meta = json.load(f)
+                    # 已加载的索引以内存中的数量为准（包含尚未合并的追加日志）
+                    if path.name in self._indexes:
+                        meta["total_count"] = self._indexes[path.name].count()
                     indexes.append(meta)
         return indexes
 
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+测试 IVFVectorIndex
+
+验证：
+1. 扫描全部聚类（nprobe == nlist）时召回率为 1.0
+2. 保存聚类中心和聚类分配后重新加载，聚类分配和搜索结果不变
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 添加项目路径
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from ann_index import IVFVectorIndex
+
+
+DIMENSION = 8
+NLIST = 4
+
+
+def open_index(index_dir, **kwargs):
+    """打开（或创建）测试索引：4 个聚类，数据量达到 4 * 39 行后自动训练"""
+    options = {"nlist": NLIST, "nprobe": 1, "shard_size": 50, "wal_compact_rows": 100, "purge_deleted_ratio": 2.0}
+    options.update(kwargs)
+    return IVFVectorIndex(str(index_dir), "test", DIMENSION, "model", "1.0", **options)
+
+
+def add_trained_rows(index, count):
+    """添加 count 行（sha256 为 s{编号}）并等待后台训练完成"""
+    embeddings = np.random.default_rng(0).standard_normal((count, DIMENSION)).astype(np.float32)
+    index.add_many(embeddings, [f"s{i}" for i in range(count)])
+    index._train_thread.join()
+    assert index.is_trained
+
+
+def test_recall_full_probe(tmp_path):
+    """测试 nprobe == nlist 时与精确检索的结果完全相同"""
+    index = open_index(tmp_path, nprobe=NLIST)
+    add_trained_rows(index, 230)
+    report = index.evaluate_recall(top_k=10, num_queries=30)
+    assert report["trained"]
+    assert report["recall"] == 1.0
+
+
+def test_reload_after_save(tmp_path):
+    """测试训练保存后重新加载（含追加日志中尚未合并的行），聚类分配和搜索结果不变"""
+    index = open_index(tmp_path)
+    add_trained_rows(index, 200)
+    embeddings = np.random.default_rng(2).standard_normal((30, DIMENSION)).astype(np.float32)
+    index.add_many(embeddings, [f"s{i}" for i in range(200, 230)])  # 留在追加日志中，加载时重新分配聚类
+    assert index._size > index._compacted_count
+    queries = np.random.default_rng(1).standard_normal((5, DIMENSION)).astype(np.float32)
+    expected = [index.search_deduplicated(query, 10) for query in queries]
+
+    reopened = open_index(tmp_path)
+    assert reopened.is_trained
+    assert np.array_equal(reopened._centroids, index._centroids)
+    assert np.array_equal(reopened._assign[:reopened._size], index._assign[:index._size])
+    assert [reopened.search_deduplicated(query, 10) for query in queries] == expected
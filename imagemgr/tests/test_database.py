@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+测试 Database
+
+验证：
+1. 数据库有写入后数据版本递增，以此为键的搜索结果缓存不再返回旧的描述文本
+2. 遍历描述时跨过多个分批，结果与一次查询相同
+3. 图片列表按游标翻页（包括没有创建时间的行）与一次查询的顺序相同，不重复不遗漏
+4. 触发器维护的图片计数在新增、状态变更、软删除和删除后与 COUNT(*) 一致
+5. 批量写入（write_behind）的写操作在 flush 之后可见；同一事务中失败的写操作只回滚自己的保存点，
+   其余写操作照常提交，错误在退出 write_behind 时抛给调用方
+"""
+
+import sys
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+# 添加项目路径
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from database import Database, SCAN_CHUNK, encode_image_cursor
+from ttl_cache import TTLCache
+
+
+@pytest.fixture
+def db(tmp_path):
+    """临时目录中的数据库，测试结束时关闭"""
+    database = Database(str(tmp_path / "test.db"))
+    yield database
+    database.close()
+
+
+def test_cached_search_sees_description_edit(db):
+    """测试缓存搜索结果（含描述文本）之后修改描述，再次搜索返回新的描述"""
+    db.add_image("s0", 10, 20, 100, "png")
+    db.add_description("s0", "vlm", "旧的描述")
+    cache = TTLCache(max_entries=16, ttl=600)
+
+    def search():
+        # 与 api_server 中的搜索接口相同：键包含数据库的数据版本，未命中时补充描述文本后缓存
+        key = ("text", "query", db.version)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        response = [{"sha256": "s0", "matched_text": db.get_descriptions_bulk(["s0"])["s0"]["vlm"]}]
+        cache.put(key, response)
+        return response
+
+    assert search()[0]["matched_text"] == "旧的描述"
+    assert search()[0]["matched_text"] == "旧的描述"
+    assert cache.hits == 1
+
+    db.add_description("s0", "vlm", "新的描述")
+    assert search()[0]["matched_text"] == "新的描述"
+
+    # 批量写入（后台写线程提交）同样使旧条目失效
+    with db.write_behind():
+        db.add_description("s0", "vlm", "批量写入的描述")
+    assert search()[0]["matched_text"] == "批量写入的描述"
+
+
+def test_get_all_descriptions_with_content(db):
+    """测试按主键分批遍历所有有内容的描述（跳过空描述和已删除的图片），limit/offset 截取其中一段"""
+    expected = []
+    with db.write_behind():
+        for i in range(SCAN_CHUNK):
+            db.add_image(f"s{i:04d}", 10, 20, 100, "png")
+            for method in ("ocr", "vlm"):
+                db.add_description(f"s{i:04d}", method, f"{method}-{i}")
+                if i != 3:
+                    expected.append({"image_sha256": f"s{i:04d}", "method": method, "content": f"{method}-{i}"})
+        db.add_description("s0000", "empty", "")
+        db.delete_image("s0003")
+
+    assert list(db.get_all_descriptions_with_content()) == expected
+    assert list(db.get_all_descriptions_with_content(limit=3, offset=2)) == expected[2:5]
+
+
+def add_images(db, created_at):
+    """按 {sha256: 创建时间} 添加图片（来源按编号奇偶分为 a/b），created_at 为 None 时置为 NULL"""
+    for i, (sha256, created) in enumerate(created_at.items()):
+        db.add_image(sha256, 10, 20, 100, "png", source="ab"[i % 2])
+        with db.get_cursor() as cursor:
+            cursor.execute("UPDATE images SET created_at = ? WHERE sha256 = ?", (created, sha256))
+
+
+def test_list_images_cursor_with_null_created_at(db):
+    """测试游标翻页经过没有创建时间的行：逐页结果与一次查询相同，不重复不遗漏"""
+    add_images(db, {
+        "s0": "2024-01-02 00:00:00", "s1": None, "s2": "2024-01-01 00:00:00", "s3": "2024-01-02 00:00:00",
+        "s4": None, "s5": "2024-01-03 00:00:00", "s6": None, "s7": "2024-01-01 00:00:00"
+    })
+
+    for source in (None, "a"):
+        expected = [image["sha256"] for image in db.list_images(limit=100, source=source)]
+        assert expected[-3 if source is None else -2:] == (["s6", "s4", "s1"] if source is None else ["s6", "s4"])
+        for page_size in (1, 2, 3):
+            pages = [db.list_images(limit=page_size, source=source)]
+            while len(pages[-1]) == page_size:
+                pages.append(db.list_images(limit=page_size, source=source, cursor=encode_image_cursor(pages[-1][-1])))
+            assert [image["sha256"] for page in pages for image in page] == expected
+
+    # 游标之后再跳过若干行
+    cursor = encode_image_cursor(db.get_image("s3"))
+    assert [image["sha256"] for image in db.list_images(limit=2, offset=2, cursor=cursor)] == ["s2", "s6"]
+
+
+def test_image_counts_match_count(db):
+    """测试触发器维护的 image_counts 在新增、状态变更、软删除和删除后与 COUNT(*) 一致"""
+    def assert_counts():
+        with db.read_cursor() as cursor:
+            cursor.execute("""
+                SELECT IFNULL(source, ''), IFNULL(status, ''), COUNT(*) FROM images
+                WHERE is_deleted = 0 GROUP BY 1, 2
+            """)
+            expected = {(source, status): count for source, status, count in cursor.fetchall()}
+            cursor.execute("SELECT source, status, count FROM image_counts WHERE count != 0")
+            assert {(source, status): count for source, status, count in cursor.fetchall()} == expected
+        for source in (None, "a", "b"):
+            for status in (None, "pending", "ready"):
+                with db.read_cursor() as cursor:
+                    query = "SELECT COUNT(*) FROM images WHERE is_deleted = 0"
+                    params = []
+                    if source:
+                        query += " AND source = ?"
+                        params.append(source)
+                    if status:
+                        query += " AND status = ?"
+                        params.append(status)
+                    cursor.execute(query, params)
+                    assert db.count_images(source=source, status=status) == cursor.fetchone()[0]
+
+    for i in range(6):
+        db.add_image(f"s{i}", 10, 20, 100, "png", source="ab"[i % 2] if i < 5 else None)
+    db.add_image("s0", 10, 20, 100, "png", source="a")  # 已存在，不计数
+    assert_counts()
+
+    db.update_image_status("s1", "ready")
+    db.update_image_status("s2", "ready")
+    assert_counts()
+
+    db.delete_image("s2")
+    db.delete_image("s3")
+    assert_counts()
+
+    db.delete_image("s3", hard=True)
+    db.delete_image("s4", hard=True)
+    db.delete_image("s5", hard=True)
+    assert_counts()
+    assert db.count_images() == 2
+
+
+def test_write_behind_visible_after_flush(tmp_path):
+    """测试 write_behind 中的写操作只进入队列，flush 之后可以读到"""
+    db = Database(str(tmp_path / "test.db"), batch_interval_ms=60000)  # 只在 flush 时提交
+    try:
+        with db.write_behind():
+            assert db.add_image("s0", 10, 20, 100, "png") is None
+            assert db.get_image("s0") is None
+            db.flush()
+            assert db.get_image("s0")["width"] == 10
+            db.update_image_status("s0", "ready")
+        assert db.get_image("s0")["status"] == "ready"  # 退出时等待提交
+    finally:
+        db.close()
+
+
+def test_write_behind_failed_op_rolls_back_savepoint(tmp_path):
+    """测试同一批中失败的写操作只回滚自己的保存点，其余写操作提交，错误抛给调用方"""
+    db = Database(str(tmp_path / "test.db"), batch_interval_ms=60000)  # 三个写操作合并成一个事务
+
+    def failing_op(cursor):
+        cursor.execute("INSERT INTO images (sha256, width) VALUES ('bad', 1)")
+        cursor.execute("INSERT INTO missing_table VALUES (1)")
+
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            with db.write_behind():
+                db.add_image("s0", 10, 20, 100, "png")
+                db._write(failing_op)
+                db.add_image("s1", 10, 20, 100, "png")
+
+        assert db.get_image("s0") is not None
+        assert db.get_image("s1") is not None
+        assert db.get_image("bad") is None  # 失败写操作中已执行的语句被回滚
+        assert db.count_images() == 2
+    finally:
+        db.close()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+测试 VectorIndex 的持久化与崩溃恢复
+
+验证：
+1. 重新加载时重放追加日志（新增和删除）
+2. 追加日志末尾写了一半时丢弃不完整的记录
+3. 合并/清理在提交（替换 meta.json）之前中断时，重新加载仍得到一致的数据
+4. 分片与 ID 元数据行数不一致时拒绝加载
+5. 分片并行搜索的进程池损坏时改为本进程计算
+6. 按 sha256 去重的搜索结果与逐行暴力计算的精确 top_k 一致
+7. 在量化（fp16/int8）副本上粗筛、再用 float32 精确重排的结果与精确 top_k 一致
+8. 只用前缀维度粗筛（可与量化同时使用）、再精确重排的结果与精确 top_k 一致
+9. 过滤条件（来源、处理状态、数据库中已删除、向量来源、创建日期）的掩码与逐行判断的精确 top_k 一致
+"""
+
+import os
+import sys
+import json
+import signal
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# 添加项目路径
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from vector_index import VectorIndex, VectorIndexManager, WAL_EMBEDDINGS_FILE, WAL_IDS_FILE
+
+
+DIMENSION = 8
+
+
+def open_index(index_dir, **kwargs):
+    """打开（或创建）测试索引：小分片，默认不自动合并、不后台清理"""
+    options = {"shard_size": 5, "wal_compact_rows": 1000, "purge_deleted_ratio": 2.0}
+    options.update(kwargs)
+    return VectorIndex(str(index_dir), "test", DIMENSION, "model", "1.0", **options)
+
+
+def add_rows(index, start, count):
+    """添加 count 行，sha256 为 s{编号}，返回原始向量"""
+    embeddings = np.random.default_rng(start).standard_normal((count, DIMENSION)).astype(np.float32)
+    index.add_many(embeddings, [f"s{i}" for i in range(start, start + count)])
+    return embeddings
+
+
+def snapshot(index):
+    """索引中所有未删除行的 (sha256, method, 向量)，按 ID 排序"""
+    rows = []
+    for row in range(index._size):
+        entry = index.get_info(row)
+        if entry is not None:
+            rows.append((entry["sha256"], entry["method"], index._get_rows([row])[0].tolist()))
+    return rows
+
+
+def exact_search(index, query, top_k, deduplicate=True, keep=None):
+    """
+    逐行暴力计算的精确 top_k：[(sha256 或 ID, 分数)]，按分数降序
+
+    对所有未删除行的 float32 向量计算内积（keep(entry) 为 False 的行跳过），deduplicate 时每张图片取最高分
+    """
+    query = query / np.linalg.norm(query)
+    scores = {}
+    for row in range(index._size):
+        entry = index.get_info(row)
+        if entry is None or (keep is not None and not keep(entry)):
+            continue
+        key = entry["sha256"] if deduplicate else row
+        score = float(index._get_rows([row])[0] @ query)
+        if score > scores.get(key, -np.inf):
+            scores[key] = score
+    return sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+
+
+def assert_matches_exact(results, expected):
+    """search_deduplicated 的结果与精确 top_k 的图片和分数一致"""
+    assert [r["sha256"] for r in results] == [sha256 for sha256, _ in expected]
+    assert [r["score"] for r in results] == pytest.approx([score for _, score in expected], abs=1e-5)
+
+
+class CheckpointCrash(Exception):
+    """模拟保存检查点时进程中断"""
+
+
+def crash_on_checkpoint(index):
+    """让索引下一次保存检查点时抛出异常（此时新分片已经写好，meta.json 尚未提交）"""
+    def fail():
+        raise CheckpointCrash()
+    index._save_checkpoint = fail
+
+
+def test_wal_replay(tmp_path):
+    """测试重新加载时重放追加日志"""
+    index = open_index(tmp_path)
+    add_rows(index, 0, 7)
+    index.remove("s2")
+    add_rows(index, 7, 3)
+    expected = snapshot(index)
+    assert index._compacted_count == 0  # 全部在追加日志中
+
+    reopened = open_index(tmp_path)
+    assert reopened.count() == 9
+    assert not reopened.contains("s2")
+    assert snapshot(reopened) == expected
+
+
+def test_wal_replay_after_compact(tmp_path):
+    """测试合并之后新增的行和删除记录在重新加载时重放"""
+    index = open_index(tmp_path, wal_compact_rows=4)
+    add_rows(index, 0, 6)  # 触发合并
+    assert index._compacted_count == 6
+    add_rows(index, 6, 2)
+    index.remove("s1")
+    expected = snapshot(index)
+
+    reopened = open_index(tmp_path, wal_compact_rows=4)
+    assert snapshot(reopened) == expected
+    assert reopened.count() == 7
+
+
+def test_torn_wal_tail(tmp_path):
+    """测试追加日志末尾只写了一半（向量和记录都不完整）时丢弃该条记录"""
+    index = open_index(tmp_path)
+    add_rows(index, 0, 4)
+    expected = snapshot(index)
+
+    index_path = tmp_path / "test"
+    with open(index_path / WAL_EMBEDDINGS_FILE, "ab") as f:
+        f.write(np.ones(DIMENSION // 2, dtype=np.float32).tobytes())
+    with open(index_path / WAL_IDS_FILE, "a") as f:
+        f.write('{"sha256": "s4", "met')
+
+    reopened = open_index(tmp_path)
+    assert snapshot(reopened) == expected
+
+    # 加载时已合并成干净的状态，再次加载和继续写入都正常
+    add_rows(reopened, 4, 1)
+    assert open_index(tmp_path).count() == 5
+
+
+def test_torn_wal_embeddings(tmp_path):
+    """测试记录已写入但向量不完整时丢弃该条记录"""
+    index = open_index(tmp_path)
+    add_rows(index, 0, 3)
+    expected = snapshot(index)
+
+    index_path = tmp_path / "test"
+    size = (index_path / WAL_EMBEDDINGS_FILE).stat().st_size
+    with open(index_path / WAL_EMBEDDINGS_FILE, "r+b") as f:
+        f.truncate(size - 4)
+
+    reopened = open_index(tmp_path)
+    assert snapshot(reopened) == expected[:2]
+
+
+def test_crash_during_compact(tmp_path):
+    """测试合并写好新分片后、提交之前中断：重新加载使用旧版本的文件并重放追加日志"""
+    index = open_index(tmp_path, wal_compact_rows=4)
+    add_rows(index, 0, 4)  # 第一次合并：分片 0 写了 4 行
+    add_rows(index, 4, 3)
+    meta_before = json.loads((tmp_path / "test" / "meta.json").read_text())
+
+    crash_on_checkpoint(index)
+    with pytest.raises(CheckpointCrash):
+        add_rows(index, 7, 3)  # 改写分片 0 并新增分片 1
+    expected = snapshot(index)
+    assert json.loads((tmp_path / "test" / "meta.json").read_text()) == meta_before  # 尚未提交
+
+    reopened = open_index(tmp_path, wal_compact_rows=4)
+    assert reopened.count() == 10
+    assert snapshot(reopened) == expected
+
+    # 中断留下的未提交分片已被清理，只剩 meta.json 中记录的分片
+    meta = json.loads((tmp_path / "test" / "meta.json").read_text())
+    shard_files = sorted(p.name for p in (tmp_path / "test").glob("embeddings_*"))
+    assert shard_files == sorted(f"{name}.npy" for name in meta["shards"])
+
+
+def test_crash_during_purge(tmp_path):
+    """测试清理已删除行写好新分片后、提交之前中断：重新加载得到清理前的数据（删除记录重放）"""
+    index = open_index(tmp_path, wal_compact_rows=4)
+    add_rows(index, 0, 12)
+    for sha256 in ("s0", "s3", "s4", "s9"):
+        index.remove(sha256)
+    expected = snapshot(index)
+
+    crash_on_checkpoint(index)
+    with index._write_lock:
+        with pytest.raises(CheckpointCrash):
+            index._purge()
+
+    reopened = open_index(tmp_path, wal_compact_rows=4)
+    assert reopened.count() == 8
+    assert snapshot(reopened) == expected
+    for sha256 in ("s0", "s3", "s4", "s9"):
+        assert not reopened.contains(sha256)
+
+    # 重新加载后正常清理
+    with reopened._write_lock:
+        reopened._purge()
+    assert [row[0] for row in snapshot(open_index(tmp_path))] == [row[0] for row in expected]
+
+
+def test_inconsistent_ids_rejected(tmp_path):
+    """测试分片行数与 ID 元数据条数不一致时拒绝加载"""
+    index = open_index(tmp_path, wal_compact_rows=4)
+    add_rows(index, 0, 6)
+
+    meta_path = tmp_path / "test" / "meta.json"
+    meta = json.loads(meta_path.read_text())
+    ids_path = tmp_path / "test" / f"ids_sha256_{meta['wal_generation']}.npy"
+    np.save(ids_path, np.load(ids_path)[:5])
+
+    with pytest.raises(ValueError):
+        open_index(tmp_path)
+
+
+def test_add_many_empty(tmp_path):
+    """测试批量添加空列表时直接返回"""
+    index = open_index(tmp_path)
+    assert index.add_many([], []) == []
+    assert index.add_many(np.empty((0, DIMENSION), dtype=np.float32), []) == []
+    assert index.count() == 0
+    with pytest.raises(ValueError):
+        index.add_many(np.ones((2, DIMENSION)), [])
+
+
+def test_search_batch_non_positive_top_k(tmp_path):
+    """测试批量搜索 top_k 不大于 0 时每个查询返回空结果"""
+    index = open_index(tmp_path)
+    add_rows(index, 0, 6)
+    queries = np.random.default_rng(100).standard_normal((3, DIMENSION)).astype(np.float32)
+    for deduplicate in (False, True):
+        assert index.search_batch(queries, 0, deduplicate=deduplicate) == [[], [], []]
+        assert index.search_batch(queries, -1, deduplicate=deduplicate) == [[], [], []]
+    assert len(index.search_batch(queries, 2)[0]) == 2
+
+
+def test_sharded_search_broken_pool(tmp_path):
+    """测试分片并行搜索的子进程被杀死后，搜索结果不变并改为本进程计算"""
+    manager = VectorIndexManager(str(tmp_path), search_processes=2)
+    index = manager.get_or_create_index("test", DIMENSION, "model", "1.0", backend_options={
+        "shard_size": 5, "wal_compact_rows": 4
+    })
+    add_rows(index, 0, 23)
+    query = np.random.default_rng(100).standard_normal(DIMENSION).astype(np.float32)
+    expected = index.search_deduplicated(query, 5)
+
+    for pid in list(manager.search_pool._processes):
+        os.kill(pid, signal.SIGKILL)
+    assert index.search_deduplicated(query, 5) == expected
+    assert index.search_pool is None
+    assert index.search_deduplicated(query, 5) == expected
+    manager.search_pool.shutdown(wait=False)
+
+
+def test_search_deduplicated_exact(tmp_path):
+    """测试每张图片有多个向量（分布在分片和缓冲区中）时，去重搜索与暴力计算的精确 top_k 一致"""
+    index = open_index(tmp_path, wal_compact_rows=12)
+    rng = np.random.default_rng(0)
+    sha256s = [f"s{i % 9}" for i in range(40)]
+    methods = ["image" if i < 9 else f"text{i % 3}" for i in range(40)]
+    embeddings = rng.standard_normal((40, DIMENSION)).astype(np.float32)
+    index.add_many(embeddings[:30], sha256s[:30], methods[:30])  # 合并进分片
+    index.add_many(embeddings[30:], sha256s[30:], methods[30:])  # 留在缓冲区
+    index.remove("s4")
+    assert index._compacted_count > 0 and index._size > index._compacted_count
+
+    queries = rng.standard_normal((5, DIMENSION)).astype(np.float32)
+    for top_k in (1, 3, 20):
+        batch = index.search_batch(queries, top_k, deduplicate=True)
+        for query, batch_results in zip(queries, batch):
+            expected = exact_search(index, query, top_k)
+            assert len(expected) == min(top_k, 8)
+            results = index.search_deduplicated(query, top_k)
+            assert_matches_exact(results, expected)
+            assert_matches_exact(batch_results, expected)
+
+
+def assert_coarse_search_exact(index, seed=0):
+    """分片和缓冲区中各有数据时，粗筛 + 精确重排的 search/search_deduplicated 与精确 top_k 一致"""
+    rng = np.random.default_rng(seed)
+    # 前几维方差更大（类似 Matryoshka 表示学习的模型，前缀维度携带主要信息）
+    scale = np.linspace(3, 1, DIMENSION).astype(np.float32)
+    embeddings = rng.standard_normal((230, DIMENSION)).astype(np.float32) * scale
+    sha256s = [f"s{i % 200}" for i in range(230)]
+    index.add_many(embeddings[:200], sha256s[:200])
+    index.add_many(embeddings[200:], sha256s[200:], ["text"] * 30)
+    assert index._coarse_tag is not None and index._size > index._compacted_count > 0
+
+    for query in embeddings[rng.choice(230, 5, replace=False)] + rng.standard_normal((5, DIMENSION)) * 0.5:
+        query = query.astype(np.float32)
+        expected = exact_search(index, query, 5, deduplicate=False)
+        results = index.search(query, 5)
+        assert [row for row, _, _ in results] == [row for row, _ in expected]
+        assert [score for _, score, _ in results] == pytest.approx([score for _, score in expected], abs=1e-5)
+        assert_matches_exact(index.search_deduplicated(query, 5), exact_search(index, query, 5))
+
+
+@pytest.mark.parametrize("quantization", ["fp16", "int8"])
+def test_quantized_search_rescored_exact(tmp_path, quantization):
+    """测试在量化副本上粗筛 top_k * rescore_factor 个候选，再用 float32 重排后与精确 top_k 一致"""
+    index = open_index(tmp_path, shard_size=64, wal_compact_rows=100, quantization=quantization, rescore_factor=10)
+    assert_coarse_search_exact(index)
+
+
+@pytest.mark.parametrize("quantization", [None, "int8"])
+def test_prefix_search_rescored_exact(tmp_path, quantization):
+    """测试只用前 4 维（重新归一化）粗筛，再用全维 float32 重排后与精确 top_k 一致"""
+    index = open_index(tmp_path, shard_size=64, wal_compact_rows=100, prefix_dimension=4,
+                       quantization=quantization, rescore_factor=10)
+    assert_coarse_search_exact(index)
+
+
+def test_filtered_search_exact(tmp_path):
+    """测试各种过滤条件下的搜索结果与按数据库属性逐行判断后暴力计算的精确 top_k 一致"""
+    images = {
+        f"s{i}": {
+            "source": [None, "a", "b"][i % 3],
+            "status": "ready" if i % 2 else "pending",
+            "is_deleted": int(i % 7 == 3),
+            "created_at": f"2024-01-{1 + i % 10:02d} 12:00:00"
+        }
+        for i in range(30) if i % 10 != 9  # s9/s19/s29 在数据库中不存在
+    }
+    index = open_index(tmp_path, wal_compact_rows=20)
+    index.attribute_loader = lambda sha256s: {
+        sha256: images[sha256] for sha256 in (images if sha256s is None else sha256s) if sha256 in images
+    }
+    rng = np.random.default_rng(0)
+    sha256s = [f"s{i % 30}" for i in range(50)]
+    methods = ["image" if i < 30 else "text" for i in range(50)]
+    embeddings = rng.standard_normal((50, DIMENSION)).astype(np.float32)
+    index.add_many(embeddings[:40], sha256s[:40], methods[:40])
+    index.add_many(embeddings[40:], sha256s[40:], methods[40:])
+
+    def keep(filters):
+        def check(entry):
+            image = images.get(entry["sha256"])
+            if not filters.get("include_deleted") and (image is None or image["is_deleted"]):
+                return False
+            for field in ("source", "status"):
+                if field in filters and (image is None or image[field] not in filters[field]):
+                    return False
+            if "method" in filters and entry["method"] not in filters["method"]:
+                return False
+            created = image["created_at"][:10] if image else None
+            if "created_from" in filters and (created is None or created < filters["created_from"]):
+                return False
+            if "created_to" in filters and (created is None or created > filters["created_to"]):
+                return False
+            return True
+        return check
+
+    cases = [
+        {},
+        {"include_deleted": True},
+        {"source": ["a"]},
+        {"source": ["a", "b"], "status": ["ready"]},
+        {"status": ["pending"], "include_deleted": True},
+        {"method": ["text"]},
+        {"created_from": "2024-01-03", "created_to": "2024-01-06"},
+        {"source": ["b"], "method": ["image"], "created_to": "2024-01-05"},
+        {"source": ["missing"]}
+    ]
+    queries = rng.standard_normal((4, DIMENSION)).astype(np.float32)
+    for filters in cases:
+        for query in queries:
+            expected = exact_search(index, query, 6, keep=keep(filters))
+            assert_matches_exact(index.search_deduplicated(query, 6, filters=filters), expected)
+
+            expected_rows = exact_search(index, query, 6, deduplicate=False, keep=keep(filters))
+            results = index.search(query, 6, filters=filters)
+            assert [row for row, _, _ in results] == [row for row, _ in expected_rows]